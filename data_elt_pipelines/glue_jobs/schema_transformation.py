@@ -1,6 +1,7 @@
 import json
 import logging
 import csv
+from collections import Counter
 
 import boto3
 from botocore.exceptions import ClientError
@@ -22,7 +23,7 @@ from shared.content_type import ContentType
 from shared.utils import get_timestamp_string
 import schema_transformation.cdm_mapper as cdm_mapper
 from shared.dynamodb import DynamoTable
-from shared.utils import is_date_string_valid, encode_jsonb_fields
+from shared.utils import encode_jsonb_fields
 from schema_definition import cdm_schema
 from shared.cdm_company import CdmCompany
 from glue_utils import (
@@ -118,27 +119,23 @@ def save_to_datalake(
     """
 
     try:
-        for result_model, index in cdm_mapper.schema_transformation(
-            data, mapping_rules, file_metadata, CdmCompany, chunk_size=chunk_size
+        # chunks come split into valid and invalid records, checked while mapping
+        for (valid, invalid, invalid_fields), index in cdm_mapper.schema_transformation(
+            data,
+            mapping_rules,
+            file_metadata,
+            CdmCompany,
+            chunk_size=chunk_size,
+            partition=True,
+            no_data_ok=False,
         ):
-            logger.info(f"Processing part {index}.  {len(result_model)} records")
-            date_fields = cdm_mapper.get_date_fields(mapping_rules)
-            valid = [
-                row
-                for row in result_model
-                if all(
-                    is_date_string_valid(row[date_field]) for date_field in date_fields
-                )
-            ]
-            invalid = [
-                row
-                for row in result_model
-                if not all(
-                    is_date_string_valid(row[date_field]) for date_field in date_fields
-                )
-            ]
+            logger.info(
+                f"Processing part {index}.  {len(valid) + len(invalid)} records"
+            )
             logger.info(f"valid count {len(valid)}")
             logger.info(f"invalid count {len(invalid)}")
+            if invalid_fields:
+                logger.info(f"invalid fields {dict(Counter(invalid_fields))}")
 
             encoded_data = []
             for record in valid:
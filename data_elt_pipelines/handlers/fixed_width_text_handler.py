@@ -5,8 +5,12 @@ import logging
 import os
 import bz2
 from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import raw_parsers.fixed_width_txt as parser
+from raw_parsers.fixed_width_txt import ParserBackend
+from shared.hashing import HashAlgorithm
 from shared.metadata import ConfigMetadata
 from shared.utils import get_timestamp_string, get_target_s3_object_key
 from shared.content_type import ContentType
@@ -18,6 +22,8 @@ from shared.constants import (
     MULTI_PART_FILE_CHUNK_SIZE,
 )
 from shared.ecs_service import run_ecs_task
+from shared.s3_stream import CsvStreamSink, S3MultipartWriter
+from shared.config_cache import S3ObjectCache
 from shared.dynamodb import add_glue_job_task
 
 
@@ -27,6 +33,9 @@ if not logger.name:
     logger.name = module_name
 logger.setLevel(logging.INFO)
 
+# field definitions parsed by earlier invocations of a warm container
+field_def_cache = S3ObjectCache()
+
 
 def process_with_ecs(
     object_key: str,
@@ -76,6 +85,16 @@ def process_with_ecs(
         "region": kwargs.get("aws_region"),
         "chunk_size": chunk_size,
     }
+    if kwargs.get("parser_backend"):
+        payload.update({"parser_backend": kwargs.get("parser_backend")})
+    if kwargs.get("hash_algorithm"):
+        payload.update({"hash_algorithm": kwargs.get("hash_algorithm")})
+    if kwargs.get("parse_workers"):
+        payload.update({"parse_workers": kwargs.get("parse_workers")})
+    if kwargs.get("upload_workers"):
+        payload.update({"upload_workers": kwargs.get("upload_workers")})
+    if kwargs.get("max_in_flight_chunks"):
+        payload.update({"max_in_flight_chunks": kwargs.get("max_in_flight_chunks")})
     if kwargs.get("source_data_bucket"):
         payload.update({"source_data_bucket": kwargs.get("source_data_bucket")})
     if kwargs.get("rules"):
@@ -105,7 +124,7 @@ def process_file(
     **kwargs,
 ) -> str:
     """
-    Process fixed width text file, by default it will not chunk the file
+    Process fixed width text file, by default it will not chunk the file.
     :param object_key: object key
     :param raw_data_bucket: raw data bucket
     :param source_data_bucket: source data bucket
@@ -149,6 +168,10 @@ def process_file(
         }
     )
     chunk_size = kwargs.get("chunk_size", 0)
+    backend = ParserBackend(kwargs.get("parser_backend") or ParserBackend.PYTHON)
+    hash_algorithm = HashAlgorithm(
+        kwargs.get("hash_algorithm") or HashAlgorithm.LEGACY
+    )
 
     if file_obj["ContentLength"] > MULTI_PART_FILE_CHUNK_SIZE:
         logger.info(f"Chunk size {chunk_size}, will use chunking")
@@ -160,14 +183,65 @@ def process_file(
             rules,
             s3_client,
             chunk_size,
+            backend=backend,
+            hash_algorithm=hash_algorithm,
+            workers=int(kwargs.get("parse_workers") or 0),
+            upload_workers=int(kwargs.get("upload_workers") or 0),
+            max_in_flight=int(kwargs.get("max_in_flight_chunks") or 0),
         )
     else:
         logger.info(f"transform_to_csv_chunks chunk size {chunk_size})")
         return transform_to_csv(
-            object_key, source_data_bucket, file_obj, metadata, rules, s3_client
+            object_key,
+            source_data_bucket,
+            file_obj,
+            metadata,
+            rules,
+            s3_client,
+            backend=backend,
+            hash_algorithm=hash_algorithm,
         )
 
 
+def upload_chunk(
+    target_bucket: str,
+    target_object_key: str,
+    data: io.StringIO | bytes,
+    metadata: dict,
+    s3_client: boto3.client,
+) -> str:
+    """
+    Compress a csv chunk, unless it is compressed already, and upload it
+    :param target_bucket: target bucket
+    :param target_object_key: target object key
+    :param data: csv chunk, or bz2 compressed bytes from the parser workers
+    :param metadata: metadata
+    :param s3_client: s3 client
+    :return: target object key
+    """
+    if isinstance(data, bytes):
+        body = data
+    else:
+        body = bz2.compress(data.getvalue().encode("utf-8"))
+    try:
+        s3_client.put_object(
+            Bucket=target_bucket,
+            Key=target_object_key,
+            Body=body,
+            Metadata=metadata,
+            ContentType=ContentType.CSV.value,
+            ContentEncoding="bzip2",
+        )
+        logger.info(f"File {target_object_key} created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to put file: {target_object_key} error: {str(e)}")
+        raise
+    except ClientError as e:
+        logger.error(f"Failed to put file: {target_object_key} error: {str(e)}")
+        raise
+    return target_object_key
+
+
 def transform_to_csv_chunks(
     source_obj_key: str,
     target_bucket: str,
@@ -176,24 +250,45 @@ def transform_to_csv_chunks(
     rules: dict,
     s3_client: boto3.client,
     chunk_size: int = DEFAULT_DATA_CHUNK_SIZE,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    workers: int = 0,
+    upload_workers: int = 0,
+    max_in_flight: int = 0,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
 ) -> tuple[str, int]:
     """
-    Transform fixed width text file to a number of compressed CSV files
+    Transform fixed width text file to a number of compressed CSV files.
+    With upload_workers the chunks are compressed and uploaded in a thread pool while
+    the next chunks are parsed, at most max_in_flight chunks are parsed but not yet
+    uploaded, the parser waits for the oldest upload when the limit is reached.
     :param source_obj_key: source object key
     :param target_bucket: target bucket
     :param data: data
     :param metadata: metadata
     :param rules: rules
     :param s3_client: s3 client
+    :param chunk_size: number of lines per chunk file
+    :param backend: parser backend
+    :param workers: number of processes parsing and compressing chunks, 0 for none
+    :param upload_workers: number of threads compressing and uploading chunks, 0 for none
+    :param max_in_flight: maximum number of chunks waiting for upload, default 2 per thread
+    :param hash_algorithm: algorithm of the hash column
     :return: target objects prefix
     """
     prefix = source_obj_key.split("/")[0]
-    file_content = io.StringIO(
-        file_obj["Body"].read().decode("utf-8", errors="replace")
+    target_object_key = ""
+    # stream the body so only a few chunks are held in memory at any time
+    chunks = parser.parse_stream(
+        file_obj["Body"],
+        rules,
+        add_hash=True,
+        chunk_size=chunk_size or DEFAULT_DATA_CHUNK_SIZE,
+        backend=backend,
+        workers=workers,
+        hash_algorithm=hash_algorithm,
     )
-    for data_string_io, index in parser.parse_chunks(
-        file_content, rules, add_hash=True, chunk_size=chunk_size
-    ):
+
+    def get_chunk_object_key(index: int) -> str:
         file_key = get_target_s3_object_key(
             prefix=prefix,
             timestamp=datetime.strptime(
@@ -203,24 +298,43 @@ def transform_to_csv_chunks(
             index=index,
             add_file_name_as_prefix=True,
         )
-        target_object_key = f"{file_key}.bz2"
-        data_string_io.seek(0)
-        body = bz2.compress(data_string_io.getvalue().encode("utf-8"))
-        try:
-            s3_client.put_object(
-                Bucket=target_bucket,
-                Key=target_object_key,
-                Body=body,
-                Metadata=metadata,
-                ContentType=ContentType.CSV.value,
-                ContentEncoding="bzip2",
+        return f"{file_key}.bz2"
+
+    if upload_workers <= 0:
+        for data, index in chunks:
+            target_object_key = get_chunk_object_key(index)
+            upload_chunk(
+                target_bucket,
+                target_object_key,
+                data,
+                metadata,
+                s3_client,
             )
-            logger.info(f"File {target_object_key} created successfully.")
-        except Exception as e:
-            logger.error(f"Failed to put file: {target_object_key} error: {str(e)}")
-            raise
-        except ClientError as e:
-            logger.error(f"Failed to put file: {target_object_key} error: {str(e)}")
+        return os.path.dirname(target_object_key), -1
+
+    max_in_flight = max_in_flight or upload_workers * 2
+    with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        in_flight = deque()
+        try:
+            for data, index in chunks:
+                target_object_key = get_chunk_object_key(index)
+                in_flight.append(
+                    executor.submit(
+                        upload_chunk,
+                        target_bucket,
+                        target_object_key,
+                        data,
+                        metadata,
+                        s3_client,
+                    )
+                )
+                if len(in_flight) >= max_in_flight:
+                    in_flight.popleft().result()
+            while in_flight:
+                in_flight.popleft().result()
+        except Exception:
+            # don't start the uploads still queued when one of them failed
+            executor.shutdown(wait=True, cancel_futures=True)
             raise
     return os.path.dirname(target_object_key), -1
 
@@ -232,15 +346,20 @@ def transform_to_csv(
     metadata: dict,
     rules: dict,
     s3_client: boto3.client,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
 ) -> tuple[str, int]:
     """
-    Transform fixed width text file to CSV
+    Transform fixed width text file to CSV, the body is parsed as a stream and
+    written through a bz2 compressor to a multipart upload
     :param source_obj_key: source object key
     :param target_bucket: target bucket
     :param data: data
     :param metadata: metadata
     :param rules: rules
     :param s3_client: s3 client
+    :param backend: parser backend
+    :param hash_algorithm: algorithm of the hash column
     :return: target object key and byte size
     """
     # a jurisdiction can have multiple prefixes, such like us_fl, us_fl_historical
@@ -253,54 +372,53 @@ def transform_to_csv(
         index=None,
         add_file_name_as_prefix=False,
     )
-
-    file_content = io.StringIO(
-        file_obj["Body"].read().decode("utf-8", errors="replace")
-    )
-    try:
-        data_string_io = parser.parse(file_content, rules)
-    except Exception as e:
-        logger.error(f"Failed to parse file: {source_obj_key} error: {str(e)}")
-        raise
-
-    data_string_io.seek(0)
     target_object_key = f"{file_key}.bz2"
-    body = bz2.compress(data_string_io.getvalue().encode("utf-8"))
-    # get bytes size
-    byte_size = len(body)
 
+    writer = S3MultipartWriter(
+        s3_client,
+        target_bucket,
+        target_object_key,
+        metadata=metadata,
+        content_type=ContentType.CSV,
+        compress=True,
+    )
     try:
-        s3_client.put_object(
-            Bucket=target_bucket,
-            Key=target_object_key,
-            Body=body,
-            Metadata=metadata,
-            ContentType=ContentType.CSV.value,
-            ContentEncoding="bzip2",
-        )
-        logger.info(f"File {target_object_key} created successfully.")
+        with CsvStreamSink([writer]) as sink:
+            sink.writerows(
+                parser.parse_stream_rows(
+                    file_obj["Body"],
+                    rules,
+                    backend=backend,
+                    hash_algorithm=hash_algorithm,
+                )
+            )
     except Exception as e:
-        logger.error(f"Failed to put file: {target_object_key} error: {str(e)}")
+        logger.error(f"Failed to transform file: {source_obj_key} error: {str(e)}")
         raise
     except ClientError as e:
         logger.error(f"Failed to put file: {target_object_key} error: {str(e)}")
         raise
 
-    return target_object_key, byte_size
+    return target_object_key, writer.size
 
 
 def get_fixed_width_field_def(
     jurisdiction: str, bucket: str, s3_client: boto3.client
 ) -> dict:
     """
-    Get fixed width field definition
+    Get fixed width field definition, cached across warm invocations
     :param jurisdiction: jurisdiction
-    :return: fixed width field definition
+    :return: fixed width field definition, shared with later invocations
     """
     fixed_width_field_def = f"fixed_width_field_def/{jurisdiction.lower()}/latest/{jurisdiction.lower()}.json"
 
     try:
-        response = s3_client.get_object(Bucket=bucket, Key=fixed_width_field_def)
+        return field_def_cache.get(
+            s3_client,
+            bucket,
+            fixed_width_field_def,
+            lambda body: json.loads(body.decode("utf-8", errors="replace")),
+        )
     except Exception as e:
         logger.error(
             f"Failed to get fixed width field definition: {fixed_width_field_def}, error: {str(e)}"
@@ -311,7 +429,6 @@ def get_fixed_width_field_def(
             f"Failed to get fixed width field definition: {fixed_width_field_def}, error: {str(e)}"
         )
         raise
-    return json.loads(response["Body"].read().decode("utf-8", errors="replace"))
 
 
 def lambda_handler(event, context):
@@ -360,6 +477,19 @@ def lambda_handler(event, context):
         logger.error("region is required")
         raise ValueError("region is required")
 
+    parser_backend = event.get("parser_backend", os.getenv("parser_backend"))
+    hash_algorithm = event.get("hash_algorithm", os.getenv("hash_algorithm"))
+    # only used in the ecs task, lambda can't run a process pool
+    parse_workers = int(
+        event.get("parse_workers", os.getenv("parse_workers")) or 0
+    )
+    upload_workers = int(
+        event.get("upload_workers", os.getenv("upload_workers")) or 0
+    )
+    max_in_flight_chunks = int(
+        event.get("max_in_flight_chunks", os.getenv("max_in_flight_chunks")) or 0
+    )
+
     s3_client = boto3.client("s3", region_name=aws_region)
 
     if job_action == JobAction.START:
@@ -406,6 +536,11 @@ def lambda_handler(event, context):
                     rules=event.get("rules"),
                     aws_region=aws_region,
                     memory=os.getenv("ecs_container_memory_size"),
+                    parser_backend=parser_backend,
+                    hash_algorithm=hash_algorithm,
+                    parse_workers=parse_workers,
+                    upload_workers=upload_workers,
+                    max_in_flight_chunks=max_in_flight_chunks,
                 )
                 logger.info(f"Starting esc task for {raw_file_key}")
                 return {
@@ -434,6 +569,11 @@ def lambda_handler(event, context):
                 s3_client=s3_client,
                 rules_bucket=config_bucket,
                 chunk_size=int(event.get("chunk_size", os.getenv("chunk_size", 0))),
+                parser_backend=parser_backend,
+                hash_algorithm=hash_algorithm,
+                parse_workers=0 if is_lambda_runtime else parse_workers,
+                upload_workers=upload_workers,
+                max_in_flight_chunks=max_in_flight_chunks,
             )
         except Exception as e:
             logger.error(f"Failed to process file: {raw_file_key} error: {str(e)}")
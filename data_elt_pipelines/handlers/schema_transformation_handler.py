@@ -1,13 +1,13 @@
 import boto3
 import asyncio
-import bz2
-import csv
-import io
 import json
 import logging
 import os
 from shared.ecs_service import run_ecs_task
-from typing import Any
+from collections import Counter
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable
 from botocore.exceptions import ClientError
 
 from datetime import datetime
@@ -15,14 +15,23 @@ from schema_transformation.cdm_mapping_rule import (
     MappingRules,
     get_mapping_rules_key,
 )
+from schema_transformation.mapping_plan import get_mapping_plan
+from schema_transformation.hash_index import (
+    HashIndexStore,
+    IncrementalRun,
+    get_hash_index,
+    get_index_name,
+    get_key_field,
+)
 from shared.metadata import CdmFileMetaData
 from shared.content_type import ContentType
 from shared.utils import (
     get_timestamp_string,
     get_target_s3_object_key,
-    is_date_string_valid,
+    is_chunk_object_key,
 )
 from shared.constants import (
+    DEFAULT_CDM_UPLOAD_WORKERS,
     MAXIMUM_FILE_SIZE_COMPRESSED,
     ISO8901_FORMAT,
     S3_CONNECTION_POOL_CONFIG,
@@ -30,6 +39,8 @@ from shared.constants import (
 import schema_transformation.cdm_mapper as cdm_mapper
 from shared.cdm_company import CdmCompany
 from shared.dynamodb import add_glue_job_task 
+from shared.s3_stream import CsvStreamSink, S3MultipartWriter, iter_source_rows
+from shared.config_cache import S3ObjectCache
 
 
 module_name = os.path.basename(__file__).split(".")[0]
@@ -38,6 +49,31 @@ if not logger.name:
     logger.name = module_name
 logger.setLevel(logging.INFO)
 
+# mapping rules parsed by earlier invocations of a warm container
+mapping_rules_cache = S3ObjectCache()
+
+
+class CdmOutput(Enum):
+    """
+    Objects written for each mapped chunk
+    csv: plain csv for the data bulk loader, aws_s3.table_import_from_s3
+    bz2: bz2 compressed csv for the glue data loader, a glue job task is added
+    """
+    CSV = "csv"
+    BZ2 = "bz2"
+
+
+def get_cdm_outputs(outputs: str | list[str] | None) -> tuple[CdmOutput, ...]:
+    """
+    Get the outputs to write, e.g. from "csv,bz2"
+    :param outputs: comma separated outputs or a list, both if empty
+    """
+    if not outputs:
+        return tuple(CdmOutput)
+    if isinstance(outputs, str):
+        outputs = outputs.split(",")
+    return tuple(CdmOutput(output.strip()) for output in outputs if output.strip())
+
 
 def process_with_ecs(
     object_key: str,
@@ -47,6 +83,7 @@ def process_with_ecs(
     aws_region: str,
     memory: int | None = None,
     chunk_size: int = cdm_mapper.DEFAULT_MAX_DATA_CHUNK_SIZE,
+    **kwargs,
 ) -> None:
     """
     Process file with ECS task
@@ -57,6 +94,9 @@ def process_with_ecs(
     :param aws_region: AWS region
     :param memory: Memory override
     :param chunk_size: Chunk size
+    :param kwargs: mapper_executor, mapper_workers, max_in_flight_chunks,
+        upload_workers, row_format, cdm_outputs, hash_index_store,
+        hash_index_location, hash_index_source
     """
     subnet_ids_string = os.getenv("PUBLIC_SUBNET_IDS")
     if not subnet_ids_string:
@@ -93,6 +133,24 @@ def process_with_ecs(
         "cdm_data_bucket": to_bucket,
         "region": aws_region,
     }
+    if kwargs.get("mapper_executor"):
+        payload.update({"mapper_executor": kwargs.get("mapper_executor")})
+    if kwargs.get("mapper_workers"):
+        payload.update({"mapper_workers": kwargs.get("mapper_workers")})
+    if kwargs.get("max_in_flight_chunks"):
+        payload.update({"max_in_flight_chunks": kwargs.get("max_in_flight_chunks")})
+    if kwargs.get("upload_workers"):
+        payload.update({"upload_workers": kwargs.get("upload_workers")})
+    if kwargs.get("row_format"):
+        payload.update({"row_format": kwargs.get("row_format")})
+    if kwargs.get("cdm_outputs"):
+        payload.update({"cdm_outputs": kwargs.get("cdm_outputs")})
+    if kwargs.get("hash_index_store"):
+        payload.update({"hash_index_store": kwargs.get("hash_index_store")})
+    if kwargs.get("hash_index_location"):
+        payload.update({"hash_index_location": kwargs.get("hash_index_location")})
+    if kwargs.get("hash_index_source"):
+        payload.update({"hash_index_source": kwargs.get("hash_index_source")})
 
     response = run_ecs_task(
         ecs_cluster=ecs_cluster,
@@ -144,6 +202,47 @@ def lambda_handler(event, context):
     else:
         chunk_size = int(chunk_size)
 
+    mapper_executor = cdm_mapper.MapperExecutor(
+        event.get("mapper_executor", os.getenv("mapper_executor"))
+        or cdm_mapper.MapperExecutor.THREAD
+    )
+    mapper_workers = event.get("mapper_workers", os.getenv("mapper_workers"))
+    mapper_workers = int(mapper_workers) if mapper_workers else None
+    max_in_flight_chunks = int(
+        event.get("max_in_flight_chunks", os.getenv("max_in_flight_chunks")) or 0
+    )
+    upload_workers = int(
+        event.get("upload_workers", os.getenv("upload_workers"))
+        or DEFAULT_CDM_UPLOAD_WORKERS
+    )
+    # a deployment can turn off the plain csv or the csv.bz2 of each chunk
+    cdm_outputs = get_cdm_outputs(event.get("cdm_outputs", os.getenv("cdm_outputs")))
+    if not cdm_outputs:
+        raise ValueError("cdm_outputs needs at least one of csv and bz2")
+    # unset, the mapper picks compact rows for the process executor
+    row_format = event.get("row_format", os.getenv("row_format"))
+    row_format = cdm_mapper.RowFormat(row_format) if row_format else None
+    # incremental mode, only rows changed since the previous run are mapped
+    hash_index_store = event.get("hash_index_store", os.getenv("hash_index_store"))
+    hash_index_store = HashIndexStore(hash_index_store) if hash_index_store else None
+    hash_index_location = event.get(
+        "hash_index_location", os.getenv("hash_index_location")
+    )
+    # stable name of the source file, for a prefix with several files per snapshot
+    hash_index_source = event.get("hash_index_source", os.getenv("hash_index_source"))
+    if hash_index_store == HashIndexStore.S3 and not hash_index_location:
+        hash_index_location = cdm_data_bucket
+    if hash_index_store and not hash_index_location:
+        raise ValueError("hash_index_location is required")
+    if hash_index_store and is_chunk_object_key(source_object_key):
+        # the rows of a chunk aren't the whole snapshot, the keys of the other
+        # chunks would be taken as removed, so map the chunk in full
+        logger.warning(
+            f"incremental mode needs the whole snapshot, {source_object_key} is a chunk, "
+            "mapping every row"
+        )
+        hash_index_store = None
+
     logger.info(
         f"Processing file: {source_object_key}, from bucket: {source_data_bucket}, chunk size: {chunk_size}"
     )
@@ -190,6 +289,15 @@ def lambda_handler(event, context):
                     aws_region=aws_region,
                     memory=os.getenv("ecs_container_memory_size"),
                     chunk_size=chunk_size,
+                    mapper_executor=mapper_executor.value,
+                    mapper_workers=mapper_workers,
+                    max_in_flight_chunks=max_in_flight_chunks,
+                    upload_workers=upload_workers,
+                    row_format=row_format.value if row_format else None,
+                    cdm_outputs=",".join(output.value for output in cdm_outputs),
+                    hash_index_store=hash_index_store.value if hash_index_store else None,
+                    hash_index_location=hash_index_location,
+                    hash_index_source=hash_index_source,
                 )
 
                 logger.info(f"Starting esc task for {source_object_key}")
@@ -225,28 +333,39 @@ def lambda_handler(event, context):
     if not jurisdiction:
         raise ValueError("meta data jurisdiction is required")
 
-    if source_content_type == ContentType.CSV:
-        if "ContentEncoding" in file_obj:
-            if file_obj.get("ContentEncoding") == "bzip2":
-                file_content = bz2.decompress(file_obj["Body"].read()).decode("utf-8")
-            elif file_obj.get("ContentEncoding") == "gzip":
-                logger.error("Gzip compression is not supported")
-            else:
-                logger.error("The only compression supported is bzip2")
-        else:
-            file_content = file_obj["Body"].read().decode("utf-8")
-
-        source_data = list(csv.DictReader(file_content.splitlines()))
-    elif source_content_type == ContentType.Json_lines:
-        file_content = file_obj["Body"].read().decode("utf-8")
-        source_data = [json.loads(line) for line in file_content.splitlines() if line]
-    else:
-        raise ValueError(f"supported content type: {source_content_type}")
+    # rows are read from the body as they are mapped, the object is never held
+    # as a whole, neither compressed nor as text or rows
+    source_data = iter_source_rows(
+        file_obj["Body"], source_content_type, file_obj.get("ContentEncoding")
+    )
 
     key = get_mapping_rules_key(jurisdiction, source_content_type)
-    mapping_rules_file = s3_client.get_object(Bucket=config_bucket, Key=key)
-    rules_dict = json.loads(mapping_rules_file["Body"].read().decode("utf-8"))
-    mapping_rules = MappingRules(**rules_dict)
+    mapping_rules = mapping_rules_cache.get(
+        s3_client,
+        config_bucket,
+        key,
+        lambda body: MappingRules(**json.loads(body.decode("utf-8"))),
+    )
+    # compile the rules now, invalid rules fail before the data is mapped
+    get_mapping_plan(mapping_rules)
+
+    incremental_run = None
+    if hash_index_store:
+        hash_index = get_hash_index(
+            hash_index_store,
+            index_name=get_index_name(
+                jurisdiction, source_object_key, hash_index_source
+            ),
+            location=hash_index_location,
+            s3_client=s3_client,
+            dynamodb=(
+                boto3.client("dynamodb", region_name=aws_region)
+                if hash_index_store == HashIndexStore.DYNAMODB
+                else None
+            ),
+        )
+        incremental_run = IncrementalRun(hash_index, get_key_field(mapping_rules))
+        source_data = incremental_run.filter(source_data)
 
     metadata.update(
         {
@@ -258,7 +377,10 @@ def lambda_handler(event, context):
     file_metadata = CdmFileMetaData(**metadata)
     # a jurisdiction can have multiple data sources
     # get prefix from source_object_filename
-    date_fields = cdm_mapper.get_date_fields(mapping_rules)
+    if is_lambda_runtime and mapper_executor == cdm_mapper.MapperExecutor.PROCESS:
+        # lambda has no /dev/shm for the semaphores of a process pool
+        logger.info("process mapper executor is not supported in lambda, using threads")
+        mapper_executor = cdm_mapper.MapperExecutor.THREAD
 
     try:
         loop = asyncio.get_running_loop()
@@ -276,8 +398,14 @@ def lambda_handler(event, context):
                 jurisdiction,
                 mapping_rules,
                 file_metadata,
-                date_fields,
                 chunk_size,
+                mapper_executor,
+                mapper_workers,
+                row_format,
+                incremental_run,
+                max_in_flight_chunks,
+                upload_workers,
+                cdm_outputs,
             )
         )
     else:
@@ -291,8 +419,14 @@ def lambda_handler(event, context):
                 jurisdiction,
                 mapping_rules,
                 file_metadata,
-                date_fields,
                 chunk_size,
+                mapper_executor,
+                mapper_workers,
+                row_format,
+                incremental_run,
+                max_in_flight_chunks,
+                upload_workers,
+                cdm_outputs,
             )
         )
 
@@ -307,54 +441,139 @@ async def create_cdm_model(
     target_bucket: str,
     source_obj_key: str,
     target_content_type: ContentType,
-    data: list[dict],
+    data: Iterable[dict],
     jurisdiction: str,
     mapping_rules: MappingRules,
     file_metadata: CdmFileMetaData,
-    date_fields: list[str],
     chunk_size: int,
+    mapper_executor: cdm_mapper.MapperExecutor = cdm_mapper.MapperExecutor.THREAD,
+    mapper_workers: int | None = None,
+    row_format: cdm_mapper.RowFormat | None = None,
+    incremental_run: IncrementalRun | None = None,
+    max_in_flight_chunks: int = 0,
+    upload_workers: int = DEFAULT_CDM_UPLOAD_WORKERS,
+    cdm_outputs: tuple[CdmOutput, ...] = tuple(CdmOutput),
 ):
     """
     Create CDM model and save the result to S3.
+    The chunks are mapped in a thread and put on a queue while upload workers
+    take them off and save them, the time of each stage is logged at the end.
 
     :param target_bucket: Target bucket
     :param source_obj_key: Source object key
     :param target_content_type: Target content type
-    :param data: Data to be transformed
+    :param data: Data to be transformed, rows are read as the chunks are mapped
     :param jurisdiction: Jurisdiction
     :param mapping_rules: Mapping rules
     :param file_metadata: File metadata
-    :param date_fields: Date fields
     :param chunk_size: Chunk size
+    :param mapper_executor: how chunks are mapped, thread, process or inline
+    :param mapper_workers: number of mapper threads or processes
+    :param row_format: dict records or compact tuples, compact rows take less
+        memory, so larger chunks fit in the same task size, by default compact
+        with the process executor
+    :param incremental_run: with an incremental run the data holds only the
+        changed rows, the removed keys are saved and the hash index is saved
+        once every chunk is written
+    :param max_in_flight_chunks: maximum number of chunks mapped but not yet
+        written, default 2 per mapper worker
+    :param upload_workers: number of chunks saved at the same time, also the
+        number of mapped chunks that can wait for a worker
+    :param cdm_outputs: objects written for each chunk, see CdmOutput
     """
+    if upload_workers < 1:
+        raise ValueError("upload_workers must be at least 1")
     prefix = source_obj_key.split("/")[0]
+    filename = os.path.basename(source_obj_key)
+    loop = asyncio.get_running_loop()
+    # chunks mapped and waiting for an upload worker
+    queue = asyncio.Queue(maxsize=upload_workers)
+    stage_seconds = Counter()
+    start = datetime.now()
 
-    tasks = []
-    for result_model, index in cdm_mapper.schema_transformation(
-        data, mapping_rules, file_metadata, CdmCompany, chunk_size
-    ):
-        logger.info(f"Processing index: {index}")
-        try:
-            task = asyncio.create_task(
-                process_result(
-                    target_bucket,
-                    s3_client,
-                    file_metadata,
-                    target_content_type,
-                    jurisdiction,
-                    prefix,
-                    date_fields,
-                    result_model,
-                    index=index,
-                    filename=os.path.basename(source_obj_key)
-                )
+    # chunks come split into valid and invalid records, checked while mapping
+    chunks = cdm_mapper.schema_transformation(
+        data,
+        mapping_rules,
+        file_metadata,
+        CdmCompany,
+        chunk_size,
+        executor=mapper_executor,
+        workers=mapper_workers,
+        partition=True,
+        row_format=row_format,
+        max_in_flight=max_in_flight_chunks,
+    )
+
+    async def map_chunks():
+        # the generator reads and maps the rows, run it in its own thread so the
+        # uploads go on in the meantime
+        with ThreadPoolExecutor(max_workers=1) as mapper:
+            while True:
+                stage_start = datetime.now()
+                item = await loop.run_in_executor(mapper, next, chunks, None)
+                stage_seconds["map"] += (datetime.now() - stage_start).total_seconds()
+                if item is None:
+                    break
+                logger.info(f"Processing index: {item[1]}")
+                stage_start = datetime.now()
+                await queue.put(item)
+                stage_seconds["wait for upload"] += (
+                    datetime.now() - stage_start
+                ).total_seconds()
+        for _ in range(upload_workers):
+            await queue.put(None)
+
+    async def upload_chunks():
+        while True:
+            stage_start = datetime.now()
+            item = await queue.get()
+            stage_seconds["wait for chunk"] += (
+                datetime.now() - stage_start
+            ).total_seconds()
+            if item is None:
+                break
+            result_chunk, index = item
+            stage_start = datetime.now()
+            await process_result(
+                target_bucket,
+                s3_client,
+                file_metadata,
+                target_content_type,
+                jurisdiction,
+                prefix,
+                result_chunk,
+                index=index,
+                filename=filename,
+                cdm_outputs=cdm_outputs,
             )
-            tasks.append(task)
-        except Exception as e:
-            logger.error(f"Error processing {source_obj_key}, index {index} error: {str(e)}")
+            stage_seconds["upload"] += (datetime.now() - stage_start).total_seconds()
+
+    tasks = [asyncio.create_task(map_chunks())]
+    tasks.extend(asyncio.create_task(upload_chunks()) for _ in range(upload_workers))
+    try:
+        await asyncio.gather(*tasks)
+    except Exception as e:
+        logger.error(f"Error processing {source_obj_key} error: {str(e)}")
+        for task in tasks:
+            task.cancel()
+        # the mapper thread finishes its chunk before the generator is closed
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        chunks.close()
+
+    # the upload times add up over the workers, the waits show which stage
+    # holds the other one back
+    logger.info(
+        f"Processed {source_obj_key} in {(datetime.now() - start).total_seconds()} seconds, "
+        + ", ".join(
+            f"{stage}: {seconds:.3f}" for stage, seconds in stage_seconds.items()
+        )
+    )
 
-        if tasks:
-            await asyncio.gather(*tasks)
+    if incremental_run:
+        incremental_run.commit()
 
 
 async def process_result(
@@ -364,14 +583,12 @@ async def process_result(
     source_content_type: ContentType,
     jurisdiction: str,
     prefix: str,
-    date_fields: list[str],
-    result_model: list[dict],
+    result_chunk: cdm_mapper.PartitionedChunk,
     index: int,
-    filename: str
+    filename: str,
+    cdm_outputs: tuple[CdmOutput, ...] = tuple(CdmOutput),
 ):
-    result_model_valid, result_model_invalid = await filter_result_model(
-        result_model, date_fields
-    )
+    result_model_valid, result_model_invalid, invalid_fields = result_chunk
     tasks = []
     if result_model_valid:
         logger.info(f"Valid data found for index: {index}: {len(result_model_valid)}")
@@ -386,7 +603,8 @@ async def process_result(
                 index,
                 result_model_valid,
                 target_table=f"stg_{jurisdiction}",
-                filename=filename
+                filename=filename,
+                cdm_outputs=cdm_outputs,
             )
         )
     else:
@@ -394,7 +612,8 @@ async def process_result(
 
     if result_model_invalid:
         logger.info(
-            f"Invalid data found for index: {index}: {len(result_model_invalid)}"
+            f"Invalid data found for index: {index}: {len(result_model_invalid)}, "
+            f"fields: {dict(Counter(invalid_fields))}"
         )
         tasks.append(
             save_result_model_async(
@@ -408,7 +627,8 @@ async def process_result(
                 result_model_invalid,
                 target_table=f"stg_{jurisdiction}_invalid",
                 suffix="invalid",
-                filename=filename
+                filename=filename,
+                cdm_outputs=cdm_outputs,
             )
         )
     else:
@@ -428,6 +648,7 @@ async def save_result_model_async(
     target_table: str,
     suffix: str | None = None,
     filename: str = None,
+    cdm_outputs: tuple[CdmOutput, ...] = tuple(CdmOutput),
 ):
     """
     asnyc wrapper for save_result_model
@@ -446,7 +667,8 @@ async def save_result_model_async(
         model,
         target_table,
         suffix,
-        filename
+        filename,
+        cdm_outputs,
     )
 
 
@@ -462,6 +684,7 @@ def save_result_model(
     target_table: str,
     suffix: str | None = None,
     filename: str = None,
+    cdm_outputs: tuple[CdmOutput, ...] = tuple(CdmOutput),
 ):
     """
     save result model
@@ -474,6 +697,7 @@ def save_result_model(
     :param index: Index
     :param model: Model
     :param suffix: Suffix
+    :param cdm_outputs: objects written, see CdmOutput
     """
     if not target_table:
         raise ValueError("target_table is required")
@@ -496,23 +720,33 @@ def save_result_model(
         metadata.update(
             {"target": f"{target_table}", "jurisdiction": jurisdiction}
         )
+        fieldnames = None
+        if isinstance(model[0], tuple):
+            # compact rows, see cdm_mapper.RowFormat
+            fieldnames = cdm_mapper.get_row_fields(file_metadata, CdmCompany)
         file_arn = save_csv(
             model,
             metadata,
             target_bucket,
             cdm_file_key,
             s3_client,
+            fieldnames,
+            cdm_outputs,
         )
         del model
-        try:
-            add_glue_job_task(
-                target_bucket,
-                os.path.dirname(cdm_file_key), # only need the prefix for glue job
-                file_size=-1,
-                target_table=target_table
-            )
-        except ClientError as e:
-            logger.error(f"Failed to add glue job task {str(e)}")
+        if CdmOutput.BZ2 not in cdm_outputs:
+            # the glue data loader only reads the csv.bz2 objects
+            logger.info(f"No glue job task added for {cdm_file_key}, bz2 output is off")
+        else:
+            try:
+                add_glue_job_task(
+                    target_bucket,
+                    os.path.dirname(cdm_file_key), # only need the prefix for glue job
+                    file_size=-1,
+                    target_table=target_table
+                )
+            except ClientError as e:
+                logger.error(f"Failed to add glue job task {str(e)}")
 
         if file_arn:
             logger.info(f"processed {file_arn} successfully")
@@ -521,47 +755,6 @@ def save_result_model(
             raise ValueError("Error processing file")
 
 
-async def filter_result_model(
-    result_model, date_fields
-) -> tuple[list[dict], list[dict]]:
-    """
-    Filter result model to valid and invalid data based on date fields
-    :param result_model: Result model
-    :param date_fields: Date fields
-    :return: Tuple of valid and invalid data
-    """
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(
-        None,
-        lambda: (
-            [
-                row
-                for row in result_model
-                if all(
-                    is_date_string_valid(
-                        row[date_field],
-                        format_name="python_date_format",
-                        no_data_ok=True,
-                    )
-                    for date_field in date_fields
-                )
-            ],
-            [
-                row
-                for row in result_model
-                if not all(
-                    is_date_string_valid(
-                        row[date_field],
-                        format_name="python_date_format",
-                        no_data_ok=True,
-                    )
-                    for date_field in date_fields
-                )
-            ],
-        ),
-    )
-
-
 def serialize_json(row: dict, key: str) -> str:
     """
     Serialize JSON
@@ -573,65 +766,70 @@ def serialize_json(row: dict, key: str) -> str:
 
 
 def save_csv(
-    model: list[dict],
+    model: list[dict] | list[tuple],
     metadata: dict[str, Any],
     cdm_data_bucket: str,
     object_key: str,
     s3_client: boto3.client,
+    fieldnames: tuple[str, ...] | None = None,
+    cdm_outputs: tuple[CdmOutput, ...] = tuple(CdmOutput),
 ) -> str:
     """
-    Save the model to S3 as CSV
+    Save the model to S3 as CSV, and as compressed csv.bz2 with the same rows.
+    Rows are streamed to multipart uploads, so the full csv is never held in memory.
+    Each block of rows is encoded once, the two objects are compressed and
+    uploaded at the same time in their own threads.
     :param file_metadata: dict
     :param cdm_data_bucket: CDM data bucket
-    :param model: model
-    :return: file ARN
+    :param model: model, dicts or compact rows already in csv form
+    :param fieldnames: header of compact rows, see cdm_mapper.get_row_fields
+    :param cdm_outputs: objects written, see CdmOutput
+    :return: file ARN, of the csv.bz2 object without the csv output
     """
+    if not cdm_outputs:
+        raise ValueError("cdm_outputs needs at least one of csv and bz2")
     start = datetime.now()
-    csv_buffer = io.StringIO()
-    fieldnames = model[0].keys()
-    writer = csv.DictWriter(csv_buffer, fieldnames=fieldnames)
-    writer.writeheader()
-    for row in model:
-        for key in row:
-            if isinstance(row[key], datetime):
-                row[key] = row[key].strftime(ISO8901_FORMAT)
-            if isinstance(row[key], dict):
-                try:
-                    row[key] = serialize_json(row, key)
-                except TypeError:
-                    row[key] = str(row[key])
-        writer.writerow(row)
-
-    # create csv file for data bulk loader
-    csv_buffer.seek(0)
-    s3_client.put_object(
-        Bucket=cdm_data_bucket,
-        Key=object_key,
-        Body=csv_buffer.getvalue().encode("utf-8"),
-        Metadata=metadata,
-        ContentType=ContentType.CSV.value,
-    )
-    check_time = datetime.now()
-    logger.info(
-        f"File {object_key} saved in {(check_time - start).total_seconds()} seconds"
-    )
+    object_keys = []
+    writers = []
+    if CdmOutput.CSV in cdm_outputs:
+        # csv file for data bulk loader
+        object_keys.append(object_key)
+        writers.append(
+            S3MultipartWriter(s3_client, cdm_data_bucket, object_key, metadata=metadata)
+        )
+    if CdmOutput.BZ2 in cdm_outputs:
+        # compressed csv.bz2 file for glue data loader
+        object_keys.append(f"{object_key}.bz2")
+        writers.append(
+            S3MultipartWriter(
+                s3_client,
+                cdm_data_bucket,
+                f"{object_key}.bz2",
+                metadata=metadata,
+                compress=True,
+            )
+        )
+    concurrent = len(writers) > 1
+    if fieldnames:
+        with CsvStreamSink(writers, concurrent=concurrent) as sink:
+            sink.writerow(fieldnames)
+            sink.writerows(model)
+    else:
+        with CsvStreamSink(
+            writers, fieldnames=model[0].keys(), concurrent=concurrent
+        ) as sink:
+            for row in model:
+                for key in row:
+                    if isinstance(row[key], datetime):
+                        row[key] = row[key].strftime(ISO8901_FORMAT)
+                    if isinstance(row[key], dict):
+                        try:
+                            row[key] = serialize_json(row, key)
+                        except TypeError:
+                            row[key] = str(row[key])
+                sink.writerow(row)
 
-    # create compressed csv.bz2 file for glue data loader
-    csv_buffer.seek(0)
-    target_object_key = f"{object_key}.bz2"
-    body = bz2.compress(csv_buffer.getvalue().encode("utf-8"))
-    s3_client.put_object(
-        Bucket=cdm_data_bucket,
-        Key=target_object_key,
-        Body=body,
-        Metadata=metadata,
-        ContentType=ContentType.CSV.value,
-        ContentEncoding="bzip2",
-    )
-    logger.info(
-        f"File {target_object_key} saved in {(datetime.now() - check_time).total_seconds()} seconds"
-    )
     logger.info(
-        f"total save_csv time: {(datetime.now() - start).total_seconds()} seconds"
+        f"Files {' and '.join(object_keys)} saved in {(datetime.now() - start).total_seconds()} seconds"
     )
-    return f"{cdm_data_bucket}/{object_key}"
+    return f"{cdm_data_bucket}/{object_keys[0]}"
@@ -1,82 +1,522 @@
+import bz2
+import codecs
 import csv
 import logging
+import multiprocessing
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from functools import lru_cache
 from io import StringIO
-from shared.utils import hash
-from shared.constants import DEFAULT_DATA_CHUNK_SIZE
-from typing import Generator
+from itertools import islice
+from operator import itemgetter
+from shared.hashing import HashAlgorithm, hash_many
+from shared.constants import DEFAULT_DATA_CHUNK_SIZE, STREAM_READ_BLOCK_SIZE
+from typing import BinaryIO, Callable, Generator, Iterable, Iterator
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+class ParserBackend(Enum):
+    """
+    python: cut each line with the compiled field extractor
+    bytes:  split and clean raw utf-8 records as bytes, only decode the cleaned
+            ascii record, falls back to python for non-ascii records
+    """
+    PYTHON = "python"
+    BYTES = "bytes"
+
+
+# bytes removed from a record by normalize_string, as a single translate pass
+RECORD_DELETE_BYTES = b'"\x00'
+# utf-8 encoded line boundaries of str.splitlines that bytes.splitlines doesn't split on
+EXTRA_LINE_BREAKS = (
+    b"\x0b",
+    b"\x0c",
+    b"\x1c",
+    b"\x1d",
+    b"\x1e",
+    b"\xc2\x85",
+    b"\xe2\x80\xa8",
+    b"\xe2\x80\xa9",
+)
+LINE_BREAK_PATTERN = re.compile(
+    rb"\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]"
+)
+
+
 def normalize_string(content):
     return content.replace('"', "").replace("\r\n", "\n").replace("\x00", "")
 
 
+def get_field_names(mapping: dict[str, any], add_hash: bool = True) -> list[str]:
+    """
+    Get the csv header from the field definition
+    :param mapping: The mapping dict
+    :param add_hash: Add a hash column to the header
+    """
+    field_names = [field["name"] for field in mapping["fields"]]
+    if add_hash:
+        field_names.append("hash")
+    return field_names
+
+
+@lru_cache(maxsize=32)
+def compile_field_extractor(
+    definition_key: tuple[str, str], field_positions: tuple[tuple[int, int], ...]
+) -> Callable[[str], list[str]]:
+    """
+    Compile the field positions into a function that cuts a line into stripped field values.
+    The slicing is done by a single itemgetter call, so there is no per field python loop.
+    Compiled extractors are cached by the definition file name, version and positions.
+    :param definition_key: (file_name, version) of the field definition
+    :param field_positions: tuple of (start, end) slice positions, 0 based
+    """
+    logger.debug(f"Compiling field extractor for {definition_key}")
+    getter = itemgetter(*[slice(start, end) for start, end in field_positions])
+    strip = str.strip
+    if len(field_positions) == 1:
+        # itemgetter with one item returns the value rather than a tuple
+        return lambda line: [strip(getter(line))]
+    return lambda line: list(map(strip, getter(line)))
+
+
+def get_definition_key(mapping: dict[str, any]) -> tuple[str, str]:
+    """
+    Get the (file_name, version) of a fixed width field definition
+    :param mapping: The mapping dict
+    """
+    meta_data = mapping.get("meta_data") or {}
+    return str(meta_data.get("file_name")), str(meta_data.get("version"))
+
+
+def get_field_positions(mapping: dict[str, any]) -> tuple[tuple[int, int], ...]:
+    """
+    Get the 0 based (start, end) slice positions of the fields
+    :param mapping: The mapping dict
+    """
+    return tuple((field["start"] - 1, field["end"]) for field in mapping["fields"])
+
+
+def get_field_extractor(mapping: dict[str, any]) -> Callable[[str], list[str]]:
+    """
+    Get the compiled field extractor for a fixed width field definition
+    :param mapping: The mapping dict
+    """
+    return compile_field_extractor(
+        get_definition_key(mapping), get_field_positions(mapping)
+    )
+
+
+def extract_rows_bytes(
+    records: Iterable[bytes | str], mapping: dict[str, any]
+) -> Generator[list[str], None, None]:
+    """
+    Cut raw utf-8 records into rows. For an ascii record quotes and NULs are removed
+    with one translate pass and the cleaned record is decoded as ascii, one byte is
+    one character so the field positions are the same as in the decoded line.
+    Other records are decoded and go through normalize_string, invalid bytes are
+    replaced as in the python backend.
+    :param records: The fixed width records, without line endings
+    :param mapping: The mapping dict
+    """
+    extract = get_field_extractor(mapping)
+    for record in records:
+        if isinstance(record, str):
+            yield extract(normalize_string(record))
+        elif record.isascii():
+            yield extract(record.translate(None, RECORD_DELETE_BYTES).decode("ascii"))
+        else:
+            yield extract(normalize_string(record.decode("utf-8", errors="replace")))
+
+
+def extract_rows(
+    lines: Iterable[str],
+    mapping: dict[str, any],
+    backend: ParserBackend = ParserBackend.PYTHON,
+) -> Iterable[list[str] | tuple[str, ...]]:
+    """
+    Cut fixed width lines into rows of stripped field values
+    :param lines: The fixed width lines, without line endings,
+                  raw bytes records are accepted by the bytes backend
+    :param mapping: The mapping dict
+    :param backend: The parser backend
+    """
+    backend = ParserBackend(backend)
+    if backend == ParserBackend.BYTES:
+        return extract_rows_bytes(lines, mapping)
+    extract = get_field_extractor(mapping)
+    return (extract(normalize_string(line)) for line in lines)
+
+
+def iter_rows(
+    lines: Iterable[str],
+    mapping: dict[str, any],
+    add_hash: bool = True,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> Iterator[list[str] | tuple[str, ...]]:
+    """
+    Cut fixed width lines into csv rows, without the header
+    :param lines: The fixed width lines, without line endings
+    :param mapping: The mapping dict
+    :param add_hash: Add a hash column to the rows
+    :param backend: The parser backend
+    :param hash_algorithm: The algorithm of the hash column
+    """
+    if not add_hash:
+        return iter(extract_rows(lines, mapping, backend))
+    hash_algorithm = HashAlgorithm(hash_algorithm)
+    if hash_algorithm.hashes_record:
+        lines = lines if isinstance(lines, list) else list(lines)
+        rows = extract_rows(lines, mapping, backend)
+        hashes = hash_many(lines, hash_algorithm)
+    else:
+        rows = list(extract_rows(lines, mapping, backend))
+        hashes = hash_many(rows, hash_algorithm)
+    return ((*row, row_hash) for row, row_hash in zip(rows, hashes))
+
+
+def write_csv(
+    lines: Iterable[str],
+    mapping: dict[str, any],
+    add_hash: bool = True,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> StringIO:
+    """
+    Convert fixed width lines to a csv StringIO object, the header is always written
+    :param lines: The fixed width lines, without line endings
+    :param mapping: The mapping dict
+    :param add_hash: Add a hash column to the output
+    :param backend: The parser backend
+    :param hash_algorithm: The algorithm of the hash column
+    """
+    csv_data = StringIO()
+    csv_writer = csv.writer(csv_data)
+    csv_writer.writerow(get_field_names(mapping, add_hash))
+    csv_writer.writerows(
+        iter_rows(lines, mapping, add_hash, backend, hash_algorithm)
+    )
+    csv_data.seek(0)
+    return csv_data
+
+
+def compress_csv(
+    lines: list[str] | list[bytes],
+    mapping: dict[str, any],
+    add_hash: bool = True,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> bytes:
+    """
+    Convert fixed width lines to bz2 compressed utf-8 csv, runs in the pool workers
+    :param lines: The fixed width lines, without line endings
+    :param mapping: The mapping dict
+    :param add_hash: Add a hash column to the output
+    :param backend: The parser backend
+    :param hash_algorithm: The algorithm of the hash column
+    """
+    csv_data = write_csv(lines, mapping, add_hash, backend, hash_algorithm)
+    return bz2.compress(csv_data.getvalue().encode("utf-8"))
+
+
+def write_chunks(
+    chunks: Iterable[list[str] | list[bytes]],
+    mapping: dict[str, any],
+    add_hash: bool = True,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    workers: int = 0,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> Generator[tuple[StringIO | bytes, int], None, None]:
+    """
+    Convert chunks of fixed width lines to csv, yielding the output and the chunk index.
+    Without workers every chunk is a csv StringIO object written in this process.
+    With workers > 0 chunks are parsed and bz2 compressed in a process pool and the
+    compressed bytes are yielded, still in chunk order. At most two chunks per worker
+    are in flight, so the input is read no faster than the workers can parse it.
+    Process pools need /dev/shm, which lambda doesn't have, so only use it in ECS.
+    :param chunks: Lists of fixed width lines
+    :param mapping: The mapping dict
+    :param add_hash: Add a hash column to the output
+    :param backend: The parser backend
+    :param workers: Number of worker processes, 0 to parse in this process
+    :param hash_algorithm: The algorithm of the hash column
+    """
+    if workers and workers > 0:
+        write_chunk = compress_csv
+    else:
+        write_chunk = write_csv
+
+    if not workers or workers <= 0:
+        for index, chunk in enumerate(chunks):
+            yield write_chunk(chunk, mapping, add_hash, backend, hash_algorithm), index
+        return
+
+    max_in_flight = workers * 2
+    # boto3 starts threads, forking a threaded process can deadlock
+    mp_context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        in_flight = deque()
+        for index, chunk in enumerate(chunks):
+            in_flight.append(
+                (
+                    executor.submit(
+                        write_chunk, chunk, mapping, add_hash, backend, hash_algorithm
+                    ),
+                    index,
+                )
+            )
+            if len(in_flight) >= max_in_flight:
+                future, done_index = in_flight.popleft()
+                yield future.result(), done_index
+        while in_flight:
+            future, done_index = in_flight.popleft()
+            yield future.result(), done_index
+
+
+def batch_lines(
+    lines: Iterable[str], chunk_size: int
+) -> Generator[list[str], None, None]:
+    """
+    Lazily group lines into lists of chunk_size lines, the last one may be shorter
+    """
+    if chunk_size <= 0:
+        raise ValueError(f"chunk_size must be a positive number, got {chunk_size}")
+    iterator = iter(lines)
+    while chunk := list(islice(iterator, chunk_size)):
+        yield chunk
+
+
+def iter_lines(
+    stream: BinaryIO,
+    encoding: str = "utf-8",
+    block_size: int = STREAM_READ_BLOCK_SIZE,
+) -> Iterator[str]:
+    """
+    Read a binary stream (e.g. the S3 StreamingBody) block by block and yield decoded
+    lines without line endings. Lines are split the same way as str.splitlines so the
+    result is the same as decoding the whole file and splitting it in one go.
+    :param stream: Binary stream with a read(size) method
+    :param encoding: Text encoding, undecodable bytes are replaced
+    :param block_size: Number of bytes to read at a time
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    pending = ""
+    while True:
+        block = stream.read(block_size)
+        text = pending + decoder.decode(block, final=not block)
+        if not block:
+            yield from text.splitlines()
+            return
+        lines = text.splitlines(keepends=True)
+        # the last line may continue in the next block, or it may end with the "\r"
+        # of a "\r\n" pair split across blocks, so always carry it over
+        pending = lines.pop() if lines else ""
+        for line in lines:
+            yield line[:-2] if line.endswith("\r\n") else line[:-1]
+
+
+def split_records(data: bytes) -> list[bytes]:
+    """
+    Split utf-8 encoded data into records without line endings, on the same boundaries
+    as str.splitlines on the decoded data. bytes.splitlines only knows "\\n" and "\\r",
+    the slower regex split is only used when the data has one of the other breaks.
+    :param data: utf-8 encoded data
+    """
+    if not any(line_break in data for line_break in EXTRA_LINE_BREAKS):
+        return data.splitlines()
+    records = LINE_BREAK_PATTERN.split(data)
+    if records[-1] == b"":
+        records.pop()
+    return records
+
+
+def iter_records(
+    stream: BinaryIO, block_size: int = STREAM_READ_BLOCK_SIZE
+) -> Iterator[bytes]:
+    """
+    Read a binary stream block by block and yield raw records without line endings,
+    split on the same boundaries as iter_lines but without decoding the stream.
+    :param stream: Binary stream with a read(size) method
+    :param block_size: Number of bytes to read at a time
+    """
+    pending = b""
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            yield from split_records(pending)
+            return
+        data = pending + block
+        # a "\n", or a "\r" that isn't the last byte, always ends a record, anything
+        # after it may continue in the next block so it is carried over
+        cut = max(data.rfind(b"\n"), data.rfind(b"\r", 0, len(data) - 1)) + 1
+        yield from split_records(data[:cut])
+        pending = data[cut:]
+
+
+def get_stream_backend(backend: ParserBackend, encoding: str) -> ParserBackend:
+    """
+    Get the backend to parse a stream with, the bytes backend only reads utf-8
+    :param backend: The requested parser backend
+    :param encoding: Text encoding of the stream
+    """
+    backend = ParserBackend(backend)
+    if backend == ParserBackend.BYTES and codecs.lookup(encoding).name != "utf-8":
+        logger.warning(f"bytes backend needs utf-8, using python backend for {encoding}")
+        return ParserBackend.PYTHON
+    return backend
+
+
+def read_lines(
+    stream: BinaryIO,
+    backend: ParserBackend,
+    encoding: str = "utf-8",
+    block_size: int = STREAM_READ_BLOCK_SIZE,
+) -> Iterator[str] | Iterator[bytes]:
+    """
+    Read the lines of a stream in the form the backend parses, raw records for the
+    bytes backend and decoded lines otherwise
+    :param stream: Binary stream with a read(size) method
+    :param backend: The parser backend, see get_stream_backend
+    :param encoding: Text encoding of the stream
+    :param block_size: Number of bytes to read at a time
+    """
+    if backend == ParserBackend.BYTES:
+        return iter_records(stream, block_size=block_size)
+    return iter_lines(stream, encoding=encoding, block_size=block_size)
+
+
+def parse_stream_rows(
+    stream: BinaryIO,
+    mapping: dict[str, any],
+    add_hash: bool = True,
+    encoding: str = "utf-8",
+    block_size: int = STREAM_READ_BLOCK_SIZE,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> Generator[list[str] | tuple[str, ...], None, None]:
+    """
+    Parse a fixed width file from a binary stream into csv rows, the header first.
+    Nothing but the current block is held in memory, use it with a streaming writer.
+    :param stream: Binary stream, e.g. file_obj["Body"] from s3 get_object
+    :param mapping: The mapping dict
+    :param add_hash: Add a hash column to the output
+    :param encoding: Text encoding of the stream
+    :param block_size: Number of bytes to read from the stream at a time
+    :param backend: The parser backend
+    :param hash_algorithm: The algorithm of the hash column
+    """
+    backend = get_stream_backend(backend, encoding)
+    yield get_field_names(mapping, add_hash)
+    # the rows are hashed a chunk at a time
+    lines = read_lines(stream, backend, encoding, block_size)
+    for chunk in batch_lines(lines, DEFAULT_DATA_CHUNK_SIZE):
+        yield from iter_rows(chunk, mapping, add_hash, backend, hash_algorithm)
+
+
+def parse_stream(
+    stream: BinaryIO,
+    mapping: dict[str, any],
+    add_hash: bool = True,
+    chunk_size: int = DEFAULT_DATA_CHUNK_SIZE,
+    encoding: str = "utf-8",
+    block_size: int = STREAM_READ_BLOCK_SIZE,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    workers: int = 0,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> Generator[tuple[StringIO | bytes, int], None, None]:
+    """
+    Parse a fixed width file from a binary stream without reading the whole file into memory.
+    The stream is read incrementally and a csv StringIO object is yielded every chunk_size lines,
+    together with the index of the chunk. Yields the same chunks as parse_chunks.
+    With workers the chunks are bz2 compressed bytes instead, see write_chunks.
+    :param stream: Binary stream, e.g. file_obj["Body"] from s3 get_object
+    :param mapping: The mapping dict
+    :param add_hash: Add a hash column to the output
+    :param chunk_size: Number of lines per chunk
+    :param encoding: Text encoding of the stream
+    :param block_size: Number of bytes to read from the stream at a time
+    :param backend: The parser backend
+    :param workers: Number of worker processes, 0 to parse in this process
+    :param hash_algorithm: The algorithm of the hash column
+    """
+    backend = get_stream_backend(backend, encoding)
+    lines = read_lines(stream, backend, encoding, block_size)
+    yield from write_chunks(
+        batch_lines(lines, chunk_size),
+        mapping,
+        add_hash,
+        backend,
+        workers,
+        hash_algorithm,
+    )
+
+
 def parse_chunks(
     input: StringIO,
     mapping: dict[str, any],
     add_hash: bool = True,
     chunk_size: int = DEFAULT_DATA_CHUNK_SIZE,
-) -> Generator[tuple[StringIO, int], None, None]:
+    backend: ParserBackend = ParserBackend.PYTHON,
+    workers: int = 0,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> Generator[tuple[StringIO | bytes, int], None, None]:
     """
     # Parse a fixed width file using a mapping file, chunk it to the chunk size 
-    # and return a csv StringIO object and the index of the chunk
+    # and return a csv StringIO object and the index of the chunk,
+    # with workers > 0 the chunks are parsed in a process pool and
+    # returned as bz2 compressed bytes
     """
-    fields = mapping["fields"]
-    field_names = [field["name"] for field in fields]
-    field_positions = [(field["start"] - 1, field["end"]) for field in fields]
     data = input.getvalue().splitlines()
-
-    # Iterate over the data and chunk it, get the index of the chunk
-    chunks = [
-        data[i : i + chunk_size] for i in range(0, len(data), chunk_size)
-    ]
-
-    for index, chunk in enumerate(chunks):
-        csv_data = StringIO()
-        csv_writer = csv.writer(csv_data)
-        if add_hash:
-            csv_writer.writerow(field_names + ["hash"])
-        else:
-            csv_writer.writerow(field_names)
-        for line in chunk:
-            line = normalize_string(line)
-            row = [line[start:end].strip() for start, end in field_positions]
-            if add_hash:
-                row_hash = hash(tuple(row))
-                row.append(row_hash)
-            csv_writer.writerow(row)
-        csv_data.seek(0)
-        yield csv_data, index
+    yield from write_chunks(
+        batch_lines(data, chunk_size),
+        mapping,
+        add_hash,
+        backend,
+        workers,
+        hash_algorithm,
+    )
 
 
-def parse(input: StringIO, mapping: dict[str, any], add_hash: bool = True) -> StringIO:
+def parse(
+    input: StringIO,
+    mapping: dict[str, any],
+    add_hash: bool = True,
+    backend: ParserBackend = ParserBackend.PYTHON,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> StringIO:
     """
     Parse a fixed width file using a mapping file and return a csv StringIO object
     :param input_file: The input fixed width file
     :param mapping: The mapping dict
     :param add_hash: Add a hash column to the output
+    :param backend: The parser backend
+    :param hash_algorithm: The algorithm of the hash column
     """
+    return write_csv(
+        input.getvalue().splitlines(), mapping, add_hash, backend, hash_algorithm
+    )
 
-    csv_data = StringIO()
-    fields = mapping["fields"]
-    field_names = [field["name"] for field in fields]
-    field_positions = [(field["start"] - 1, field["end"]) for field in fields]
 
-    data = input.getvalue().splitlines()
-    csv_writer = csv.writer(csv_data)
-    if add_hash:
-        csv_writer.writerow(field_names + ["hash"])
-    else:
-        csv_writer.writerow(field_names)
-    for line in data:
-        line = normalize_string(line)
-        row = [line[start:end].strip() for start, end in field_positions]
-        if add_hash:
-            row_hash = hash(tuple(row))
-            row.append(row_hash)
-        csv_writer.writerow(row)
-    csv_data.seek(0)
-    return csv_data
+
+def parse_bytes(
+    content: bytes,
+    mapping: dict[str, any],
+    add_hash: bool = True,
+    hash_algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> StringIO:
+    """
+    Parse raw utf-8 fixed width content with the bytes backend and return a csv StringIO
+    object, the same csv as parse on the decoded content
+    :param content: The raw fixed width file content
+    :param mapping: The mapping dict
+    :param add_hash: Add a hash column to the output
+    :param hash_algorithm: The algorithm of the hash column
+    """
+    return write_csv(
+        split_records(content), mapping, add_hash, ParserBackend.BYTES, hash_algorithm
+    )
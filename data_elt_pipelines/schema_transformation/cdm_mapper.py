@@ -1,24 +1,100 @@
 # given the input as a csv stream (StringIO), and a mapping file as dictionary,
 # this function will return a csv string (StringIO) based on the mapping file
 
-import re
+import copy
+import json
 import logging
+import marshal
+import multiprocessing
+import os
+import pickle
+from collections import deque
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Any, Tuple, Generator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from enum import Enum
+from functools import partial
+from itertools import islice
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Any,
+    Tuple,
+    Generator,
+    Iterable,
+    Mapping,
+    Sequence,
+)
 from schema_transformation.cdm_mapping_rule import (
     MappingRule,
     MappingRules,
     Strategy,
     ValueType,
 )
+from schema_transformation.mapping_plan import (
+    ColumnBinding,
+    LiteralValues,
+    MappingPlan,
+    ResolvedLiterals,
+    get_mapping_plan,
+)
 from shared.cdm_company import CdmCompany, OrderedEnum
 from shared.metadata import CdmFileMetaData
-from shared.constants import DEFAULT_MAX_DATA_CHUNK_SIZE
+from shared.constants import DEFAULT_MAX_DATA_CHUNK_SIZE, ISO8901_FORMAT
+from shared.utils import DateValue, is_date_string_valid, parse_date
 
 logger = logging.getLogger()
 
 
+class MapperExecutor(Enum):
+    """
+    thread:  chunks are mapped in a thread pool, the mapper is pure python so
+             this uses about one core
+    process: chunks are mapped in a process pool, the rules are compiled once
+             per worker and the mapped chunks are sent back serialised
+    inline:  chunks are mapped one after the other in the calling thread
+    """
+    THREAD = "thread"
+    PROCESS = "process"
+    INLINE = "inline"
+
+
+class RowFormat(Enum):
+    """
+    dict:    a mapped record is a dict with nested dicts, as the mapper builds it
+    compact: a mapped record is a tuple in the column order of get_row_fields,
+             with the values as they are written to csv, nested values are
+             json strings, see to_compact_row. About a third of the memory of
+             a dict record.
+    """
+    DICT = "dict"
+    COMPACT = "compact"
+
+
+class ChunkOrder(Enum):
+    """
+    completed: mapped chunks are yielded as they complete, a slow chunk doesn't
+               hold back the ones after it
+    index:     mapped chunks are yielded in the order of the source rows, the
+               chunks after a slow chunk wait for it
+    """
+    COMPLETED = "completed"
+    INDEX = "index"
+
+
+# valid rows, invalid rows and the first date field that failed for each invalid row
+PartitionedChunk = Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[str]]
+
+# mapping rules compiled by init_mapper_worker, one per worker process
+_worker_context: dict[str, Any] = {}
+
+
 def is_metadata_set(
     cdm_model: Dict[str, Any],
     metadata: CdmFileMetaData | None = None,
@@ -75,49 +151,457 @@ def do_transform(
     """
     map the source_data to the CDM model, return the CDM model in csv format
     """
+    return map_rows(
+        source_data, get_mapping_plan(mapping_rules), meta_data, cdm_model_def
+    )
+
+
+def map_rows(
+    source_data: list[Dict[str, Any]],
+    plan: MappingPlan,
+    meta_data: CdmFileMetaData,
+    cdm_model_def: CdmCompany = CdmCompany,
+    row_format: RowFormat = RowFormat.DICT,
+) -> List[Dict[str, Any]] | List[Tuple]:
+    """
+    map the source_data to the CDM model with compiled mapping rules
+    :param row_format: dict records or compact tuples, see RowFormat
+    """
     start = datetime.now()
-    cdm_model = []
+    rows = iter_mapped_rows(source_data, plan, meta_data, cdm_model_def)
+    if row_format == RowFormat.COMPACT:
+        fields = get_row_fields(meta_data, cdm_model_def)
+        rows = (to_compact_row(record, fields) for record in rows)
+    cdm_model = list(rows)
+    logger.info(f"time taken: {(datetime.now() - start).total_seconds()}")
+    return cdm_model
+
+
+def map_rows_partitioned(
+    source_data: list[Dict[str, Any]],
+    plan: MappingPlan,
+    meta_data: CdmFileMetaData,
+    cdm_model_def: CdmCompany = CdmCompany,
+    no_data_ok: bool = True,
+    row_format: RowFormat = RowFormat.DICT,
+) -> PartitionedChunk:
+    """
+    map the source_data to the CDM model and split the records into valid and
+    invalid ones while they are mapped, a record is invalid when one of its
+    date fields doesn't parse, see get_invalid_date_field
+    :param no_data_ok: a date field without a value is valid
+    :param row_format: dict records or compact tuples, see RowFormat
+    :return: valid records, invalid records and the failed field of each
+    """
+    start = datetime.now()
+    valid, invalid, invalid_fields = [], [], []
+    date_fields = plan.date_fields
+    compact = row_format == RowFormat.COMPACT
+    if compact:
+        fields = get_row_fields(meta_data, cdm_model_def)
+    for record in iter_mapped_rows(source_data, plan, meta_data, cdm_model_def):
+        field = get_invalid_date_field(record, date_fields, no_data_ok)
+        if compact:
+            # after the check, the dates lose their validity in json
+            record = to_compact_row(record, fields)
+        if field is None:
+            valid.append(record)
+        else:
+            invalid.append(record)
+            invalid_fields.append(field)
+    logger.info(f"time taken: {(datetime.now() - start).total_seconds()}")
+    return valid, invalid, invalid_fields
+
+
+def iter_mapped_rows(
+    source_data: list[Dict[str, Any]],
+    plan: MappingPlan,
+    meta_data: CdmFileMetaData,
+    cdm_model_def: CdmCompany = CdmCompany,
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    map the rows one by one, see map_rows
+    """
+    header = None
+    new_record = get_cdm_template(meta_data, cdm_model_def)
+    model_keys = tuple(new_record())
 
     for source_row in source_data:
-        copy_of_mapping_rules = mapping_rules.rules.copy()
-        row_data = get_dummy_cdm_model(meta_data, cdm_model_def)
-        apply_cdm_model(source_row, row_data, copy_of_mapping_rules)
-        if not is_metadata_set(row_data, meta_data):
-            set_metadata(row_data, meta_data)
-        cdm_model.append(row_data)
-
-        del copy_of_mapping_rules
-        del source_row
+        # rows of a file share the header, bind it again only when it changes
+        row_header = tuple(source_row)
+        if row_header != header:
+            header = row_header
+            binding = plan.bind_header(header)
+            literals = plan.resolve_literals(header, model_keys)
+        row_data = new_record()
+        apply_mapping_plan(source_row, row_data, plan, binding, literals)
+        yield row_data
+
+
+def get_row_fields(
+    meta_data: CdmFileMetaData,
+    model_def: CdmCompany | OrderedEnum = CdmCompany,
+) -> Tuple[str, ...]:
+    """
+    Get the fields of a mapped record in column order, the csv header of
+    compact rows
+    """
+    return tuple(get_dummy_cdm_model(meta_data, model_def))
+
+
+def to_compact_row(record: Dict[str, Any], fields: Tuple[str, ...]) -> Tuple:
+    """
+    Convert a mapped record to a compact row, see RowFormat
+    :param record: mapped record
+    :param fields: columns, see get_row_fields
+    :return: values in the order of the fields
+    """
+    if len(record) != len(fields):
+        extra = sorted(set(record).difference(fields))
+        raise ValueError(f"fields not in the cdm model: {extra}")
+    return tuple([get_csv_value(record[field]) for field in fields])
+
+
+def get_csv_value(value: Any) -> Any:
+    """
+    Get a value as it is written to csv, datetimes are iso formatted and dicts
+    json encoded, None and strings are left to the csv writer
+    """
+    if isinstance(value, datetime):
+        return value.strftime(ISO8901_FORMAT)
+    if isinstance(value, dict):
+        try:
+            return json.dumps(value, ensure_ascii=False)
+        except TypeError:
+            return str(value)
+    return value
+
+
+def get_invalid_date_field(
+    record: Dict[str, Any], date_fields: Sequence[str], no_data_ok: bool = True
+) -> str | None:
+    """
+    Get the first date field of a mapped record that is not a valid date, dates
+    mapped by get_plain_value carry their validity so they aren't parsed again
+    :param record: mapped record
+    :param date_fields: top level date fields, see MappingPlan.date_fields
+    :param no_data_ok: a date field without a value is valid
+    :return: the field name, None if every date is valid
+    """
+    for date_field in date_fields:
+        if not is_date_string_valid(
+            record.get(date_field),
+            format_name="python_date_format",
+            no_data_ok=no_data_ok,
+        ):
+            return date_field
+    return None
+
+
+def do_transform_columnar(
+    columns: Mapping[str, Sequence[Any]],
+    mapping_rules: MappingRules,
+    meta_data: CdmFileMetaData,
+    cdm_model_def: CdmCompany = CdmCompany,
+) -> List[Dict[str, Any]]:
+    """
+    map a chunk given as columns to the CDM model, the result is the same as
+    do_transform of the rows. Columns that only copy a value to a top level
+    field are moved as a whole and top level literals are filled as constants,
+    see MappingPlan.bind_columnar, the nested nodes are still built row by row.
+    :param columns: column name -> values, lists, numpy or arrow arrays or an
+        arrow table, missing values are None or empty strings
+    :param mapping_rules: Mapping rules
+    :param meta_data: File metadata
+    :param cdm_model_def: CDM model definition
+    :return: CDM records in the order of the rows
+    """
+    start = datetime.now()
+    plan = get_mapping_plan(mapping_rules)
+    if hasattr(columns, "to_pydict"):
+        columns = columns.to_pydict()
+    columns = {name: get_column_values(values) for name, values in columns.items()}
+    size = len(next(iter(columns.values()), []))
+    if any(
+        isinstance(value, (dict, list)) for values in columns.values() for value in values
+    ):
+        # nested source values can hold keys the literal rules look for
+        rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+        return map_rows(rows, plan, meta_data, cdm_model_def)
+
+    new_record = get_cdm_template(meta_data, cdm_model_def)
+    cdm_model = [new_record() for _ in range(size)]
+    if not cdm_model:
+        return cdm_model
+    header = tuple(columns)
+    binding = plan.bind_header(header)
+    model_keys = tuple(cdm_model[0])
+    literals = plan.resolve_literals(header, model_keys)
+    if literals is None:
+        # the literals are searched for after every column, row by row
+        rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+        return map_rows(rows, plan, meta_data, cdm_model_def)
+    literal_values, column_literals = literals
+    moved = plan.bind_columnar(header, model_keys)
+
+    for column, rules in binding:
+        if column not in moved:
+            continue
+        field = rules[0].cdm_field
+        for row_data, source_value in zip(cdm_model, columns[column]):
+            if source_value is None or source_value == "":
+                continue
+            if row_data[field] is None:
+                row_data[field] = source_value
+
+    # moved columns still count as values, the literals are set at the first
+    # value of a row
+    row_ops = [
+        (column, (), columns[column], ())
+        if column in moved
+        else (column, rules, columns[column], group_literals)
+        for (column, rules), group_literals in zip(binding, column_literals)
+    ]
+    for i, row_data in enumerate(cdm_model):
+        applied_literals = set()
+        has_value = False
+        for source_name, rules, values, group_literals in row_ops:
+            source_value = values[i]
+            if source_value is None or source_value == "":
+                continue
+            if rules:
+                add_non_literal_to_model(
+                    plan,
+                    row_data,
+                    source_name,
+                    source_value,
+                    source_name,
+                    get_column_rule(rules, source_name),
+                )
+            if not has_value:
+                has_value = True
+                set_literal_values(row_data, literal_values)
+            if group_literals:
+                add_group_literals(plan, row_data, group_literals, applied_literals)
+        if has_value:
+            set_literal_values(row_data, literal_values)
     logger.info(f"time taken: {(datetime.now() - start).total_seconds()}")
     return cdm_model
 
 
+def get_column_values(values: Sequence[Any]) -> list[Any]:
+    """
+    Get the values of a column as a list of python objects
+    """
+    if hasattr(values, "to_pylist"):
+        return values.to_pylist()
+    if hasattr(values, "tolist"):
+        return values.tolist()
+    return list(values)
+
+
+def init_mapper_worker(
+    mapping_rules: MappingRules,
+    meta_data: CdmFileMetaData,
+    cdm_model_def: CdmCompany = CdmCompany,
+    partition: bool = False,
+    no_data_ok: bool = True,
+    row_format: RowFormat = RowFormat.DICT,
+) -> None:
+    """
+    Compile the mapping rules once when a worker process starts
+    """
+    _worker_context.update(
+        {
+            "plan": get_mapping_plan(mapping_rules),
+            "meta_data": meta_data,
+            "cdm_model_def": cdm_model_def,
+            "partition": partition,
+            "no_data_ok": no_data_ok,
+            "row_format": row_format,
+        }
+    )
+
+
+def map_chunk_in_worker(source_data: list[Dict[str, Any]]) -> bytes:
+    """
+    Map a chunk in a worker process, see init_mapper_worker
+    :return: the serialised chunk, see deserialize_chunk
+    """
+    args = (
+        source_data,
+        _worker_context["plan"],
+        _worker_context["meta_data"],
+        _worker_context["cdm_model_def"],
+    )
+    row_format = _worker_context["row_format"]
+    if _worker_context["partition"]:
+        result = map_rows_partitioned(
+            *args, _worker_context["no_data_ok"], row_format
+        )
+    else:
+        result = map_rows(*args, row_format)
+    return serialize_chunk(result)
+
+
+def serialize_chunk(model: List[Dict[str, Any]] | PartitionedChunk) -> bytes:
+    """
+    Serialise mapped rows to send them between processes. Compact rows only
+    hold strings and None, which marshal handles about ten times faster than
+    pickle. Dict records hold DateValue dates, which marshal can't write, so
+    they always fall back to pickle.
+    """
+    try:
+        return b"m" + marshal.dumps(model)
+    except ValueError:
+        return b"p" + pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def deserialize_chunk(data: bytes) -> List[Dict[str, Any]] | PartitionedChunk:
+    """
+    Deserialise rows serialised by serialize_chunk, in the same python version
+    """
+    if data[:1] == b"m":
+        return marshal.loads(memoryview(data)[1:])
+    return pickle.loads(memoryview(data)[1:])
+
+
+def iter_chunks(
+    source_data: Iterable[Dict[str, Any]], chunk_size: int
+) -> Generator[List[Dict[str, Any]], None, None]:
+    """
+    Split rows into chunks of chunk_size rows, reading them lazily
+    """
+    rows = iter(source_data)
+    while chunk := list(islice(rows, chunk_size)):
+        yield chunk
+
+
 def schema_transformation(
-    source_data: list[Dict[str, Any]],
+    source_data: Iterable[Dict[str, Any]],
     mapping_rules: MappingRules,
     meta_data: CdmFileMetaData,
     cdm_model_def: CdmCompany = CdmCompany,
     chunk_size: int = DEFAULT_MAX_DATA_CHUNK_SIZE,
-) -> Generator[Tuple[List[Dict[str, Any]], int], None, None]:
+    executor: MapperExecutor = MapperExecutor.THREAD,
+    workers: int | None = None,
+    partition: bool = False,
+    no_data_ok: bool = True,
+    row_format: RowFormat | None = None,
+    max_in_flight: int = 0,
+    order: ChunkOrder = ChunkOrder.COMPLETED,
+) -> Generator[Tuple[List[Dict[str, Any]] | List[Tuple] | PartitionedChunk, int], None, None]:
     """
-    map the source_data to the CDM model, return the CDM model in csv format
+    map the source_data to the CDM model, return the CDM model in csv format.
+    The rows are read a chunk at a time and at most max_in_flight chunks are
+    mapped but not yet yielded, the next chunk is only read once a result has
+    been taken, so memory doesn't grow with the size of the input.
+    :param source_data: rows, a list or an iterator read chunk by chunk
+    :param executor: how the chunks are mapped, see MapperExecutor
+    :param workers: number of threads or processes, the executor default if None
+    :param partition: yield each chunk split into valid and invalid records,
+        see map_rows_partitioned
+    :param no_data_ok: with partition, a date field without a value is valid
+    :param row_format: dict records or compact tuples, see RowFormat. By default
+        compact with the process executor, compact rows are sent back from the
+        workers with marshal while dict records have to be pickled, dict
+        records otherwise
+    :param max_in_flight: maximum number of chunks submitted to the pool and not
+        yet yielded, default 2 per worker
+    :param order: yield the chunks as they complete or by index, see ChunkOrder
+    :return: mapped chunks with their index
     """
-    chunks = [
-        source_data[i : i + chunk_size] for i in range(0, len(source_data), chunk_size)
-    ]
+    executor = MapperExecutor(executor)
+    if row_format is None:
+        if executor == MapperExecutor.PROCESS:
+            row_format = RowFormat.COMPACT
+        else:
+            row_format = RowFormat.DICT
+    row_format = RowFormat(row_format)
+    order = ChunkOrder(order)
+    chunks = iter_chunks(source_data, chunk_size)
+    plan = get_mapping_plan(mapping_rules)
+    if partition:
+        map_chunk = partial(
+            map_rows_partitioned, no_data_ok=no_data_ok, row_format=row_format
+        )
+    else:
+        map_chunk = partial(map_rows, row_format=row_format)
+
+    if executor == MapperExecutor.INLINE:
+        for i, chunk in enumerate(chunks):
+            yield map_chunk(chunk, plan, meta_data, cdm_model_def), i
+        return
+
+    if executor == MapperExecutor.PROCESS:
+        # forkserver, a forked copy of a process with running threads can deadlock
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=init_mapper_worker,
+            initargs=(
+                mapping_rules,
+                meta_data,
+                cdm_model_def,
+                partition,
+                no_data_ok,
+                row_format,
+            ),
+        )
+        submit = partial(pool.submit, map_chunk_in_worker)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        submit = partial(
+            pool.submit,
+            map_chunk,
+            plan=plan,
+            meta_data=meta_data,
+            cdm_model_def=cdm_model_def,
+        )
+
+    if not workers:
+        # the pool defaults, to bound the chunks in flight
+        cpu_count = os.cpu_count() or 1
+        if executor == MapperExecutor.PROCESS:
+            workers = cpu_count
+        else:
+            workers = min(32, cpu_count + 4)
+    max_in_flight = max_in_flight or workers * 2
 
-    with ThreadPoolExecutor() as executor:
-        futures = {
-            executor.submit(
-                do_transform, chunk, mapping_rules, meta_data, cdm_model_def
-            ): i
-            for i, chunk in enumerate(chunks)
-        }
+    def get_result(future: Future) -> List[Dict[str, Any]] | List[Tuple] | PartitionedChunk:
+        if executor == MapperExecutor.PROCESS:
+            return deserialize_chunk(future.result())
+        return future.result()
 
-        for future in as_completed(futures):
-            chunk_index = futures[future]
-            chunk_result = future.result()
-            yield chunk_result, chunk_index
+    with pool:
+        try:
+            if order == ChunkOrder.INDEX:
+                in_flight = deque()
+                for i, chunk in enumerate(chunks):
+                    in_flight.append((submit(chunk), i))
+                    if len(in_flight) >= max_in_flight:
+                        future, chunk_index = in_flight.popleft()
+                        yield get_result(future), chunk_index
+                while in_flight:
+                    future, chunk_index = in_flight.popleft()
+                    yield get_result(future), chunk_index
+                return
+
+            in_flight = {}
+            for i, chunk in enumerate(chunks):
+                in_flight[submit(chunk)] = i
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in sorted(done, key=in_flight.get):
+                        yield get_result(future), in_flight.pop(future)
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=in_flight.get):
+                    yield get_result(future), in_flight.pop(future)
+        except Exception:
+            # don't map the chunks still queued when one of them failed
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
 
 
 def get_default_value(rule: MappingRule) -> Any:
@@ -150,6 +634,24 @@ def get_dummy_cdm_model(
     return cdm_model
 
 
+def get_cdm_template(
+    meta_data: CdmFileMetaData,
+    model_def: CdmCompany | OrderedEnum = CdmCompany,
+) -> Callable[[], Dict[str, Any]]:
+    """
+    build the empty cdm model with the file metadata once for a file
+    :return: function returning a new record for a row, a shallow copy of
+        the template unless the metadata has nested values
+    """
+    if not meta_data:
+        raise ValueError("metadata is required")
+    template = get_dummy_cdm_model(meta_data, model_def)
+    # the mapper only adds dicts to a record, every metadata field is already set
+    if any(isinstance(value, (dict, list)) for value in template.values()):
+        return partial(copy.deepcopy, template)
+    return template.copy
+
+
 def get_rules_by_cdm_field(
     field_name: str, mapping_rules: Dict[str, MappingRule]
 ) -> list[MappingRule]:
@@ -258,26 +760,20 @@ def get_plain_value(
     Get the value based on the rule
     """
     if rule.value_type == ValueType.DATE:
-        try:
-            # TBC: this will pad 0s to the date string so to resuce not-compliant date string
-            # e.g. 132021
-            # Instead of throwing an error later down the modelling with date functions
-            # which expects the date string to be in the format of 8 digits 0 padded
-            # But if we can't 'rescue it, so be it. Let the schema transforamtion handle it as an invalid data
-            date_str = datetime.strptime(
-                source_value, rule.python_date_format
-            ).strftime(rule.python_date_format)
-            return {
+        # TBC: this will pad 0s to the date string so to resuce not-compliant date string
+        # e.g. 132021
+        # Instead of throwing an error later down the modelling with date functions
+        # which expects the date string to be in the format of 8 digits 0 padded
+        # But if we can't 'rescue it, so be it. Let the schema transforamtion handle it as an invalid data
+        date_str, valid = parse_date(source_value, rule.python_date_format)
+        return DateValue(
+            {
                 "value": date_str,
                 "format": rule.date_format,
                 "python_date_format": rule.python_date_format,
-            }
-        except ValueError:
-            return {
-                "value": source_value,
-                "format": rule.date_format,
-                "python_date_format": rule.python_date_format,
-            }
+            },
+            valid=valid,
+        )
     else:
         if rule.strategy == Strategy.DEFAULT or rule.strategy == Strategy.ADD:
             return source_value
@@ -297,7 +793,7 @@ def remove_literal_rule(rules: Dict[str, MappingRule], rule: MappingRule) -> Non
 
 
 def search_leaf(
-    nodes: dict[str, any], rules: dict[str, MappingRule], func: callable
+    nodes: dict[str, any], rules: dict[str, MappingRule] | set[str], func: callable
 ) -> None:
     for _, node in nodes.items():
         if isinstance(node, dict):
@@ -315,275 +811,331 @@ def apply_cdm_model(
     """
     apply the cdm model to the data
     """
-    # for each key-value pair in the data, find the corresponding cdm field and add the value
-    for source_name, source_value in source_row.items():
+    apply_mapping_plan(source_row, cdm_record, MappingPlan(mapping_rules))
+
+
+def apply_mapping_plan(
+    source_row: Dict[str, Any],
+    cdm_record: Dict[str, Any],
+    plan: MappingPlan,
+    binding: ColumnBinding | None = None,
+    literals: ResolvedLiterals | None = None,
+) -> None:
+    """
+    apply the compiled mapping rules to the data, the plan is not changed so
+    it can be shared by rows and threads
+    :param source_row: source row
+    :param cdm_record: cdm record to add the values to
+    :param plan: compiled mapping rules
+    :param binding: the header of the row bound by plan.bind_header
+    :param literals: the literals resolved for the header with the binding by
+        plan.resolve_literals, if None they are searched for after every column
+    """
+    if binding is None:
+        header = tuple(source_row)
+        binding = plan.bind_header(header)
+        literals = plan.resolve_literals(header, tuple(cdm_record))
+    # literal rules added under a pattern group, they are added once per row
+    applied_literals = set()
+    if literals is not None:
+        literal_values, column_literals = literals
+        has_value = False
+        for (source_name, rules), group_literals in zip(binding, column_literals):
+            source_value = source_row[source_name]
+            if source_value is None or source_value == "":
+                continue
+            if rules:
+                add_non_literal_to_model(
+                    plan,
+                    cdm_record,
+                    source_name,
+                    source_value,
+                    source_name,
+                    get_column_rule(rules, source_name),
+                )
+            if not has_value:
+                has_value = True
+                set_literal_values(cdm_record, literal_values)
+            if group_literals:
+                add_group_literals(plan, cdm_record, group_literals, applied_literals)
+        if has_value:
+            # a value mapped to a literal field after the first value is
+            # overwritten by the literal
+            set_literal_values(cdm_record, literal_values)
+        return
+
+    literals_added = False
+    for source_name, rules in binding:
+        source_value = source_row[source_name]
         if source_value is None or source_value == "":
             continue
+        if rules:
+            add_non_literal_to_model(
+                plan,
+                cdm_record,
+                source_name,
+                source_value,
+                source_name,
+                get_column_rule(rules, source_name),
+            )
+        elif literals_added:
+            # nothing has been added since the literal rules were last applied
+            continue
+        add_literal_to_model(plan, cdm_record, applied_literals)
+        literals_added = True
 
-        def get_rules_by_source_field(source_name: str) -> list[MappingRule]:
-            """
-            Get the rules based on the source name or pattern match
-            """
-            rules = []
-            for _, rule in mapping_rules.items():
-                if rule.source_field and rule.source_field == source_name:
-                    return [rule]
-
-            if not source_name:
-                return None
-
-            for _, rule in mapping_rules.items():
-                if rule.pattern is not None and (
-                    rule.strategy == Strategy.REGEX
-                    or rule.strategy == Strategy.FIND_REGEX_PARENT
-                ):
-                    pattern = re.compile(rule.pattern)
-
-                    if pattern.match(source_name):
-                        rules.append(rule)
-            return rules
-
-        def group_by_regex_match(
-            nodes: Dict[str, Any], rule: MappingRule
-        ) -> Dict[str, Any]:
-            """
-            filter and group source data by the regex pattern as the source_field
-            """
-            pattern = re.compile(rule.pattern)
-            group_label = None
-            match = pattern.match(source_name)
-            if match:
-                if match.groups():
-                    group_label = match.group(1)
-                if group_label:
-                    update_pattern_group(group_label, rule)
-                    if group_label not in nodes:
-                        nodes[group_label] = {rule.cdm_field: source_value}
-                    else:
-                        nodes[group_label].update({rule.cdm_field: source_value})
-                        # udpate the pattern group so that we can use it to find the node later
-                        # search for "strategy": "find_regex_parent", "pattern_group": 1,
-                        # and same cdm_parent
-
-                    return nodes
-
-        def update_pattern_group(group_label: str, rule: MappingRule) -> None:
-            """
-            update the pattern group in the mapping rules
-            """
-            # get all rules with strategy FIND_REGEX_PARENT
-            rules = [
-                r
-                for _, r in mapping_rules.items()
-                if r.strategy == Strategy.FIND_REGEX_PARENT
-            ]
-
-            for a_rule in rules:
-                if str(a_rule.pattern_group) == str(rule.pattern_group):
-                    a_rule.pattern_group = group_label
-
-        def get_node(nodes: Dict[str, Any], rule: MappingRule) -> Any:
-            if not rule.cdm_parent:
-                # top level node
-                if rule.cdm_field in nodes:
-                    return nodes
-                else:
-                    nodes[rule.cdm_field] = {}
-                    return nodes
-            if isinstance(nodes, dict):
-                for _, node in nodes.items():
-                    if isinstance(node, dict):
-                        if rule.cdm_field in node:
-                            return node
-                        elif rule.pattern_group in node:
-                            return node
-                        else:
-                            return get_node(node, rule)
-            if rule.pattern_group:
-                if rule.pattern_group not in nodes[rule.cdm_parent]:
-                    nodes[rule.cdm_parent][rule.pattern_group] = {}
-                return nodes[rule.cdm_parent]
-
-        def find_regex_node_by_pattern(nodes: Dict[str, Any], rule: MappingRule) -> Any:
-            """
-            find the node based on the regex pattern in the mapping rules
-            This is a a little hack because we use the regex pattern as the key
-            to groupd and store the matched entity. The mapping rules doesn't
-            define the key, so we need to find the key based on the pattern
-            """
-            for node_name, node in nodes.items():
-                if isinstance(node, dict):
-                    if rule.pattern_group in node:
-                        return node[rule.pattern_group]
-                    else:
-                        result = find_regex_node_by_pattern(node, rule)
-                        if result:
-                            return result
-                elif node == rule.pattern_group:
-                    node = {}
-                    return node
-
-        def add_non_literal_to_model(
-            record: Dict[str, Any],
-            source_key: str,
-            mapping_rule: MappingRule = None,
-        ) -> Any:
-            """
-            Recursively search for source_key in a nested dictionary and add the value
-            """
-            #
-            if not mapping_rule:
-                rules = get_rules_by_source_field(source_key)
-                if not rules:
-                    return None
-                if len(rules) == 1:
-                    rule = rules[0]
-            else:
-                rule = mapping_rule
-            if rule.strategy == Strategy.LITERAL:
-                return record
-
-            if rule.strategy == Strategy.REGEX:
-                # start searching from the immediate parent node
-                if rule.cdm_parent:
-                    parent_rule = get_parent_rule(rule, mapping_rules)
-                    if parent_rule.cdm_field in record:
-                        if not record[parent_rule.cdm_field]:
-                            record[parent_rule.cdm_field] = {}
-                        result = group_by_regex_match(
-                            record[parent_rule.cdm_field], rule
-                        )
-                        return result
-                    else:
-                        # parent node is not in the nodes, keep finding the parent node
-                        node = add_non_literal_to_model(
-                            record, parent_rule.source_field, parent_rule
-                        )
-                        node[parent_rule.cdm_field].update(
-                            {rule.cdm_field: source_value}
-                        )
-                else:
-                    return group_by_regex_match(result, rule)
-            elif rule.strategy == Strategy.FIND_REGEX_PARENT:
-                if not rule.pattern_group:
-                    raise KeyError(
-                        f"Rule {rule.cdm_field} has errors, it defines FIND_REGEX_PARENT but missing pattern_group"
-                    )
-                # a FIND_REGEX_PARENT rule must have a parent
-                if not rule.cdm_parent:
-                    raise KeyError(
-                        f"rule {rule.cdm_field} has errors, it defines FIND_REGEX_PARENT but missing parent"
-                    )
-                if rule.cdm_parent in record:
-                    pattern_group_key = str(rule.pattern_group)
-                    if not record[rule.cdm_parent]:
-                        record[rule.cdm_parent] = {}
-                    if pattern_group_key not in record[rule.cdm_parent]:
-                        record[rule.cdm_parent].update({pattern_group_key: {}})
-                    record[rule.cdm_parent][pattern_group_key].update(
-                        {rule.cdm_field: {}}
+
+def set_literal_values(record: Dict[str, Any], literal_values: LiteralValues) -> None:
+    """
+    Set the literals resolved by MappingPlan.resolve_literals on a record
+    """
+    for parent, field, value in literal_values:
+        if parent is None:
+            record[field] = value
+        else:
+            if not record[parent]:
+                record[parent] = {}
+            record[parent][field] = value
+
+
+def add_group_literals(
+    plan: MappingPlan,
+    record: Dict[str, Any],
+    group_literals: tuple[tuple[str, MappingRule], ...],
+    applied: set[str],
+) -> None:
+    """
+    Add the pattern group literals a column can need once its group exists
+    :param group_literals: (rule name, rule) of the column, see
+        MappingPlan.resolve_literals
+    :param applied: names of the literals already added to the row
+    """
+    pending = tuple(
+        (rule_name, rule) for rule_name, rule in group_literals if rule_name not in applied
+    )
+    if pending:
+        add_literal_to_model(plan, record, applied, pending)
+
+
+def get_column_rule(rules: tuple[MappingRule, ...], source_key: str) -> MappingRule:
+    """
+    Get the only rule of a column
+    """
+    if len(rules) > 1:
+        raise KeyError(
+            f"column {source_key} matches more than one rule: "
+            f"{', '.join(rule.cdm_field for rule in rules)}"
+        )
+    return rules[0]
+
+
+def group_by_regex_match(
+    nodes: Dict[str, Any],
+    rule: MappingRule,
+    group_label: str | None,
+    source_value: Any,
+) -> Dict[str, Any]:
+    """
+    filter and group source data by the label the regex pattern matched
+    """
+    if group_label:
+        if group_label not in nodes:
+            nodes[group_label] = {rule.cdm_field: source_value}
+        else:
+            nodes[group_label].update({rule.cdm_field: source_value})
+        return nodes
+
+
+def add_non_literal_to_model(
+    plan: MappingPlan,
+    record: Dict[str, Any],
+    source_name: str,
+    source_value: Any,
+    source_key: str,
+    mapping_rule: MappingRule = None,
+    group_label: str | None = None,
+) -> Any:
+    """
+    Recursively search for source_key in a nested dictionary and add the value
+    :param plan: compiled mapping rules
+    :param record: cdm record or a node of it
+    :param source_name: source column name
+    :param source_value: source column value
+    :param source_key: source field of the rule to apply
+    :param mapping_rule: the rule to apply, looked up by source_key if not given
+    :param group_label: label matched by the regex rule of the column, the key
+        find_regex_parent rules nest their node under
+    """
+    if not mapping_rule:
+        rules = plan.get_column_rules(source_key)
+        if not rules:
+            return None
+        rule = get_column_rule(rules, source_key)
+    else:
+        rule = mapping_rule
+    if rule.strategy == Strategy.LITERAL:
+        return record
+
+    if rule.strategy == Strategy.REGEX:
+        if not rule.cdm_parent:
+            raise KeyError(
+                f"rule {rule.cdm_field} has errors, it defines REGEX but missing parent"
+            )
+        group_label = plan.get_group_label(rule, source_name)
+        # start searching from the immediate parent node
+        parent_rule = plan.get_parent_rule(rule)
+        if parent_rule.cdm_field in record:
+            if not record[parent_rule.cdm_field]:
+                record[parent_rule.cdm_field] = {}
+            return group_by_regex_match(
+                record[parent_rule.cdm_field], rule, group_label, source_value
+            )
+        else:
+            # parent node is not in the nodes, keep finding the parent node
+            node = add_non_literal_to_model(
+                plan,
+                record,
+                source_name,
+                source_value,
+                parent_rule.source_field,
+                parent_rule,
+                group_label,
+            )
+            node[parent_rule.cdm_field].update({rule.cdm_field: source_value})
+    elif rule.strategy == Strategy.FIND_REGEX_PARENT:
+        if not rule.pattern_group:
+            raise KeyError(
+                f"Rule {rule.cdm_field} has errors, it defines FIND_REGEX_PARENT but missing pattern_group"
+            )
+        # a FIND_REGEX_PARENT rule must have a parent
+        if not rule.cdm_parent:
+            raise KeyError(
+                f"rule {rule.cdm_field} has errors, it defines FIND_REGEX_PARENT but missing parent"
+            )
+        if not group_label:
+            group_label = plan.get_group_label(rule, source_name)
+        if rule.cdm_parent in record:
+            pattern_group_key = group_label or str(rule.pattern_group)
+            if not record[rule.cdm_parent]:
+                record[rule.cdm_parent] = {}
+            if pattern_group_key not in record[rule.cdm_parent]:
+                record[rule.cdm_parent].update({pattern_group_key: {}})
+            record[rule.cdm_parent][pattern_group_key].update({rule.cdm_field: {}})
+            return record[rule.cdm_parent][pattern_group_key]
+        else:
+            parent_rule = plan.get_parent_rule(rule)
+            node = add_non_literal_to_model(
+                plan,
+                record,
+                source_name,
+                source_value,
+                parent_rule.source_field,
+                parent_rule,
+                group_label,
+            )
+            node[parent_rule.cdm_field].update({rule.cdm_field: source_value})
+            return record
+    elif rule.strategy == Strategy.DEFAULT or rule.strategy == Strategy.ADD:
+        if not isinstance(record, dict):
+            raise KeyError("nodes is not a dictionary")
+        if rule.cdm_field in record:
+            if (
+                rule.source_field
+                and rule.source_field == source_key
+                and record[rule.cdm_field] is None
+            ):
+                record[rule.cdm_field] = get_plain_value(rule, source_value)
+            return record
+
+        elif rule.cdm_parent:
+            parent_rule = plan.get_parent_rule(rule)
+
+            if rule.cdm_parent in record:
+                if not record[rule.cdm_parent]:
+                    record[rule.cdm_parent] = {}
+                record[rule.cdm_parent].update({rule.cdm_field: {}})
+                if rule.source_field and rule.source_field == source_key:
+                    record[rule.cdm_parent][rule.cdm_field] = get_plain_value(
+                        rule, source_value
                     )
-                    return record[rule.cdm_parent][pattern_group_key]
                 else:
-                    parent_rule = get_parent_rule(rule, mapping_rules)
-                    node = add_non_literal_to_model(
-                        record, parent_rule.source_field, parent_rule
+                    return record[rule.cdm_parent]
+            elif parent_rule:
+                # parent node is not in the nodes, keep finding the parent node
+                node = add_non_literal_to_model(
+                    plan,
+                    record,
+                    source_name,
+                    source_value,
+                    parent_rule.source_field,
+                    parent_rule,
+                    group_label,
+                )
+                if node:
+                    node[parent_rule.cdm_field].update(
+                        {rule.cdm_field: get_plain_value(rule, source_value)}
                     )
-                    node[parent_rule.cdm_field].update({rule.cdm_field: source_value})
-                    return record
-            elif rule.strategy == Strategy.DEFAULT or rule.strategy == Strategy.ADD:
-                if not isinstance(record, dict):
-                    raise KeyError("nodes is not a dictionary")
-                if rule.cdm_field in record:
-                    if (
-                        rule.source_field
-                        and rule.source_field == source_key
-                        and record[rule.cdm_field] is None
-                    ):
-                        record[rule.cdm_field] = get_plain_value(
-                            rule, source_value, mapping_rules
-                        )
-                    return record
-
-                elif rule.cdm_parent:
-                    parent_rule = get_parent_rule(rule, mapping_rules)
-
-                    if rule.cdm_parent in record:
-                        if not record[rule.cdm_parent]:
-                            record[rule.cdm_parent] = {}
-                        record[rule.cdm_parent].update({rule.cdm_field: {}})
-                        if rule.source_field and rule.source_field == source_key:
-                            record[rule.cdm_parent][rule.cdm_field] = get_plain_value(
-                                rule, source_value, mapping_rules
-                            )
-                        else:
-                            return record[rule.cdm_parent]
-                    elif parent_rule:
-                        # parent node is not in the nodes, keep finding the parent node
-                        node = add_non_literal_to_model(
-                            record, parent_rule.source_field, parent_rule
-                        )
-                        if node:
-                            node[parent_rule.cdm_field].update(
-                                {
-                                    rule.cdm_field: get_plain_value(
-                                        rule, source_value, mapping_rules
-                                    )
-                                }
-                            )
 
-                else:
-                    # look for child nodes
-                    for _, node in record.items():
-                        if isinstance(node, dict):
-                            result = add_non_literal_to_model(node, source_key)
-                        elif isinstance(node, list):
-                            for item in node:
-                                result = add_non_literal_to_model(item, source_key)
-
-        def add_literal_to_model(
-            nodes: Dict[str, Any], rules: dict[str, MappingRule]
-        ) -> Any:
-            """
-            Recursively search for source_key in a nested dictionary and add the value
-            """
-            # start searching from the immediate parent node
-            # if parent node found, add the literal value
-            # if not, keep finding the parent node of nodes down the leaf nodes
-            literal_rules = {
-                k: r for k, r in rules.items() if r.strategy == Strategy.LITERAL
-            }
-            for rule_name, rule in literal_rules.items():
-                if rule.cdm_parent and rule.pattern_group is None:
-                    parent_rule = get_parent_rule(rule, rules)
-                    if parent_rule.cdm_field in nodes:
-                        if not nodes[parent_rule.cdm_field]:
-                            nodes[parent_rule.cdm_field] = {}
-                        nodes[parent_rule.cdm_field].update(
-                            {rule.cdm_field: rule.literal_value}
+        else:
+            # look for child nodes
+            for _, node in record.items():
+                if isinstance(node, dict):
+                    add_non_literal_to_model(
+                        plan, node, source_name, source_value, source_key
+                    )
+                elif isinstance(node, list):
+                    for item in node:
+                        add_non_literal_to_model(
+                            plan, item, source_name, source_value, source_key
                         )
-                        # del rules[rule_name]
-                        continue
 
-                elif rule.pattern_group:
-                    if rule.pattern_group in nodes:
-                        nodes[rule.pattern_group].update(
-                            {rule.cdm_field: rule.literal_value}
-                        )
-                        del rules[rule_name]
-                    else:
-                        # pattern_group is not in the nodes, keep finding the parent node down the leaf nodes
-                        search_leaf(nodes, rules, add_literal_to_model)
-                elif rule.cdm_field in nodes:
-                    nodes[rule.cdm_field] = rule.literal_value
-                    # del rules[rule_name]
-                    continue
-                else:
-                    # parent node is not in the nodes, keep finding the parent node down the leaf nodes
-                    search_leaf(nodes, rules, add_literal_to_model)
 
-        add_non_literal_to_model(cdm_record, source_name)
-        add_literal_to_model(cdm_record, mapping_rules)
+def add_literal_to_model(
+    plan: MappingPlan,
+    nodes: Dict[str, Any],
+    applied: set[str],
+    rules: tuple[tuple[str, MappingRule], ...] | None = None,
+) -> Any:
+    """
+    Recursively search for the parent nodes of the literal rules and add the value
+    :param plan: compiled mapping rules
+    :param nodes: cdm record or a node of it
+    :param applied: names of the pattern group literal rules already added to the row
+    :param rules: (rule name, rule) of the literals to add, all of them if None
+    """
+    # start searching from the immediate parent node
+    # if parent node found, add the literal value
+    # if not, keep finding the parent node of nodes down the leaf nodes
+    literal_rules = [
+        (rule_name, rule)
+        for rule_name, rule in (plan.literal_rules if rules is None else rules)
+        if rule_name not in applied
+    ]
+    search_children = partial(add_literal_to_model, plan, rules=rules)
+    for rule_name, rule in literal_rules:
+        if rule.cdm_parent and rule.pattern_group is None:
+            parent_rule = plan.get_parent_rule(rule)
+            if parent_rule.cdm_field in nodes:
+                if not nodes[parent_rule.cdm_field]:
+                    nodes[parent_rule.cdm_field] = {}
+                nodes[parent_rule.cdm_field].update(
+                    {rule.cdm_field: rule.literal_value}
+                )
+                continue
+
+        elif rule.pattern_group:
+            if rule.pattern_group in nodes:
+                nodes[rule.pattern_group].update({rule.cdm_field: rule.literal_value})
+                applied.add(rule_name)
+            else:
+                # pattern_group is not in the nodes, keep finding the parent node down the leaf nodes
+                search_leaf(nodes, applied, search_children)
+        elif rule.cdm_field in nodes:
+            nodes[rule.cdm_field] = rule.literal_value
+            continue
+        else:
+            # parent node is not in the nodes, keep finding the parent node down the leaf nodes
+            search_leaf(nodes, applied, search_children)
 
 
 def get_date_fields(mapping_rules: MappingRules) -> list[str]:
@@ -0,0 +1,306 @@
+import boto3
+import csv
+import gzip
+import io
+import logging
+import os
+from abc import ABC, abstractmethod
+from botocore.exceptions import ClientError
+from enum import Enum
+from typing import Any, Generator, Iterable, Optional
+from schema_transformation.cdm_mapping_rule import MappingRules
+from shared.cdm_company import CdmCompany
+from shared.constants import HASH_INDEX_PREFIX, DYNAMODB_BATCH_WRITE_SIZE
+from shared.hashing import hash_one
+
+
+logger = logging.getLogger()
+
+# source column the parser fills with the row hash
+HASH_FIELD = "hash"
+
+
+class HashIndexStore(Enum):
+    """
+    Where the hash index of the previous run is kept
+    local:    gzipped csv file in a local directory
+    s3:       gzipped csv object in a bucket
+    dynamodb: one item per key in a table with partition key index_name and
+              sort key row_key, only changed and removed keys are written
+    """
+    LOCAL = "local"
+    S3 = "s3"
+    DYNAMODB = "dynamodb"
+
+
+class HashIndex(ABC):
+    """
+    Row hash of every key of a snapshot, keys with more than one row keep
+    every hash separated by a space
+    """
+
+    @abstractmethod
+    def load(self) -> dict[str, str]:
+        """
+        Load the index of the previous run, empty if there is none
+        """
+
+    @abstractmethod
+    def save(
+        self, index: dict[str, str], changed: dict[str, str], removed: list[str]
+    ) -> None:
+        """
+        Save the index of this run
+        :param index: key -> hash of every key of the snapshot
+        :param changed: key -> hash of the new and changed keys
+        :param removed: keys that are not in the snapshot any more
+        """
+
+
+class FileHashIndex(HashIndex):
+    """
+    Hash index kept as a gzipped csv of key,hash rows
+    """
+
+    @staticmethod
+    def to_bytes(index: dict[str, str]) -> bytes:
+        text = io.StringIO()
+        csv.writer(text).writerows(index.items())
+        return gzip.compress(text.getvalue().encode("utf-8"))
+
+    @staticmethod
+    def from_bytes(data: bytes) -> dict[str, str]:
+        text = io.StringIO(gzip.decompress(data).decode("utf-8"))
+        return dict(csv.reader(text))
+
+
+class LocalHashIndex(FileHashIndex):
+    def __init__(self, directory: str, index_name: str):
+        self.path = os.path.join(directory, f"{index_name}.csv.gz")
+
+    def load(self) -> dict[str, str]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "rb") as f:
+            return self.from_bytes(f.read())
+
+    def save(
+        self, index: dict[str, str], changed: dict[str, str], removed: list[str]
+    ) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # replace the old index only once the new one is written
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(self.to_bytes(index))
+        os.replace(temp_path, self.path)
+
+
+class S3HashIndex(FileHashIndex):
+    def __init__(self, s3_client: boto3.client, bucket: str, index_name: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = f"{HASH_INDEX_PREFIX}/{index_name}.csv.gz"
+
+    def load(self) -> dict[str, str]:
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return {}
+            raise
+        return self.from_bytes(response["Body"].read())
+
+    def save(
+        self, index: dict[str, str], changed: dict[str, str], removed: list[str]
+    ) -> None:
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=self.to_bytes(index),
+            ContentType="text/csv",
+            ContentEncoding="gzip",
+        )
+
+
+class DynamoHashIndex(HashIndex):
+    def __init__(self, dynamodb: boto3.client, table_name: str, index_name: str):
+        self.dynamodb = dynamodb
+        self.table = table_name
+        self.index_name = index_name
+
+    def load(self) -> dict[str, str]:
+        index = {}
+        paginator = self.dynamodb.get_paginator("query")
+        for page in paginator.paginate(
+            TableName=self.table,
+            KeyConditionExpression="index_name = :index_name",
+            ExpressionAttributeValues={":index_name": {"S": self.index_name}},
+            ProjectionExpression="row_key, row_hash",
+        ):
+            for item in page.get("Items", []):
+                index[item["row_key"]["S"]] = item["row_hash"]["S"]
+        return index
+
+    def save(
+        self, index: dict[str, str], changed: dict[str, str], removed: list[str]
+    ) -> None:
+        requests = [
+            {
+                "PutRequest": {
+                    "Item": {
+                        "index_name": {"S": self.index_name},
+                        "row_key": {"S": key},
+                        "row_hash": {"S": row_hash},
+                    }
+                }
+            }
+            for key, row_hash in changed.items()
+        ]
+        requests.extend(
+            {
+                "DeleteRequest": {
+                    "Key": {
+                        "index_name": {"S": self.index_name},
+                        "row_key": {"S": key},
+                    }
+                }
+            }
+            for key in removed
+        )
+        for i in range(0, len(requests), DYNAMODB_BATCH_WRITE_SIZE):
+            self._write(requests[i : i + DYNAMODB_BATCH_WRITE_SIZE])
+
+    def _write(self, requests: list[dict[str, Any]]) -> None:
+        while requests:
+            response = self.dynamodb.batch_write_item(
+                RequestItems={self.table: requests}
+            )
+            requests = response.get("UnprocessedItems", {}).get(self.table, [])
+
+
+def get_hash_index(
+    store: HashIndexStore,
+    index_name: str,
+    location: str,
+    s3_client: Optional[boto3.client] = None,
+    dynamodb: Optional[boto3.client] = None,
+) -> HashIndex:
+    """
+    Get the hash index of a data source
+    :param store: where the index is kept
+    :param index_name: name of the index, e.g. jurisdiction/prefix
+    :param location: directory, bucket or table name
+    """
+    store = HashIndexStore(store)
+    if store == HashIndexStore.LOCAL:
+        return LocalHashIndex(location, index_name)
+    if store == HashIndexStore.S3:
+        return S3HashIndex(s3_client, location, index_name)
+    return DynamoHashIndex(dynamodb, location, index_name)
+
+
+def get_index_name(
+    jurisdiction: str, object_key: str, source_name: Optional[str] = None
+) -> str:
+    """
+    Get the name of the hash index of a data source, e.g. us_fl/cor. The source
+    file names carry the snapshot date, so they can't name the index, a prefix
+    with more than one file per snapshot needs a source name for each of them,
+    e.g. us_fl/cor/cordata0
+    :param jurisdiction: jurisdiction of the data
+    :param object_key: key of the source object, the file of the snapshot
+    :param source_name: stable name of the file within the prefix
+    """
+    prefix = object_key.split("/")[0]
+    if source_name:
+        return f"{jurisdiction}/{prefix}/{source_name}"
+    return f"{jurisdiction}/{prefix}"
+
+
+def get_key_field(mapping_rules: MappingRules) -> str:
+    """
+    Get the source column mapped to the company number, the key of the index
+    """
+    for rule in mapping_rules.rules.values():
+        if (
+            rule.cdm_field == CdmCompany.COMPANY_NUMBER.value
+            and not rule.cdm_parent
+            and rule.source_field
+        ):
+            return rule.source_field
+    raise ValueError("no source field is mapped to company_number")
+
+
+def get_row_hash(row: dict[str, Any]) -> str:
+    """
+    Get the hash of a source row, the hash column of the parser if it has one
+    """
+    row_hash = row.get(HASH_FIELD)
+    if row_hash:
+        return row_hash
+    return hash_one(tuple(str(value) for value in row.values()))
+
+
+class IncrementalRun:
+    """
+    Select the rows of a snapshot that are new or changed since the previous
+    run, by the row hash of each key. The index is only saved by commit, call it
+    once the mapped rows are written, so a failed run is mapped again in full.
+    The rows passed to filter must be the whole snapshot, a key missing from
+    them is removed, so a run can't be split over the chunks of a file.
+    """
+
+    def __init__(self, hash_index: HashIndex, key_field: str):
+        self.hash_index = hash_index
+        self.key_field = key_field
+        self.index: dict[str, str] = {}
+        self.changed: dict[str, str] = {}
+        self.removed_keys: list[str] = []
+
+    def filter(
+        self, source_data: Iterable[dict[str, Any]]
+    ) -> Generator[dict[str, Any], None, None]:
+        """
+        Yield the new and changed rows, rows without a key are always mapped.
+        The removed keys are known once every row has been read.
+        :param source_data: rows of the whole snapshot
+        :return: rows to map
+        """
+        previous = self.hash_index.load()
+        index, changed = self.index, self.changed
+        total = mapped = 0
+        for row in source_data:
+            total += 1
+            key = row.get(self.key_field)
+            row_hash = get_row_hash(row)
+            if not key:
+                mapped += 1
+                yield row
+                continue
+            if key in index:
+                index[key] = f"{index[key]} {row_hash}"
+            else:
+                index[key] = row_hash
+            old_hash = previous.get(key)
+            if old_hash != row_hash and (
+                not old_hash or row_hash not in old_hash.split(" ")
+            ):
+                mapped += 1
+                yield row
+        # every key with other hashes, including a key that lost one of its
+        # rows, which maps no row but has to be saved
+        changed.update(
+            (key, row_hash)
+            for key, row_hash in index.items()
+            if set(row_hash.split(" ")) != set(previous.get(key, "").split(" "))
+        )
+        self.removed_keys = [key for key in previous if key not in index]
+        logger.info(
+            f"{mapped} of {total} rows changed, {len(self.removed_keys)} keys removed"
+        )
+
+    def commit(self) -> None:
+        """
+        Save the index of this run, see HashIndex.save
+        """
+        self.hash_index.save(self.index, self.changed, self.removed_keys)
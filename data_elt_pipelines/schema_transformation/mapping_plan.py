@@ -0,0 +1,461 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Any, Iterable, Mapping, Optional
+from schema_transformation.cdm_mapping_rule import (
+    MappingRule,
+    MappingRules,
+    Strategy,
+    ValueType,
+)
+from shared.constants import HEADER_BINDING_CACHE_SIZE, MAPPING_PLAN_CACHE_SIZE
+
+
+# source column and the rules it matches, for every column of a header
+ColumnBinding = tuple[tuple[str, tuple[MappingRule, ...]], ...]
+# (parent, field, value) of the literals set on a record, parent is None for a
+# top level field, and the pattern group literals each column of a header can
+# need, see MappingPlan.resolve_literals
+LiteralValues = tuple[tuple[Optional[str], str, Any], ...]
+ResolvedLiterals = tuple[LiteralValues, tuple[tuple[tuple[str, MappingRule], ...], ...]]
+# numbered back references change meaning when patterns are combined
+BACK_REFERENCE = re.compile(r"\\[1-9]")
+# keys of the nodes get_plain_value creates for date values
+DATE_VALUE_KEYS = frozenset(("value", "format", "python_date_format"))
+
+
+class MappingPlan:
+    """
+    Mapping rules compiled for the mapper: regex patterns are compiled, source
+    columns and parent rules are looked up once instead of for every value.
+    The plan is not changed by the mapper, the state of a row (e.g. the matched
+    pattern group label) is passed along with the row, so a single plan can be
+    shared by every row and thread.
+    """
+
+    def __init__(self, rules: Mapping[str, MappingRule]):
+        # own copies, changing the caller's rules afterwards doesn't change the plan
+        rules = {name: rule.model_copy(deep=True) for name, rule in rules.items()}
+        self.rules: Mapping[str, MappingRule] = MappingProxyType(rules)
+        self.literal_rules: tuple[tuple[str, MappingRule], ...] = tuple(
+            (name, rule)
+            for name, rule in rules.items()
+            if rule.strategy == Strategy.LITERAL
+        )
+        regex_rules = {
+            name: rule
+            for name, rule in rules.items()
+            if rule.pattern is not None
+            and rule.strategy in (Strategy.REGEX, Strategy.FIND_REGEX_PARENT)
+        }
+        check_regex_rules(regex_rules)
+        self._matcher = RegexMatcher(tuple(regex_rules.values()))
+        self._source_fields = {}
+        for rule in rules.values():
+            if rule.source_field:
+                # the first rule for a source field wins
+                self._source_fields.setdefault(rule.source_field, rule)
+        self._cdm_fields = frozenset(rule.cdm_field for rule in rules.values())
+        # top level fields holding dates, in rule order, see get_date_fields
+        self.date_fields: tuple[str, ...] = tuple(
+            dict.fromkeys(
+                rule.cdm_parent or rule.cdm_field
+                for rule in rules.values()
+                if rule.value_type == ValueType.DATE
+            )
+        )
+        self._parents = {}
+        for rule in rules.values():
+            if rule.cdm_parent is not None:
+                key = (rule.cdm_parent, str(rule.pattern_group))
+                if key not in self._parents:
+                    self._parents[key] = find_parent(rules.values(), rule)
+        # column -> rules, (pattern, column) -> label and header -> binding, filled
+        # on first use, the values only depend on the key, so concurrent fills
+        # are harmless
+        self._columns: dict[str, tuple[MappingRule, ...]] = {}
+        self._labels: dict[tuple[str, str], Optional[str]] = {}
+        self._headers: dict[tuple[str, ...], ColumnBinding] = {}
+        self._columnar: dict[tuple, frozenset[str]] = {}
+        self._literals: dict[tuple, Optional[ResolvedLiterals]] = {}
+
+    def get_column_rules(self, source_name: str) -> tuple[MappingRule, ...]:
+        """
+        Get the rules of a source column, the rule with the same source_field,
+        otherwise every regex rule whose pattern matches the column name
+        :param source_name: source column name
+        """
+        rules = self._columns.get(source_name)
+        if rules is None:
+            rules = self._match_column(source_name)
+            self._columns[source_name] = rules
+        return rules
+
+    def _match_column(self, source_name: str) -> tuple[MappingRule, ...]:
+        if source_name in self._source_fields:
+            return (self._source_fields[source_name],)
+        if not source_name:
+            return ()
+        matches = self._matcher.match_all(source_name)
+        for rule, label in matches:
+            self._labels[(rule.pattern, source_name)] = label
+        return tuple(rule for rule, _ in matches)
+
+    def bind_header(self, header: tuple[str, ...]) -> ColumnBinding:
+        """
+        Bind the columns of a file to their rules, so rows with the same header
+        are mapped by a loop over the bound columns without looking up rules
+        :param header: source column names in the order of the row
+        :return: (column, rules) for every column, rules is empty for a column
+            without a rule
+        :raises KeyError: when a column matches more than one rule
+        """
+        binding = self._headers.get(header)
+        if binding is None:
+            binding = tuple((column, self.get_column_rules(column)) for column in header)
+            for column, rules in binding:
+                if len(rules) > 1:
+                    raise KeyError(
+                        f"column {column} matches more than one rule: "
+                        f"{', '.join(rule.cdm_field for rule in rules)}"
+                    )
+            if len(self._headers) < HEADER_BINDING_CACHE_SIZE:
+                self._headers[header] = binding
+        return binding
+
+    def bind_columnar(
+        self, header: tuple[str, ...], model_keys: tuple[str, ...]
+    ) -> frozenset[str]:
+        """
+        Find the columns the columnar mapper can move to a top level field as a
+        whole without changing the result of the row by row mapping: a
+        default/add rule without parent for a field no other rule adds to, uses
+        as parent or sets a literal for
+        :param header: source column names
+        :param model_keys: top level keys of the cdm record
+        :return: names of the moved columns
+        """
+        key = (header, model_keys)
+        moved = self._columnar.get(key)
+        if moved is not None:
+            return moved
+
+        binding = self.bind_header(header)
+        rules = tuple(self.rules.values())
+        parents = {rule.cdm_parent for rule in rules if rule.cdm_parent}
+        fields = {}
+        for rule in rules:
+            fields[rule.cdm_field] = fields.get(rule.cdm_field, 0) + 1
+        moved = set()
+        for column, column_rules in binding:
+            if len(column_rules) != 1:
+                continue
+            rule = column_rules[0]
+            if (
+                rule.strategy in (Strategy.DEFAULT, Strategy.ADD)
+                and not rule.cdm_parent
+                and rule.value_type != ValueType.DATE
+                and rule.source_field == column
+                and rule.cdm_field in model_keys
+                and rule.cdm_field not in parents
+                and fields[rule.cdm_field] == 1
+            ):
+                moved.add(column)
+        moved = frozenset(moved)
+        if len(self._columnar) < HEADER_BINDING_CACHE_SIZE:
+            self._columnar[key] = moved
+        return moved
+
+    def resolve_literals(
+        self, header: tuple[str, ...], model_keys: tuple[str, ...]
+    ) -> Optional[ResolvedLiterals]:
+        """
+        Resolve where the literal rules go for the rows of a header, so the
+        mapper sets them directly instead of searching the record for their
+        parents after every column:
+        - a literal of a top level field or of a child of a top level field is
+          set when the row has its first value, and again at the end of the row
+          as values mapped to the same field in between are overwritten by it
+        - a pattern group literal is added after a column that can create the
+          group, see get_group_labels
+        :param header: source column names
+        :param model_keys: top level keys of the cdm record
+        :return: the literal values and the group literals of each column, None
+            if a literal can also be found in a nested node, the mapper then
+            searches for the literals after every column
+        """
+        key = (header, model_keys)
+        if key in self._literals:
+            return self._literals[key]
+
+        binding = self.bind_header(header)
+        nested_keys = self._get_nested_keys(binding)
+        values, group_literals = [], []
+        resolved = True
+        for rule_name, rule in self.literal_rules:
+            if rule.cdm_parent and rule.pattern_group is None:
+                try:
+                    parent = self.get_parent_rule(rule).cdm_field
+                except KeyError:
+                    # raised again when the row is mapped
+                    resolved = False
+                    break
+                values.append((parent, rule.cdm_field, rule.literal_value))
+                # the parent must be at the top level only
+                resolved = parent in model_keys and parent not in nested_keys
+            elif rule.pattern_group:
+                group_literals.append((rule_name, rule))
+                # the group must be created below the top level
+                resolved = rule.pattern_group not in model_keys
+            else:
+                values.append((None, rule.cdm_field, rule.literal_value))
+                resolved = (
+                    rule.cdm_field in model_keys and rule.cdm_field not in nested_keys
+                )
+            if not resolved:
+                break
+
+        literals = None
+        if resolved:
+            column_literals = []
+            for column, rules in binding:
+                labels = self.get_group_labels(rules, column)
+                column_literals.append(
+                    tuple(
+                        (rule_name, rule)
+                        for rule_name, rule in group_literals
+                        if str(rule.pattern_group) in labels
+                    )
+                )
+            literals = (tuple(values), tuple(column_literals))
+        if len(self._literals) < HEADER_BINDING_CACHE_SIZE:
+            self._literals[key] = literals
+        return literals
+
+    def get_group_labels(
+        self, rules: tuple[MappingRule, ...], source_name: str
+    ) -> set[str]:
+        """
+        Get the pattern group keys a column can create, the labels its rule and
+        the parents of the rule match and their pattern groups
+        """
+        labels = set()
+        for rule in rules:
+            seen = set()
+            while rule is not None and id(rule) not in seen:
+                seen.add(id(rule))
+                label = self.get_group_label(rule, source_name)
+                if label is not None:
+                    labels.add(label)
+                if rule.pattern_group is not None:
+                    labels.add(str(rule.pattern_group))
+                try:
+                    rule = self.get_parent_rule(rule)
+                except KeyError:
+                    break
+        return labels
+
+    def _get_nested_keys(self, binding: ColumnBinding) -> set[str]:
+        """
+        Get the keys the mapper can create below the top level for a header
+        """
+        nested_keys = set(DATE_VALUE_KEYS)
+        for rule in self.rules.values():
+            if rule.cdm_parent:
+                nested_keys.add(rule.cdm_field)
+            if rule.pattern_group is not None:
+                nested_keys.add(str(rule.pattern_group))
+        for column, column_rules in binding:
+            for rule in column_rules:
+                nested_keys.add(self.get_group_label(rule, column))
+        return nested_keys
+
+    def get_group_label(self, rule: MappingRule, source_name: str) -> Optional[str]:
+        """
+        Get the label a regex rule groups a column under, e.g. 2 for PRINC2_NAME
+        :param rule: regex rule
+        :param source_name: source column name
+        :return: first group of the match, None if there is none
+        """
+        if rule.pattern is None:
+            return None
+        key = (rule.pattern, source_name)
+        if key in self._labels:
+            return self._labels[key]
+        label = None
+        match = re.match(rule.pattern, source_name)
+        if match and match.groups():
+            label = match.group(1)
+        self._labels[key] = label
+        return label
+
+    def get_parent_rule(self, rule: MappingRule) -> Optional[MappingRule]:
+        """
+        find the parent rule based on cdm_parent and the pattern group the
+        rule is declared with, see cdm_mapper.get_parent_rule
+        """
+        if rule.cdm_parent is None:
+            return None
+        if rule.cdm_parent not in self._cdm_fields:
+            raise KeyError(f" {rule.cdm_parent} is not defined in the mapping rules")
+        parent_rule = self._parents.get((rule.cdm_parent, str(rule.pattern_group)))
+        if not parent_rule:
+            raise KeyError(f"parent rule for {rule.cdm_field} is not found")
+        return parent_rule
+
+
+class RegexMatcher:
+    """
+    The patterns of the regex rules combined into one alternation of named
+    groups, a single match finds the first rule matching a column and the
+    label of its first group. Patterns with numbered back references or
+    global flags can't be combined and are matched one by one.
+    """
+
+    def __init__(self, rules: tuple[MappingRule, ...]):
+        self.rules = rules
+        self._group_counts = tuple(re.compile(rule.pattern).groups for rule in rules)
+        # index of the first rule -> alternation of the rules from there on
+        self._alternations: dict[int, tuple[re.Pattern, dict[str, int]]] = {}
+        self._combined = not any(BACK_REFERENCE.search(rule.pattern) for rule in rules)
+        if self._combined:
+            try:
+                self._get_alternation(0)
+            except re.error:
+                # e.g. global flags or the same group name in two patterns
+                self._combined = False
+
+    def _get_alternation(self, start: int) -> tuple[re.Pattern, dict[str, int]]:
+        alternation = self._alternations.get(start)
+        if alternation is None:
+            pattern = re.compile(
+                "|".join(
+                    f"(?P<rule_{i}>{self.rules[i].pattern})"
+                    for i in range(start, len(self.rules))
+                )
+            )
+            alternation = (pattern, pattern.groupindex)
+            self._alternations[start] = alternation
+        return alternation
+
+    def match(self, source_name: str, start: int = 0) -> Optional[tuple[int, Optional[str]]]:
+        """
+        Find the first rule from start whose pattern matches the column
+        :param source_name: source column name
+        :param start: index of the first rule to try
+        :return: index of the rule and the group label, None if no rule matches
+        """
+        if start >= len(self.rules):
+            return None
+        if not self._combined:
+            for i in range(start, len(self.rules)):
+                match = re.match(self.rules[i].pattern, source_name)
+                if match:
+                    return i, match.group(1) if match.groups() else None
+            return None
+
+        pattern, groupindex = self._get_alternation(start)
+        match = pattern.match(source_name)
+        if not match:
+            return None
+        index = int(match.lastgroup[len("rule_"):])
+        label = None
+        if self._group_counts[index]:
+            label = match.group(groupindex[match.lastgroup] + 1)
+        return index, label
+
+    def match_all(self, source_name: str) -> list[tuple[MappingRule, Optional[str]]]:
+        """
+        Find every rule whose pattern matches the column, an alternation only
+        matches when none of the patterns before the matching one can, so this
+        is one match, plus one for each further matching rule
+        :param source_name: source column name
+        :return: (rule, group label) in the order of the rules
+        """
+        matches = []
+        found = self.match(source_name)
+        while found:
+            index, label = found
+            matches.append((self.rules[index], label))
+            found = self.match(source_name, index + 1)
+        return matches
+
+
+def check_regex_rules(rules: Mapping[str, MappingRule]) -> None:
+    """
+    Reject regex rules that would make columns ambiguous when the rules are
+    loaded: invalid patterns and rules with the same pattern. Columns matched
+    by more than one pattern are rejected by MappingPlan.bind_header, before
+    the first row of a file is mapped.
+    :raises KeyError: when the rules have errors
+    """
+    patterns = {}
+    for name, rule in rules.items():
+        try:
+            re.compile(rule.pattern)
+        except re.error as e:
+            raise KeyError(f"rule {name} has errors, invalid pattern {rule.pattern}: {e}")
+        if rule.pattern in patterns:
+            raise KeyError(
+                f"rules {patterns[rule.pattern]} and {name} have the same pattern {rule.pattern}"
+            )
+        patterns[rule.pattern] = name
+
+
+def find_parent(
+    rules: Iterable[MappingRule], rule: MappingRule
+) -> Optional[MappingRule]:
+    """
+    find the parent rule of a rule, same as cdm_mapper.find_parent_rule over the
+    rules with the parent cdm_field
+    """
+    for a_rule in rules:
+        if a_rule.cdm_field != rule.cdm_parent:
+            continue
+        if a_rule.cdm_parent is None:
+            # top level node, no duplication
+            return a_rule
+        elif str(a_rule.pattern_group) == str(rule.pattern_group):
+            return a_rule
+    return None
+
+
+def get_rules_fingerprint(mapping_rules: MappingRules) -> str:
+    """
+    Fingerprint of the rules, a changed rules file with the same name and
+    version gets a new plan
+    """
+    return hashlib.sha256(
+        mapping_rules.model_dump_json().encode("utf-8")
+    ).hexdigest()
+
+
+_plans: OrderedDict[tuple[str, str, str], MappingPlan] = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+def get_mapping_plan(mapping_rules: MappingRules) -> MappingPlan:
+    """
+    Get the compiled plan of the mapping rules, plans are cached by the rules
+    file name, version and fingerprint
+    :param mapping_rules: Mapping rules
+    :return: the plan, shared between callers
+    """
+    key = (
+        mapping_rules.meta_data.file_name,
+        mapping_rules.meta_data.version,
+        get_rules_fingerprint(mapping_rules),
+    )
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+    plan = MappingPlan(mapping_rules.rules)
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > MAPPING_PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
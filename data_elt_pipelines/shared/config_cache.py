@@ -0,0 +1,71 @@
+import boto3
+import logging
+import threading
+from botocore.exceptions import ClientError
+from typing import Any, Callable
+
+
+logger = logging.getLogger()
+
+
+class S3ObjectCache:
+    """
+    Process level cache of parsed S3 objects, e.g. field definitions and mapping rules.
+    Create it at module level so it survives warm lambda invocations. Every get still
+    revalidates with a conditional get_object using the stored ETag, so a changed
+    object is picked up straight away, an unchanged one costs a 304 without a body
+    and without parsing it again.
+    """
+
+    def __init__(self):
+        # (bucket, key) -> (etag, parsed object)
+        self._entries: dict[tuple[str, str], tuple[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        s3_client: boto3.client,
+        bucket: str,
+        key: str,
+        loader: Callable[[bytes], Any],
+    ) -> Any:
+        """
+        Get the parsed object, loading it when it is not cached or has changed
+        :param s3_client: s3 client
+        :param bucket: bucket
+        :param key: object key
+        :param loader: parses the object body
+        :return: the parsed object, shared between callers, don't change it
+        """
+        with self._lock:
+            entry = self._entries.get((bucket, key))
+        args = {"Bucket": bucket, "Key": key}
+        if entry:
+            args["IfNoneMatch"] = entry[0]
+        try:
+            response = s3_client.get_object(**args)
+        except ClientError as e:
+            if entry and is_not_modified(e):
+                logger.debug(f"{bucket}/{key} not modified, using cached object")
+                return entry[1]
+            raise
+
+        value = loader(response["Body"].read())
+        etag = response.get("ETag")
+        if etag:
+            with self._lock:
+                self._entries[(bucket, key)] = (etag, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def is_not_modified(error: ClientError) -> bool:
+    """
+    Check if a conditional get failed because the object has not been modified
+    """
+    status_code = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    code = str(error.response.get("Error", {}).get("Code"))
+    return status_code == 304 or code in ("304", "NotModified")
@@ -4,12 +4,22 @@ ISO8901_FORMAT = "%Y-%m-%dT%H:%M:%S"
 ISO8901_FORMAT_TZ = "%Y-%m-%dT%H:%M:%Sz"
 SFTP_CONFIG_OBJECT_KEY = "source_ingestion/ingestion_meta_data.json"
 MULTI_PART_FILE_CHUNK_SIZE = 10 * 1024 * 1024  # 10 MB
+STREAM_READ_BLOCK_SIZE = 8 * 1024 * 1024  # 8 MB
+# compressed text expands several times, read less of it at a time
+COMPRESSED_STREAM_READ_BLOCK_SIZE = 1 * 1024 * 1024  # 1 MB
+MULTI_PART_UPLOAD_PART_SIZE = 8 * 1024 * 1024  # 8 MB, s3 minimum is 5 MB
+CSV_SINK_FLUSH_SIZE = 1 * 1024 * 1024  # 1 MB
 MAXIMUM_FILE_SIZE_UNCOMPRESS = 100 * 1024 * 1024  # 100 MB
 MAXIMUM_FILE_SIZE_COMPRESSED = 10 * 1024 * 1024  # 10 MB for compressed file
 MAXIMUM_DATA_SIZE_LAMBDA = 1 * 1024 * 1024 * 1024  # 1GB
 DEFAULT_REGION = "eu-west-2"
 DEFAULT_MAX_DATA_CHUNK_SIZE = 20000
 DEFAULT_DATA_CHUNK_SIZE = 2500
+MAPPING_PLAN_CACHE_SIZE = 32
+HEADER_BINDING_CACHE_SIZE = 64
+DATE_CACHE_SIZE = 64 * 1024
+HASH_INDEX_PREFIX = "hash_index"
+DYNAMODB_BATCH_WRITE_SIZE = 25  # batch_write_item limit
 DEFAULT_GLUE_CAPACITY_DPU = 2
 GLUE_JOB_TIMEOUT_MINUTES = 120
 GLUE_JOB_MAX_RETRIES = 0
@@ -17,3 +27,6 @@ GLUE_JOB_MAX_RETRIES = 0
 S3_CONNECTION_POOL_CONFIG = Config(
     retries={"max_attempts": 10, "mode": "standard"}, max_pool_connections=50
 )
+
+# mapped chunks written to s3 at the same time by the schema transformation
+DEFAULT_CDM_UPLOAD_WORKERS = 2
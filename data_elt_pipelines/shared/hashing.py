@@ -0,0 +1,73 @@
+import base64
+import hashlib
+from enum import Enum
+from typing import Iterable, Sequence
+from shared.utils import hash as legacy_hash
+
+
+class HashAlgorithm(Enum):
+    """
+    legacy:  sha256 of the tuple repr of the row fields, urlsafe base64, every other
+             character, the values already stored in the hash column
+    blake2b: blake2b with a 16 byte digest of the utf-8 record, urlsafe base64
+             without padding, 22 characters like legacy
+    """
+    LEGACY = "legacy"
+    BLAKE2B = "blake2b"
+
+    @property
+    def hashes_record(self) -> bool:
+        """
+        True when the algorithm hashes the raw record instead of the row fields
+        """
+        return self != HashAlgorithm.LEGACY
+
+
+BLAKE2B_DIGEST_SIZE = 16
+
+
+def get_record_bytes(record: bytes | str) -> bytes:
+    """
+    Get the utf-8 bytes of a record, so a record hashes the same whether it was read
+    as bytes or decoded, invalid utf-8 is replaced as when the file is decoded
+    :param record: record as read from the file, without line ending
+    """
+    if isinstance(record, str):
+        return record.encode("utf-8")
+    if record.isascii():
+        return record
+    return record.decode("utf-8", errors="replace").encode("utf-8")
+
+
+def hash_many(
+    values: Iterable[bytes | str | Sequence[str]],
+    algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> list[str]:
+    """
+    Hash a batch of rows or records
+    :param values: row fields for legacy, raw records for the record algorithms
+    :param algorithm: The hash algorithm
+    :return: hashes in the same order as the values
+    """
+    algorithm = HashAlgorithm(algorithm)
+    if algorithm == HashAlgorithm.LEGACY:
+        return [legacy_hash(tuple(value)) for value in values]
+
+    blake2b = hashlib.blake2b
+    encode = base64.urlsafe_b64encode
+    return [
+        encode(blake2b(get_record_bytes(value), digest_size=BLAKE2B_DIGEST_SIZE).digest())
+        .rstrip(b"=")
+        .decode("ascii")
+        for value in values
+    ]
+
+
+def hash_one(
+    value: bytes | str | Sequence[str],
+    algorithm: HashAlgorithm = HashAlgorithm.LEGACY,
+) -> str:
+    """
+    Hash a single row or record, see hash_many
+    """
+    return hash_many((value,), algorithm)[0]
@@ -0,0 +1,427 @@
+import boto3
+import bz2
+import csv
+import io
+import json
+import logging
+import zlib
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import BinaryIO, Iterable, Iterator, Optional
+from shared.constants import (
+    MULTI_PART_UPLOAD_PART_SIZE,
+    CSV_SINK_FLUSH_SIZE,
+    STREAM_READ_BLOCK_SIZE,
+    COMPRESSED_STREAM_READ_BLOCK_SIZE,
+)
+from shared.content_type import ContentType
+
+
+logger = logging.getLogger()
+
+
+class S3MultipartWriter:
+    """
+    Write a stream of bytes to an S3 object, optionally bz2 compressed on the fly.
+    Data is buffered until a part is full and then uploaded as a part of a multipart
+    upload, so at most one part is held in memory. An object that never fills a part
+    is uploaded with a single put_object instead.
+    """
+
+    def __init__(
+        self,
+        s3_client: boto3.client,
+        bucket: str,
+        key: str,
+        metadata: Optional[dict[str, str]] = None,
+        content_type: ContentType = ContentType.CSV,
+        compress: bool = False,
+        part_size: int = MULTI_PART_UPLOAD_PART_SIZE,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.metadata = metadata or {}
+        self.content_type = content_type
+        self.compressor = bz2.BZ2Compressor() if compress else None
+        self.part_size = part_size
+        self.size = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._finished = False
+        self._closed = False
+        self._completed = False
+
+    def _object_args(self) -> dict[str, any]:
+        args = {
+            "Bucket": self.bucket,
+            "Key": self.key,
+            "Metadata": self.metadata,
+            "ContentType": self.content_type.value,
+        }
+        if self.compressor:
+            args["ContentEncoding"] = "bzip2"
+        return args
+
+    def _upload_part(self, data: bytes) -> None:
+        if not self._upload_id:
+            response = self.s3_client.create_multipart_upload(**self._object_args())
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self._upload_id,
+            Body=data,
+        )
+        self._parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        logger.debug(f"Uploaded {self.key} part: {part_number}")
+
+    def write(self, data: bytes) -> None:
+        """
+        Write data to the object, full parts are uploaded straight away
+        :param data: uncompressed data
+        """
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._upload_part(part)
+
+    def finish(self) -> None:
+        """
+        Flush the compressor and upload the buffer as the last part of a multipart
+        upload, nothing can be written after it. The object is created by close.
+        """
+        if self._finished:
+            return
+        if self.compressor:
+            data = self.compressor.flush()
+            self.size += len(data)
+            self._buffer += data
+        if self._upload_id and self._buffer:
+            self._upload_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._finished = True
+
+    def close(self) -> int:
+        """
+        Finish the writer and create the object, the upload is aborted if it
+        can't be completed
+        :return: size of the object in bytes
+        """
+        if self._closed:
+            return self.size
+        try:
+            self.finish()
+            if not self._upload_id:
+                self.s3_client.put_object(
+                    Body=bytes(self._buffer), **self._object_args()
+                )
+            else:
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts},
+                )
+        except Exception:
+            self.abort()
+            raise
+        self._buffer = bytearray()
+        self._closed = True
+        self._completed = True
+        logger.info(f"File {self.key} created successfully.")
+        return self.size
+
+    def abort(self) -> None:
+        """
+        Abort the multipart upload, uploaded parts are removed, a closed writer
+        is left as it is
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if not self._upload_id:
+            return
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+        except ClientError as e:
+            logger.error(f"Failed to abort upload of {self.key}, error: {str(e)}")
+
+    def delete(self) -> None:
+        """
+        Delete the object created by close, e.g. when an object written together
+        with it failed, a writer that wasn't closed is left as it is
+        """
+        if not self._completed:
+            return
+        self._completed = False
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            logger.error(f"Failed to delete {self.key}, error: {str(e)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+class CsvStreamSink:
+    """
+    Write csv rows to one or more S3MultipartWriter. Rows are formatted into a small
+    text buffer, which is encoded once and passed to every writer when it reaches
+    flush_size, so neither the csv text nor the compressed body is held as a whole.
+    With concurrent, every writer compresses and uploads in its own thread while
+    the next rows are formatted, a writer gets the next block once it has written
+    the previous one, so at most two blocks are held.
+    """
+
+    def __init__(
+        self,
+        writers: list[S3MultipartWriter],
+        fieldnames: Optional[list[str]] = None,
+        encoding: str = "utf-8",
+        flush_size: int = CSV_SINK_FLUSH_SIZE,
+        concurrent: bool = False,
+    ):
+        self.writers = writers
+        self.encoding = encoding
+        self.flush_size = flush_size
+        self._executor = (
+            ThreadPoolExecutor(max_workers=len(writers)) if concurrent else None
+        )
+        self._pending = []
+        self._buffer = io.StringIO()
+        if fieldnames:
+            self._writer = csv.DictWriter(self._buffer, fieldnames=fieldnames)
+            self._writer.writeheader()
+        else:
+            self._writer = csv.writer(self._buffer)
+
+    def _wait(self) -> None:
+        pending, self._pending = self._pending, []
+        # every writer is done before an error is raised, so none is still
+        # writing when the writers are aborted
+        wait(pending)
+        for future in pending:
+            future.result()
+
+    def _flush(self) -> None:
+        data = self._buffer.getvalue().encode(self.encoding)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        if not data:
+            return
+        if self._executor:
+            self._wait()
+            self._pending = [
+                self._executor.submit(writer.write, data) for writer in self.writers
+            ]
+        else:
+            for writer in self.writers:
+                writer.write(data)
+
+    def write(self, text: str) -> None:
+        """
+        Write already formatted csv text, e.g. the output of the fixed width parser
+        :param text: csv text
+        """
+        self._buffer.write(text)
+        if self._buffer.tell() >= self.flush_size:
+            self._flush()
+
+    def writerow(self, row: Iterable[any] | dict[str, any]) -> None:
+        """
+        Write a row, a dict when the sink has fieldnames
+        :param row: row
+        """
+        self._writer.writerow(row)
+        if self._buffer.tell() >= self.flush_size:
+            self._flush()
+
+    def writerows(self, rows: Iterable[Iterable[any] | dict[str, any]]) -> None:
+        for row in rows:
+            self.writerow(row)
+
+    def _call(self, method: str) -> list[any]:
+        if not self._executor:
+            return [getattr(writer, method)() for writer in self.writers]
+        futures = [
+            self._executor.submit(getattr(writer, method)) for writer in self.writers
+        ]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def close(self) -> list[int]:
+        """
+        Flush the buffer and close the writers. Every writer uploads its last
+        part before any object is created, if one of them fails the writers that
+        aren't closed yet are aborted and the objects already created are deleted
+        :return: size in bytes of each object
+        """
+        try:
+            self._flush()
+            if self._executor:
+                self._wait()
+            self._call("finish")
+            return self._call("close")
+        except Exception:
+            self.abort()
+            for writer in self.writers:
+                writer.delete()
+            raise
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+
+    def abort(self) -> None:
+        if self._executor:
+            # a writer still writing can't be aborted
+            wait(self._pending)
+            self._pending = []
+            self._executor.shutdown()
+        for writer in self.writers:
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+class DecompressingStream(io.RawIOBase):
+    """
+    Read a binary stream, e.g. the S3 StreamingBody, decompressing it on the fly.
+    Only the last block read and at most output_size bytes of decompressed data
+    are held in memory, however well the data compresses.
+    Concatenated bz2 streams and gzip members, as written by parallel
+    compressors, are read one after the other like the command line tools do.
+    """
+
+    def __init__(
+        self,
+        stream: BinaryIO,
+        content_encoding: Optional[str] = None,
+        block_size: Optional[int] = None,
+        output_size: int = STREAM_READ_BLOCK_SIZE,
+    ):
+        if content_encoding not in (None, "", "bzip2", "gzip"):
+            raise ValueError(
+                f"compression {content_encoding} is not supported, only bzip2 and gzip"
+            )
+        self.stream = stream
+        self.content_encoding = content_encoding or None
+        if block_size is None:
+            block_size = (
+                COMPRESSED_STREAM_READ_BLOCK_SIZE
+                if self.content_encoding
+                else STREAM_READ_BLOCK_SIZE
+            )
+        self.block_size = block_size
+        self.output_size = output_size
+        self._decompressor = self._new_decompressor()
+        self._buffer = b""
+        self._position = 0
+        self._eof = False
+
+    def _new_decompressor(self):
+        if self.content_encoding == "bzip2":
+            return bz2.BZ2Decompressor()
+        if self.content_encoding == "gzip":
+            return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        return None
+
+    def _fill(self) -> None:
+        decompressor = self._decompressor
+        if not decompressor:
+            block = self.stream.read(self.block_size)
+            self._eof = not block
+            self._buffer, self._position = block, 0
+            return
+        if decompressor.eof:
+            # the next stream starts in the unused data or in the next block
+            block = decompressor.unused_data or self.stream.read(self.block_size)
+            if not block:
+                self._eof = True
+                return
+            decompressor = self._decompressor = self._new_decompressor()
+        elif isinstance(decompressor, bz2.BZ2Decompressor):
+            # bz2 keeps the input it hasn't decompressed yet
+            block = b""
+            if decompressor.needs_input:
+                block = self.stream.read(self.block_size)
+        else:
+            # zlib hands the input it hasn't decompressed yet back
+            block = decompressor.unconsumed_tail or self.stream.read(self.block_size)
+        output = decompressor.decompress(block, max_length=self.output_size)
+        if not block and not output and not decompressor.eof:
+            raise EOFError("compressed stream ended before the end-of-stream marker")
+        self._buffer, self._position = output, 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self._position >= len(self._buffer):
+            if self._eof:
+                return 0
+            self._fill()
+        size = min(len(buffer), len(self._buffer) - self._position)
+        buffer[:size] = self._buffer[self._position : self._position + size]
+        self._position += size
+        return size
+
+
+def iter_source_rows(
+    stream: BinaryIO,
+    content_type: ContentType,
+    content_encoding: Optional[str] = None,
+    encoding: str = "utf-8",
+) -> Iterator[dict[str, any]]:
+    """
+    Read the rows of a csv or json lines object lazily, one row at a time.
+    The content type and encoding are checked straight away, before any row
+    is read.
+    :param stream: Binary stream, e.g. file_obj["Body"] from s3 get_object
+    :param content_type: csv or json lines
+    :param content_encoding: the ContentEncoding of the object, bzip2, gzip or None
+    :param encoding: Text encoding of the object
+    :return: a dict per csv row or json line
+    """
+    content_type = ContentType(content_type)
+    if content_type not in (ContentType.CSV, ContentType.Json_lines):
+        raise ValueError(f"unsupported content type: {content_type}")
+    text = io.TextIOWrapper(
+        io.BufferedReader(DecompressingStream(stream, content_encoding)),
+        encoding=encoding,
+        newline="",
+    )
+    return _read_rows(text, content_type)
+
+
+def _read_rows(
+    text: io.TextIOWrapper, content_type: ContentType
+) -> Iterator[dict[str, any]]:
+    if content_type == ContentType.CSV:
+        yield from csv.DictReader(text)
+    else:
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
@@ -4,9 +4,10 @@ from datetime import datetime, timezone
 import json
 import hashlib
 import os
+from functools import lru_cache
 from botocore.exceptions import ClientError
 from shared.param_models import FileParam, SFTPData
-from shared.constants import ISO8901_FORMAT, SFTP_CONFIG_OBJECT_KEY
+from shared.constants import DATE_CACHE_SIZE, ISO8901_FORMAT, SFTP_CONFIG_OBJECT_KEY
 from shared.content_type import ContentType
 
 
@@ -136,6 +137,44 @@ def get_timestamp_string(
         return datetime.strptime(timestamp, format)
 
 
+class DateValue(dict):
+    """
+    A mapped date {"value", "format", "python_date_format"} that carries whether
+    the value parsed with its python_date_format, so it isn't parsed again
+    when the rows are split into valid and invalid data. It serialises like
+    any other dict.
+    """
+    __slots__ = ("valid",)
+
+    def __init__(self, *args, valid: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.valid = valid
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_date(value: str, date_format: str) -> tuple[str, bool]:
+    try:
+        return datetime.strptime(value, date_format).strftime(date_format), True
+    except ValueError:
+        return value, False
+
+
+def parse_date(value: str, date_format: str) -> tuple[str, bool]:
+    """
+    Parse a date string and format it again with the same format, e.g. 132021
+    becomes 01032021 with %m%d%Y. Results are cached, registry dates repeat a lot.
+    :param value: date string
+    :param date_format: python date format
+    :return: the formatted date and True, the value and False if it doesn't parse
+    """
+    try:
+        return _parse_date(value, date_format)
+    except TypeError:
+        # not hashable, let strptime raise for it
+        datetime.strptime(value, date_format)
+        raise
+
+
 def is_date_string_valid(
     data: dict[str, any],
     format_name: str = "python_date_format",
@@ -161,6 +200,9 @@ def is_date_string_valid(
     if isinstance(data, str):
         data = json.loads(data)
     for _, record in data.items():
+        if isinstance(record, DateValue) and format_name == "python_date_format":
+            # validated when it was mapped
+            return record.valid
         try:
             value = record.get("value")
             format = record.get(format_name)  # e.g. "%m%d%Y", "%d %b %Y"
@@ -172,8 +214,7 @@ def is_date_string_valid(
             elif not value or not format:
                 return False
             else:
-                datetime.strptime(value, format)
-                return True
+                return parse_date(value, format)[1]
         except ValueError:
             return False
     return False
@@ -261,3 +302,17 @@ def get_target_s3_object_key(
         return f"{prefix}/{timestamp.year}/{timestamp.month}/{timestamp.day}/{sub_prefix}{original_filename}{index_token}_{suffix}.{format.get_short_name()}"
     else:
         return f"{prefix}/{timestamp.year}/{timestamp.month}/{timestamp.day}/{sub_prefix}{original_filename}{index_token}.{format.get_short_name()}"
+
+
+def is_chunk_object_key(object_key: str) -> bool:
+    """
+    Check if an object is one chunk of a file split by the parser, named as
+    get_target_s3_object_key names it with add_file_name_as_prefix and an index,
+    e.g. us_fl/2024/9/23/abc/abc_0.csv.bz2
+    :param object_key: object key
+    """
+    directory = os.path.basename(os.path.dirname(object_key))
+    filename = os.path.basename(object_key).split(".")[0]
+    if not directory or not filename.startswith(f"{directory}_"):
+        return False
+    return filename[len(directory) + 1 :].isdigit()
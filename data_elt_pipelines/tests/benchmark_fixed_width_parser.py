@@ -0,0 +1,144 @@
+#####################################
+# Benchmark the fixed width parser locally
+# python -m tests.benchmark_fixed_width_parser
+#####################################
+import argparse
+import json
+import statistics
+import time
+from raw_parsers.fixed_width_txt import (
+    ParserBackend,
+    extract_rows,
+    get_field_extractor,
+    normalize_string,
+    split_records,
+    write_csv,
+)
+from shared.hashing import HashAlgorithm
+
+
+def argument_parser():
+    """
+    Argument parser
+    :return: arguments
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the fixed width parser")
+    parser.add_argument(
+        "--input",
+        "-i",
+        type=str,
+        required=False,
+        default="tests/test_data/US_FL_20240923c.txt",
+        help="Fixed width text file",
+    )
+    parser.add_argument(
+        "--field_def",
+        "-f",
+        type=str,
+        required=False,
+        default="../config/fixed_width_field_def/us_fl.json",
+        help="Fixed width field definition",
+    )
+    parser.add_argument(
+        "--repeat", "-r", type=int, required=False, default=9, help="Repeat count"
+    )
+    parser.add_argument(
+        "--copies",
+        "-c",
+        type=int,
+        required=False,
+        default=20,
+        help="Copies of the input, the 2k row sample is too small to time reliably",
+    )
+    return parser.parse_args()
+
+
+def slicing_loop(lines: list[str], mapping: dict[str, any]) -> None:
+    """
+    The per field slicing loop the parser used before the compiled extractor
+    """
+    field_positions = [
+        (field["start"] - 1, field["end"]) for field in mapping["fields"]
+    ]
+    for line in lines:
+        line = normalize_string(line)
+        _ = [line[start:end].strip() for start, end in field_positions]
+
+
+def compiled_extractor(lines: list[str], mapping: dict[str, any]) -> None:
+    extract = get_field_extractor(mapping)
+    for line in lines:
+        _ = extract(normalize_string(line))
+
+
+def decoded_lines(content: bytes, mapping: dict[str, any]) -> None:
+    """
+    Decode and split the raw content, then cut it with the compiled extractor
+    """
+    compiled_extractor(content.decode("utf-8", errors="replace").splitlines(), mapping)
+
+
+def bytes_records(content: bytes, mapping: dict[str, any]) -> None:
+    """
+    Split the raw content into records and cut them with the bytes backend
+    """
+    for _ in extract_rows(split_records(content), mapping, ParserBackend.BYTES):
+        pass
+
+
+def csv_with_hash(lines: list[str], mapping: dict[str, any]) -> None:
+    write_csv(lines, mapping, add_hash=True)
+
+
+def csv_with_record_hash(lines: list[str], mapping: dict[str, any]) -> None:
+    write_csv(lines, mapping, add_hash=True, hash_algorithm=HashAlgorithm.BLAKE2B)
+
+
+def csv_without_hash(lines: list[str], mapping: dict[str, any]) -> None:
+    write_csv(lines, mapping, add_hash=False)
+
+
+def run(
+    name: str,
+    func: callable,
+    data: list[str] | bytes,
+    mapping: dict,
+    repeat: int,
+    rows: int,
+):
+    rates = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data, mapping)
+        rates.append(rows / (time.perf_counter() - start))
+    # the median and the spread, a single best run hides the noise
+    print(
+        f"{name:<24} {statistics.median(rates):>12,.0f} rows/s"
+        f"  ({min(rates):,.0f} - {max(rates):,.0f})"
+    )
+
+
+def main():
+    args = argument_parser()
+    with open(args.field_def, "r") as f:
+        mapping = json.load(f)
+    with open(args.input, "rb") as f:
+        content = f.read()
+    if not content.endswith(b"\n"):
+        content += b"\n"
+    content *= args.copies
+    lines = content.decode("utf-8", errors="replace").splitlines()
+    rows = len(lines)
+
+    print(f"{rows} rows, {len(mapping['fields'])} fields, median of {args.repeat}")
+    run("slicing loop", slicing_loop, lines, mapping, args.repeat, rows)
+    run("compiled extractor", compiled_extractor, lines, mapping, args.repeat, rows)
+    run("decode + extractor", decoded_lines, content, mapping, args.repeat, rows)
+    run("bytes records", bytes_records, content, mapping, args.repeat, rows)
+    run("csv (no hash)", csv_without_hash, lines, mapping, args.repeat, rows)
+    run("csv (with hash)", csv_with_hash, lines, mapping, args.repeat, rows)
+    run("csv (blake2b hash)", csv_with_record_hash, lines, mapping, args.repeat, rows)
+
+
+if __name__ == "__main__":
+    main()
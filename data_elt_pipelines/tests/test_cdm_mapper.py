@@ -1,9 +1,14 @@
 import csv
+import io
 import json
+import pytest
+from datetime import datetime
 import schema_transformation.cdm_mapper as cdm_mapper
 from schema_transformation.cdm_mapping_rule import MappingRule, MappingRules
 from shared.cdm_company import OrderedEnum
 from shared.metadata import CdmFileMetaData
+from schema_transformation.mapping_plan import get_mapping_plan
+from shared.utils import is_date_string_valid
 
 
 def test_get_dummy_cdm_model():
@@ -1349,3 +1354,224 @@ def test_get_date_fields_with_duplicated_fields():
     expected = ["incorporation_date", "dissolution_date", "file_date"]
     result = cdm_mapper.get_date_fields(mapping_rules)
     assert sorted(result) == sorted(expected), f"Expected {expected}, but got {result}"
+
+
+@pytest.mark.parametrize("executor", ["inline", "thread", "process"])
+def test_schema_transformation_executors(executor):
+    mapping_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    with open("tests/test_data/us_fl_source_small.csv", "r") as f:
+        data = list(csv.DictReader(f))
+    expected = cdm_mapper.do_transform(data, mapping_rules, meta_data)
+    if executor == "process":
+        # compact rows by default, sent back with marshal instead of pickle
+        fields = cdm_mapper.get_row_fields(meta_data)
+        expected = [cdm_mapper.to_compact_row(row, fields) for row in expected]
+
+    chunks = dict(
+        (index, result)
+        for result, index in cdm_mapper.schema_transformation(
+            data,
+            mapping_rules,
+            meta_data,
+            chunk_size=3,
+            executor=executor,
+            workers=2,
+        )
+    )
+    assert sorted(chunks) == list(range(len(chunks)))
+    assert [row for index in sorted(chunks) for row in chunks[index]] == expected
+
+
+@pytest.mark.parametrize("executor", ["inline", "thread", "process"])
+def test_schema_transformation_partitioned(executor):
+    mapping_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    with open("tests/test_data/us_fl_source_small.csv", "r") as f:
+        row = next(csv.DictReader(f))
+    data = [
+        {**row, "COR_NUMBER": str(i), "COR_FILE_DATE": date}
+        for i, date in enumerate(["132021", "13402021", "01022021", "", "x"])
+    ]
+    date_fields = cdm_mapper.get_date_fields(mapping_rules)
+    expected = cdm_mapper.do_transform(data, mapping_rules, meta_data)
+
+    chunks = dict(
+        (index, result)
+        for result, index in cdm_mapper.schema_transformation(
+            data,
+            mapping_rules,
+            meta_data,
+            chunk_size=3,
+            executor=executor,
+            workers=2,
+            partition=True,
+            row_format="dict",
+        )
+    )
+    valid = [row for index in sorted(chunks) for row in chunks[index][0]]
+    invalid = [row for index in sorted(chunks) for row in chunks[index][1]]
+    invalid_fields = [field for index in sorted(chunks) for field in chunks[index][2]]
+    assert valid == [
+        row
+        for row in expected
+        if all(
+            is_date_string_valid(row[field], no_data_ok=True) for field in date_fields
+        )
+    ]
+    assert invalid == [expected[1], expected[4]]
+    assert invalid_fields == ["incorporation_date", "incorporation_date"]
+
+
+def test_get_invalid_date_field():
+    mapping_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    plan = get_mapping_plan(mapping_rules)
+    record = cdm_mapper.do_transform(
+        [{"COR_NUMBER": "1", "COR_FILE_DATE": ""}], mapping_rules, meta_data
+    )[0]
+    assert cdm_mapper.get_invalid_date_field(record, plan.date_fields) is None
+    assert (
+        cdm_mapper.get_invalid_date_field(record, plan.date_fields, no_data_ok=False)
+        == plan.date_fields[0]
+    )
+
+
+@pytest.mark.parametrize("executor", ["inline", "process"])
+def test_compact_rows(executor):
+    mapping_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    with open("tests/test_data/us_fl_source_small.csv", "r") as f:
+        data = list(csv.DictReader(f))
+    data.append({"COR_NUMBER": "2", "COR_NAME": "Café", "COR_FILE_DATE": "x"})
+    model_meta_data = meta_data.model_copy(update={"fetched_at": datetime(2024, 1, 2)})
+    expected = cdm_mapper.do_transform(data, mapping_rules, model_meta_data)
+    fields = cdm_mapper.get_row_fields(model_meta_data)
+    assert fields == tuple(expected[0])
+
+    (valid, invalid, _), _ = next(
+        cdm_mapper.schema_transformation(
+            data,
+            mapping_rules,
+            model_meta_data,
+            executor=executor,
+            partition=True,
+            row_format="compact",
+        )
+    )
+    assert all(isinstance(row, tuple) for row in valid + invalid)
+    # written as save_csv writes dict records
+    dict_csv, compact_csv = io.StringIO(), io.StringIO()
+    writer = csv.DictWriter(dict_csv, fieldnames=fields)
+    writer.writeheader()
+    for row in expected:
+        writer.writerow(
+            {key: cdm_mapper.get_csv_value(value) for key, value in row.items()}
+        )
+    writer = csv.writer(compact_csv)
+    writer.writerow(fields)
+    writer.writerows(valid + invalid)
+    assert compact_csv.getvalue() == dict_csv.getvalue()
+    assert "Café" in compact_csv.getvalue()
+    assert "2024-01-02T00:00:00" in compact_csv.getvalue()
+
+    with pytest.raises(ValueError, match="not in the cdm model"):
+        cdm_mapper.to_compact_row({**expected[0], "other": 1}, fields)
+
+
+def test_serialize_chunk():
+    model = [{"name": "a", "officers": {"1": {"name": "b"}}, "hash": None}]
+    assert cdm_mapper.deserialize_chunk(cdm_mapper.serialize_chunk(model)) == model
+    model = [{"fetched_at": datetime(2024, 1, 2)}]
+    assert cdm_mapper.deserialize_chunk(cdm_mapper.serialize_chunk(model)) == model
+
+
+def to_columns(data: list[dict]) -> dict[str, list]:
+    return {key: [row[key] for row in data] for key in data[0]}
+
+
+def test_do_transform_columnar():
+    us_fl_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    with open("tests/test_data/us_fl_source_small.csv", "r") as f:
+        data = list(csv.DictReader(f))
+    data.append({key: "" for key in data[0]})
+    expected = cdm_mapper.do_transform(data, us_fl_rules, meta_data)
+    result = cdm_mapper.do_transform_columnar(to_columns(data), us_fl_rules, meta_data)
+    assert [json.dumps(row) for row in result] == [json.dumps(row) for row in expected]
+
+    data = [
+        {"RA_NAME": "Formation Inc", "RA_NAME_TYPE": "Organization", "PRINC1_NAME": None},
+        {"RA_NAME": "", "RA_NAME_TYPE": None, "PRINC1_NAME": "John Doe"},
+    ]
+    expected = cdm_mapper.do_transform(data, mapping_rules, meta_data)
+    result = cdm_mapper.do_transform_columnar(to_columns(data), mapping_rules, meta_data)
+    assert result == expected
+
+
+def test_do_transform_columnar_arrow_table():
+    pa = pytest.importorskip("pyarrow")
+    us_fl_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    with open("tests/test_data/us_fl_source_small.csv", "r") as f:
+        data = list(csv.DictReader(f))
+    expected = cdm_mapper.do_transform(data, us_fl_rules, meta_data)
+    table = pa.Table.from_pylist(data)
+    assert cdm_mapper.do_transform_columnar(table, us_fl_rules, meta_data) == expected
+
+
+def test_get_cdm_template():
+    test_meta_data = meta_data.model_copy()
+    test_meta_data.fetched_file = "test_file"
+    new_record = cdm_mapper.get_cdm_template(test_meta_data)
+    first, second = new_record(), new_record()
+    assert first == cdm_mapper.get_dummy_cdm_model(test_meta_data)
+    assert first["source_name"] == "test_file"
+    assert cdm_mapper.is_metadata_set(first, test_meta_data)
+    first["officers"] = {"1": {"name": "a"}}
+    assert second["officers"] is None
+    with pytest.raises(ValueError):
+        cdm_mapper.get_cdm_template(None)
+
+
+@pytest.mark.parametrize("order", ["completed", "index"])
+@pytest.mark.parametrize("executor", ["inline", "thread", "process"])
+def test_schema_transformation_bounded_in_flight(executor, order):
+    mapping_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    with open("tests/test_data/us_fl_source_small.csv", "r") as f:
+        row = next(csv.DictReader(f))
+    rows_read = 0
+
+    def read_rows():
+        nonlocal rows_read
+        for i in range(20):
+            rows_read += 1
+            yield {**row, "COR_NUMBER": str(i)}
+
+    chunks = []
+    for result, index in cdm_mapper.schema_transformation(
+        read_rows(),
+        mapping_rules,
+        meta_data,
+        chunk_size=2,
+        executor=executor,
+        workers=2,
+        max_in_flight=3,
+        order=order,
+        row_format="dict",
+    ):
+        # the rows of at most 3 chunks are read ahead of the results taken
+        assert rows_read <= (len(chunks) + 3) * 2
+        chunks.append((index, [record["company_number"] for record in result]))
+
+    if order == "index":
+        assert [index for index, _ in chunks] == list(range(10))
+    assert sorted(chunks) == [(i, [str(i * 2), str(i * 2 + 1)]) for i in range(10)]
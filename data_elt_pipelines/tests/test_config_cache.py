@@ -0,0 +1,52 @@
+import json
+import pytest
+from io import BytesIO
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+from shared.config_cache import S3ObjectCache
+
+
+def get_object_response(data: dict, etag: str) -> dict:
+    return {"Body": BytesIO(json.dumps(data).encode("utf-8")), "ETag": etag}
+
+
+def not_modified_error() -> ClientError:
+    return ClientError(
+        {
+            "Error": {"Code": "304", "Message": "Not Modified"},
+            "ResponseMetadata": {"HTTPStatusCode": 304},
+        },
+        "GetObject",
+    )
+
+
+def test_cache_revalidates_with_etag():
+    s3_client = MagicMock()
+    s3_client.get_object.side_effect = [
+        get_object_response({"version": 1}, '"etag-1"'),
+        not_modified_error(),
+        get_object_response({"version": 2}, '"etag-2"'),
+    ]
+    loader = MagicMock(side_effect=lambda body: json.loads(body))
+    cache = S3ObjectCache()
+
+    first = cache.get(s3_client, "bucket", "key.json", loader)
+    assert first == {"version": 1}
+    assert cache.get(s3_client, "bucket", "key.json", loader) is first
+    assert cache.get(s3_client, "bucket", "key.json", loader) == {"version": 2}
+
+    assert loader.call_count == 2
+    calls = [call.kwargs for call in s3_client.get_object.call_args_list]
+    assert calls[0] == {"Bucket": "bucket", "Key": "key.json"}
+    assert calls[1]["IfNoneMatch"] == '"etag-1"'
+    assert calls[2]["IfNoneMatch"] == '"etag-1"'
+
+
+def test_cache_raises_other_errors():
+    s3_client = MagicMock()
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}, "ResponseMetadata": {"HTTPStatusCode": 404}},
+        "GetObject",
+    )
+    with pytest.raises(ClientError):
+        S3ObjectCache().get(s3_client, "bucket", "key.json", json.loads)
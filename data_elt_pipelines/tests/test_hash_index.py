@@ -0,0 +1,146 @@
+import json
+import pytest
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+from schema_transformation.cdm_mapping_rule import MappingRules
+from schema_transformation.hash_index import (
+    DynamoHashIndex,
+    FileHashIndex,
+    IncrementalRun,
+    LocalHashIndex,
+    HashIndex,
+    S3HashIndex,
+    get_index_name,
+    get_key_field,
+    get_row_hash,
+)
+
+
+def get_rows(*rows: tuple[str, str, str]) -> list[dict]:
+    return [
+        {"COR_NUMBER": key, "COR_NAME": name, "hash": row_hash}
+        for key, name, row_hash in rows
+    ]
+
+
+def test_get_key_field():
+    mapping_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    assert get_key_field(mapping_rules) == "COR_NUMBER"
+
+
+def test_get_row_hash():
+    assert get_row_hash({"COR_NUMBER": "1", "hash": "abc"}) == "abc"
+    row = {"COR_NUMBER": "1", "COR_NAME": "A"}
+    assert get_row_hash(row) == get_row_hash(dict(row))
+    assert get_row_hash(row) != get_row_hash({**row, "COR_NAME": "B"})
+
+
+def test_incremental_run(tmp_path):
+    hash_index = LocalHashIndex(str(tmp_path), "us_fl/cor")
+    run = IncrementalRun(hash_index, "COR_NUMBER")
+    first = get_rows(("1", "A", "h1"), ("2", "B", "h2"), ("3", "C", "h3"))
+    assert list(run.filter(first)) == first
+    assert run.removed_keys == []
+    run.commit()
+
+    # not committed, mapped again by the next run
+    run = IncrementalRun(hash_index, "COR_NUMBER")
+    second = get_rows(("1", "A", "h1"), ("2", "B2", "h2b"), ("4", "D", "h4"))
+    assert list(run.filter(second)) == second[1:]
+    assert run.removed_keys == ["3"]
+
+    run = IncrementalRun(hash_index, "COR_NUMBER")
+    assert list(run.filter(second)) == second[1:]
+    run.commit()
+    assert hash_index.load() == {"1": "h1", "2": "h2b", "4": "h4"}
+
+    run = IncrementalRun(hash_index, "COR_NUMBER")
+    assert list(run.filter(second)) == []
+    assert run.removed_keys == []
+
+
+def test_incremental_run_with_duplicated_keys(tmp_path):
+    hash_index = LocalHashIndex(str(tmp_path), "us_fl")
+    run = IncrementalRun(hash_index, "COR_NUMBER")
+    rows = get_rows(("1", "A", "h1"), ("1", "A2", "h1b"), ("", "X", "hx"))
+    assert list(run.filter(rows)) == rows
+    run.commit()
+    assert hash_index.load() == {"1": "h1 h1b"}
+
+    run = IncrementalRun(hash_index, "COR_NUMBER")
+    # rows without a key are always mapped
+    assert list(run.filter(rows)) == rows[2:]
+    assert run.changed == {}
+
+    # a key losing one of its rows maps nothing but its hashes are saved
+    run = IncrementalRun(hash_index, "COR_NUMBER")
+    assert list(run.filter(rows[:1])) == []
+    assert run.changed == {"1": "h1"}
+    run.commit()
+    assert hash_index.load() == {"1": "h1"}
+
+
+def test_get_index_name():
+    # the same index for the snapshots of every day
+    assert get_index_name("us_fl", "cor/2024/10/12/US_FL_20241012.csv.bz2") == (
+        "us_fl/cor"
+    )
+    assert get_index_name("us_fl", "cor/2024/10/13/US_FL_20241013.csv.bz2") == (
+        "us_fl/cor"
+    )
+    assert get_index_name(
+        "us_fl", "cor/2024/10/12/cordata0_20241012.csv.bz2", "cordata0"
+    ) == "us_fl/cor/cordata0"
+    with pytest.raises(TypeError):
+        HashIndex()
+
+
+def test_s3_hash_index():
+    s3_client = MagicMock()
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+    )
+    hash_index = S3HashIndex(s3_client, "bucket", "us_fl/cor")
+    assert hash_index.load() == {}
+
+    hash_index.save({"1": "h1", "2,b": "h2"}, {}, [])
+    args = s3_client.put_object.call_args.kwargs
+    assert args["Key"] == "hash_index/us_fl/cor.csv.gz"
+    assert FileHashIndex.from_bytes(args["Body"]) == {"1": "h1", "2,b": "h2"}
+
+    s3_client.get_object.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "GetObject"
+    )
+    with pytest.raises(ClientError):
+        hash_index.load()
+
+
+def test_dynamo_hash_index():
+    dynamodb = MagicMock()
+    dynamodb.get_paginator.return_value.paginate.return_value = [
+        {"Items": [{"row_key": {"S": "1"}, "row_hash": {"S": "h1"}}]},
+        {"Items": [{"row_key": {"S": "2"}, "row_hash": {"S": "h2"}}]},
+    ]
+    unprocessed = {"DeleteRequest": {"Key": {}}}
+    dynamodb.batch_write_item.side_effect = [
+        {"UnprocessedItems": {"table": [unprocessed]}},
+        {},
+        {},
+    ]
+    hash_index = DynamoHashIndex(dynamodb, "table", "us_fl")
+    assert hash_index.load() == {"1": "h1", "2": "h2"}
+
+    changed = {str(i): f"h{i}" for i in range(30)}
+    hash_index.save(changed, changed, ["x"])
+    batches = [
+        call.kwargs["RequestItems"]["table"]
+        for call in dynamodb.batch_write_item.call_args_list
+    ]
+    # unprocessed items are written again before the next batch
+    assert [len(batch) for batch in batches] == [25, 1, 6]
+    assert batches[1] == [unprocessed]
+    assert batches[2][-1] == {
+        "DeleteRequest": {"Key": {"index_name": {"S": "us_fl"}, "row_key": {"S": "x"}}}
+    }
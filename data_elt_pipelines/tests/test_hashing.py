@@ -0,0 +1,25 @@
+from shared.hashing import HashAlgorithm, hash_many, hash_one
+from shared.utils import hash
+
+
+def test_legacy_hash_matches_stored_values():
+    rows = [["a", "b", ""], ("1", "2", "3")]
+    assert hash_many(rows) == [hash(("a", "b", "")), hash(("1", "2", "3"))]
+    assert hash_one(["a", "b", ""], "legacy") == hash(("a", "b", ""))
+
+
+def test_blake2b_hashes_records():
+    records = [b"abc  def", "abc  def", b"abc def", "café", b"caf\xc3\xa9"]
+    hashes = hash_many(records, HashAlgorithm.BLAKE2B)
+    assert all(len(value) == 22 for value in hashes)
+    assert hashes[0] == hashes[1]
+    assert hashes[0] != hashes[2]
+    assert hashes[3] == hashes[4]
+
+
+def test_blake2b_invalid_bytes_same_as_decoded_record():
+    record = b"abc\xff"
+    decoded = record.decode("utf-8", errors="replace")
+    assert hash_one(record, HashAlgorithm.BLAKE2B) == hash_one(
+        decoded, HashAlgorithm.BLAKE2B
+    )
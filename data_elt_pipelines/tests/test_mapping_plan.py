@@ -0,0 +1,201 @@
+import json
+import pytest
+from schema_transformation import cdm_mapper
+from schema_transformation.cdm_mapping_rule import MappingRule, MappingRules
+from schema_transformation.mapping_plan import (
+    MappingPlan,
+    RegexMatcher,
+    get_mapping_plan,
+)
+from shared.metadata import CdmFileMetaData
+
+
+def load_rules() -> MappingRules:
+    return MappingRules(**json.load(open("tests/test_data/cdm_mapping_us_fl.json")))
+
+
+def test_mapping_rules_are_not_changed():
+    mapping_rules = load_rules()
+    before = mapping_rules.model_dump()
+    data = [
+        {"COR_NUMBER": "1", "PRINC2_NAME": "Jane Doe", "COR_MAIL_CITY": "Miami"},
+        {"COR_NUMBER": "2", "RA_NAME": "Agent Inc", "RA_NAME_TYPE": "C"},
+    ]
+    cdm_mapper.do_transform(data, mapping_rules, CdmFileMetaData())
+    assert mapping_rules.model_dump() == before
+
+
+def test_rows_do_not_depend_on_earlier_rows():
+    mapping_rules = load_rules()
+    data = [
+        {"COR_NUMBER": "1", "PRINC2_NAME": "Jane Doe", "PRINC2_TYPE": "P"},
+        {"COR_NUMBER": "2", "PRINC1_TYPE": "C", "PRINC1_NAME": "John Doe"},
+    ]
+    together = cdm_mapper.do_transform(data, mapping_rules, CdmFileMetaData())
+    alone = [
+        cdm_mapper.do_transform([row], mapping_rules, CdmFileMetaData())[0]
+        for row in data
+    ]
+    assert together == alone
+    assert together[0]["officers"]["2"] == {
+        "name": "Jane Doe",
+        "other_attributes": {"type": "P"},
+    }
+    assert together[1]["officers"]["1"] == {
+        "other_attributes": {"type": "C"},
+        "name": "John Doe",
+    }
+
+
+def test_get_mapping_plan_is_cached_by_content():
+    mapping_rules = load_rules()
+    plan = get_mapping_plan(mapping_rules)
+    assert get_mapping_plan(load_rules()) is plan
+
+    mapping_rules.rules["name"].source_field = "COR_NAME_2"
+    changed = get_mapping_plan(mapping_rules)
+    assert changed is not plan
+    assert changed.get_column_rules("COR_NAME_2")[0].cdm_field == "name"
+    assert not plan.get_column_rules("COR_NAME_2")
+
+
+def test_rules_with_the_same_pattern():
+    mapping_rules = load_rules()
+    with pytest.raises(KeyError, match="have the same pattern"):
+        MappingPlan(
+            {
+                **mapping_rules.rules,
+                "princ_name_2": mapping_rules.rules["princ_name"].model_copy(
+                    update={"cdm_field": "full_name"}
+                ),
+            }
+        )
+
+
+def test_column_matching_several_rules():
+    mapping_rules = load_rules()
+    plan = MappingPlan(
+        {
+            **mapping_rules.rules,
+            "princ_full_name": mapping_rules.rules["princ_name"].model_copy(
+                update={"cdm_field": "full_name", "pattern": "PRINC(\\d)_"}
+            ),
+        }
+    )
+    record = cdm_mapper.get_dummy_cdm_model()
+    # rejected for the header, before any value is mapped
+    with pytest.raises(KeyError, match="PRINC1_NAME matches more than one rule"):
+        cdm_mapper.apply_mapping_plan({"PRINC1_NAME": ""}, record, plan)
+
+
+def test_regex_matcher():
+    rules = tuple(
+        MappingRule(cdm_field=field, pattern=pattern, strategy="regex")
+        for field, pattern in [
+            ("name", "PRINC(\\d)_NAME"),
+            ("type", "PRINC(\\d)_TYPE"),
+            ("city", "(RA_)CITY"),
+            ("any", "RA_.*"),
+            ("same", "(?P<x>A)(?P=x)"),
+        ]
+    )
+    matcher = RegexMatcher(rules)
+    assert matcher.match("PRINC3_TYPE") == (1, "3")
+    assert matcher.match("FILLER") is None
+    assert [
+        (rule.cdm_field, label) for rule, label in matcher.match_all("RA_CITY")
+    ] == [("city", "RA_"), ("any", None)]
+    assert matcher.match("AA") == (4, "A")
+
+    # not combined, matched one by one
+    matcher = RegexMatcher(rules + (MappingRule(cdm_field="b", pattern="(B)\\1"),))
+    assert matcher.match("PRINC3_TYPE") == (1, "3")
+    assert matcher.match("BB") == (5, "B")
+
+
+def test_bind_header():
+    plan = get_mapping_plan(load_rules())
+    header = ("COR_NUMBER", "FILLER", "PRINC1_NAME", "COR_MAIL_CITY")
+    binding = plan.bind_header(header)
+    assert plan.bind_header(tuple(header)) is binding
+    assert [column for column, _ in binding] == list(header)
+    assert [[rule.cdm_field for rule in rules] for _, rules in binding] == [
+        ["company_number"],
+        [],
+        ["name"],
+        ["locality"],
+    ]
+
+
+def test_literals_for_row_with_unmapped_columns_only():
+    mapping_rules = load_rules()
+    data = [{"FILLER": "x", "COR_NUMBER": ""}, {"FILLER": "", "COR_NUMBER": ""}]
+    result = cdm_mapper.do_transform(data, mapping_rules, CdmFileMetaData())
+    assert result[0]["jurisdiction_code"] == "us_fl"
+    assert result[0]["all_attributes"] == {"identifier_system_code": "us_fein"}
+    assert result[1]["jurisdiction_code"] is None
+
+
+def test_resolve_literals():
+    plan = get_mapping_plan(load_rules())
+    header = ("COR_NUMBER", "RA_NAME", "PRINC1_NAME", "FILLER")
+    model_keys = tuple(cdm_mapper.get_dummy_cdm_model(CdmFileMetaData()))
+    literal_values, column_literals = plan.resolve_literals(header, model_keys)
+    assert set(literal_values) == {
+        (None, "jurisdiction_code", "us_fl"),
+        ("all_attributes", "identifier_system_code", "us_fein"),
+    }
+    # the position literal of the RA_ group only after the column creating it
+    assert [[name for name, _ in literals] for literals in column_literals] == [
+        [],
+        ["ra_position"],
+        [],
+        [],
+    ]
+    assert plan.resolve_literals(header, model_keys) is not None
+
+
+def test_literals_not_resolved():
+    mapping_rules = load_rules()
+    rules = {
+        **mapping_rules.rules,
+        "nested_literal": MappingRule(
+            cdm_field="other_attributes", strategy="literal", literal_value="x"
+        ),
+    }
+    plan = MappingPlan(rules)
+    model_keys = tuple(cdm_mapper.get_dummy_cdm_model(CdmFileMetaData()))
+    assert plan.resolve_literals(("COR_NUMBER",), model_keys) is None
+
+    # searched for after every column as before
+    record = cdm_mapper.get_dummy_cdm_model(CdmFileMetaData())
+    cdm_mapper.apply_mapping_plan(
+        {"COR_NUMBER": "1", "PRINC1_NAME": "Jane Doe"}, record, plan
+    )
+    assert record["company_number"] == "1"
+    assert record["jurisdiction_code"] == "us_fl"
+    assert record["all_attributes"] == {"identifier_system_code": "us_fein"}
+
+
+def test_literal_overwrites_mapped_value():
+    mapping_rules = load_rules()
+    rules = {
+        **mapping_rules.rules,
+        "fein_system": MappingRule(
+            source_field="FEIN_SYSTEM",
+            cdm_parent="all_attributes",
+            cdm_field="identifier_system_code",
+            strategy="add",
+        ),
+    }
+    plan = MappingPlan(rules)
+    data = [
+        {"FEIN_SYSTEM": "other", "COR_NUMBER": "1", "RA_NAME": "Agent Inc"},
+        {"COR_NUMBER": "2", "FEIN_SYSTEM": "other"},
+    ]
+    result = cdm_mapper.map_rows(data, plan, CdmFileMetaData())
+    assert [row["all_attributes"] for row in result] == [
+        {"identifier_system_code": "us_fein"},
+        {"identifier_system_code": "us_fein"},
+    ]
+    assert result[0]["officers"]["RA_"] == {"name": "Agent Inc", "position": "agent"}
@@ -1,7 +1,22 @@
+import bz2
 import csv
 import json
-from io import StringIO
-from raw_parsers.fixed_width_txt import parse, normalize_string, parse_chunks
+import pytest
+from io import BytesIO, StringIO
+from raw_parsers.fixed_width_txt import (
+    parse,
+    normalize_string,
+    parse_chunks,
+    parse_stream,
+    iter_lines,
+    get_field_extractor,
+    extract_rows,
+    ParserBackend,
+    parse_bytes,
+    iter_records,
+    split_records,
+    parse_stream_rows,
+)
 
 
 def test_parser_with_valid_data():
@@ -167,3 +182,167 @@ def test_parse_chunks_no_hash():
     csv_data, index = chunks[0]
     assert index == 0
     assert csv_data.getvalue() == "field1,field2\r\n12345,67890\r\n09876,54321\r\n"
+
+
+def test_iter_lines_across_blocks():
+    content = "ab\u00e9c\r\nde\rf\n\ng\r\nh"
+    stream = BytesIO(content.encode("utf-8"))
+    # a tiny block size splits both the multi-byte character and the "\r\n" pair
+    lines = list(iter_lines(stream, block_size=3))
+    assert lines == content.splitlines()
+
+
+def test_iter_lines_invalid_bytes_replaced():
+    stream = BytesIO(b"abc\xffdef\nxyz\n")
+    lines = list(iter_lines(stream, block_size=2))
+    assert lines == b"abc\xffdef\nxyz\n".decode("utf-8", errors="replace").splitlines()
+
+
+def test_parse_stream_same_as_parse_chunks():
+    input_data_file = "tests/test_data/US_FL_20240923c.txt"
+    field_def = "../config/fixed_width_field_def/us_fl.json"
+    with open(field_def, "r") as f:
+        mapping = json.load(f)
+    with open(input_data_file, "rb") as f:
+        raw = f.read()
+
+    expected = list(
+        parse_chunks(
+            StringIO(raw.decode("utf-8", errors="replace")), mapping, chunk_size=500
+        )
+    )
+    result = list(
+        parse_stream(BytesIO(raw), mapping, chunk_size=500, block_size=64 * 1024)
+    )
+    assert len(result) == len(expected) == 5
+    for (csv_data, index), (expected_csv, expected_index) in zip(result, expected):
+        assert index == expected_index
+        assert csv_data.getvalue() == expected_csv.getvalue()
+
+
+def test_parse_stream_empty_input():
+    mapping = {"fields": [{"name": "field1", "start": 1, "end": 5}]}
+    assert list(parse_stream(BytesIO(b""), mapping)) == []
+
+
+def test_field_extractor_matches_slicing():
+    mapping = {
+        "meta_data": {"file_name": "test_def", "version": "1"},
+        "fields": [
+            {"name": "field1", "start": 1, "end": 5},
+            {"name": "field2", "start": 6, "end": 10},
+            {"name": "field3", "start": 11, "end": 14},
+        ],
+    }
+    extract = get_field_extractor(mapping)
+    for line in ["12345 7890abc", "  1   2", ""]:
+        expected = [line[0:5].strip(), line[5:10].strip(), line[10:14].strip()]
+        assert extract(line) == expected
+    # compiled once per definition
+    assert get_field_extractor(mapping) is extract
+
+
+def test_field_extractor_single_field():
+    mapping = {"fields": [{"name": "field1", "start": 2, "end": 4}]}
+    assert get_field_extractor(mapping)(" abcd") == ["abc"]
+
+
+def test_parse_bytes_same_as_parse():
+    field_def = "../config/fixed_width_field_def/us_fl.json"
+    with open(field_def, "r") as f:
+        mapping = json.load(f)
+    with open("tests/test_data/US_FL_20240923c.txt", "rb") as f:
+        content = f.read()
+
+    expected = parse(StringIO(content.decode("utf-8", errors="replace")), mapping)
+    assert parse_bytes(content, mapping).getvalue() == expected.getvalue()
+
+    chunks = parse_stream(
+        BytesIO(content), mapping, chunk_size=500, backend=ParserBackend.BYTES
+    )
+    expected_chunks = parse_stream(BytesIO(content), mapping, chunk_size=500)
+    for (output, index), (expected_output, expected_index) in zip(
+        chunks, expected_chunks, strict=True
+    ):
+        assert index == expected_index
+        assert output.getvalue() == expected_output.getvalue()
+
+
+def test_split_records_same_as_splitlines():
+    data = (
+        b'ab"c\x00d\r\nxyz\rline\x0bbreaks\x1cand\xc2\x85more'
+        b"\xe2\x80\xa8caf\xc3\xa9 \xff\xe2\x80\n\n"
+    )
+    expected = data.decode("utf-8", errors="replace").splitlines()
+    records = split_records(data)
+    assert [r.decode("utf-8", errors="replace") for r in records] == expected
+    for block_size in (1, 2, 5):
+        assert list(iter_records(BytesIO(data), block_size=block_size)) == records
+
+
+def test_bytes_backend_same_as_python():
+    mapping = {
+        "fields": [
+            {"name": "field1", "start": 1, "end": 3},
+            {"name": "field2", "start": 4, "end": 6},
+        ]
+    }
+    data = b'a"bcdefg\r\nab\x00cdef\x00\x00\n \xc3\xa9 xyz\n\xffabcd\x1f\n\n'
+    expected = parse(StringIO(data.decode("utf-8", errors="replace")), mapping)
+    assert parse_bytes(data, mapping).getvalue() == expected.getvalue()
+
+
+def test_unknown_backend_raises():
+    mapping = {"fields": [{"name": "field1", "start": 1, "end": 3}]}
+    with pytest.raises(ValueError):
+        extract_rows(["abc"], mapping, "numpy")
+
+
+def test_parse_chunks_with_workers():
+    field_def = "../config/fixed_width_field_def/us_fl.json"
+    with open(field_def, "r") as f:
+        mapping = json.load(f)
+    with open("tests/test_data/US_FL_20240923c.txt", "rb") as f:
+        content = StringIO(f.read().decode("utf-8", errors="replace"))
+
+    expected = list(parse_chunks(content, mapping, chunk_size=300))
+    output = list(parse_chunks(content, mapping, chunk_size=300, workers=2))
+    assert [index for _, index in output] == list(range(len(expected)))
+    for (data, _), (expected_output, _) in zip(output, expected, strict=True):
+        assert isinstance(data, bytes)
+        assert bz2.decompress(data).decode("utf-8") == expected_output.getvalue()
+
+
+def test_parse_stream_rows_same_as_parse():
+    field_def = "../config/fixed_width_field_def/us_fl.json"
+    with open(field_def, "r") as f:
+        mapping = json.load(f)
+    with open("tests/test_data/US_FL_20240923c.txt", "rb") as f:
+        content = f.read()
+
+    expected = parse(StringIO(content.decode("utf-8", errors="replace")), mapping)
+    for backend in (ParserBackend.PYTHON, ParserBackend.BYTES):
+        output = StringIO()
+        csv.writer(output).writerows(
+            parse_stream_rows(BytesIO(content), mapping, backend=backend)
+        )
+        assert output.getvalue() == expected.getvalue()
+
+
+def test_record_hash_same_for_all_backends():
+    field_def = "../config/fixed_width_field_def/us_fl.json"
+    with open(field_def, "r") as f:
+        mapping = json.load(f)
+    with open("tests/test_data/US_FL_20240923c.txt", "rb") as f:
+        content = f.read()
+
+    expected = parse(
+        StringIO(content.decode("utf-8", errors="replace")),
+        mapping,
+        hash_algorithm="blake2b",
+    ).getvalue()
+    assert parse_bytes(content, mapping, hash_algorithm="blake2b").getvalue() == expected
+    rows = list(csv.reader(StringIO(expected)))
+    assert rows[0][-1] == "hash"
+    assert len({row[-1] for row in rows[1:]}) == len(rows) - 1
+
@@ -1,4 +1,9 @@
+import bz2
 import datetime
+import json
+import pytest
+from io import BytesIO
+from unittest.mock import MagicMock
 import handlers.fixed_width_text_handler as handler
 from handlers.fixed_width_text_handler import ContentType
 
@@ -22,3 +27,66 @@ def test_get_targte_file_key_default():
         jurisdiction, timestamp, raw_file_key, format=ContentType.Parquet
     )
     assert target_file_key == "us_fl/2024/10/21/abc.parquet"
+
+
+def get_chunk_uploads(upload_workers: int) -> dict[str, bytes]:
+    with open("../config/fixed_width_field_def/us_fl.json", "r") as f:
+        rules = json.load(f)
+    with open("tests/test_data/US_FL_20240923c.txt", "rb") as f:
+        file_obj = {"Body": BytesIO(f.read())}
+    metadata = {"source_timestamp": "2024-09-23T00:00:00", "source_name": "abc.txt"}
+    s3_client = MagicMock()
+
+    prefix, _ = handler.transform_to_csv_chunks(
+        "us_fl/2024/09/23/abc.txt",
+        "bucket",
+        file_obj,
+        metadata,
+        rules,
+        s3_client,
+        chunk_size=500,
+        upload_workers=upload_workers,
+        max_in_flight=2,
+    )
+    assert prefix == "us_fl/2024/9/23/abc"
+    return {
+        call.kwargs["Key"]: bz2.decompress(call.kwargs["Body"])
+        for call in s3_client.put_object.call_args_list
+    }
+
+
+def test_transform_to_csv_chunks_pipelined_uploads():
+    expected = get_chunk_uploads(upload_workers=0)
+    assert len(expected) == 5
+    assert get_chunk_uploads(upload_workers=2) == expected
+
+
+def test_null_or_empty_worker_counts_default_to_zero(monkeypatch):
+    s3_client = MagicMock()
+    s3_client.head_object.return_value = {
+        "ContentLength": 100,
+        "Metadata": {"jurisdiction": "us_fl"},
+    }
+    monkeypatch.setattr(handler.boto3, "client", lambda *args, **kwargs: s3_client)
+    monkeypatch.setenv("upload_workers", "")
+    process_file = MagicMock(return_value=("us_fl/abc.csv.bz2", 100))
+    monkeypatch.setattr(handler, "process_file", process_file)
+    monkeypatch.setattr(handler, "add_glue_job_task", MagicMock())
+
+    handler.lambda_handler(
+        {
+            "action": "START",
+            "key": "us_fl/abc.txt",
+            "raw_data_bucket": "raw",
+            "config_bucket": "config",
+            "source_data_bucket": "source",
+            "region": "eu-west-2",
+            "parse_workers": None,
+            "max_in_flight_chunks": "",
+        },
+        context=None,
+    )
+    kwargs = process_file.call_args.kwargs
+    assert kwargs["parse_workers"] == 0
+    assert kwargs["upload_workers"] == 0
+    assert kwargs["max_in_flight_chunks"] == 0
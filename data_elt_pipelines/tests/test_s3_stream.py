@@ -0,0 +1,274 @@
+import bz2
+import csv
+import gzip
+import json
+import os
+import pytest
+from io import BytesIO, StringIO
+from unittest.mock import MagicMock
+from shared.constants import CSV_SINK_FLUSH_SIZE
+from shared.content_type import ContentType
+from shared.s3_stream import (
+    CsvStreamSink,
+    DecompressingStream,
+    S3MultipartWriter,
+    iter_source_rows,
+)
+
+
+@pytest.fixture
+def s3_client():
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    client.upload_part.side_effect = lambda **kwargs: {
+        "ETag": f"etag-{kwargs['PartNumber']}"
+    }
+    return client
+
+
+def get_uploaded_parts(s3_client) -> bytes:
+    return b"".join(
+        call.kwargs["Body"] for call in s3_client.upload_part.call_args_list
+    )
+
+
+def test_small_object_uses_put_object(s3_client):
+    with S3MultipartWriter(s3_client, "bucket", "key.csv", {"a": "b"}) as writer:
+        writer.write(b"a,b\r\n")
+        writer.write(b"1,2\r\n")
+
+    s3_client.create_multipart_upload.assert_not_called()
+    s3_client.put_object.assert_called_once_with(
+        Body=b"a,b\r\n1,2\r\n",
+        Bucket="bucket",
+        Key="key.csv",
+        Metadata={"a": "b"},
+        ContentType="text/csv",
+    )
+    assert writer.size == 10
+
+
+def test_compressed_object_uploaded_in_parts(s3_client):
+    # bz2 only emits data once a 900 KB block is full, so write a few MB
+    data = [f"{i},{os.urandom(64).hex()}\r\n".encode("utf-8") for i in range(30000)]
+    writer = S3MultipartWriter(
+        s3_client, "bucket", "key.csv.bz2", compress=True, part_size=256 * 1024
+    )
+    for line in data:
+        writer.write(line)
+    size = writer.close()
+
+    upload_args = s3_client.create_multipart_upload.call_args.kwargs
+    assert upload_args["ContentEncoding"] == "bzip2"
+    body = get_uploaded_parts(s3_client)
+    assert len(body) == size
+    assert bz2.decompress(body) == b"".join(data)
+    parts = s3_client.complete_multipart_upload.call_args.kwargs["MultipartUpload"]
+    assert [part["PartNumber"] for part in parts["Parts"]] == list(
+        range(1, s3_client.upload_part.call_count + 1)
+    )
+    s3_client.put_object.assert_not_called()
+
+
+def test_sink_aborts_upload_on_error(s3_client):
+    writer = S3MultipartWriter(s3_client, "bucket", "key.csv", part_size=16)
+    with pytest.raises(ValueError):
+        with CsvStreamSink([writer], flush_size=1) as sink:
+            sink.writerow(["a long enough value", "to start the upload"])
+            raise ValueError("failed")
+
+    s3_client.abort_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="key.csv", UploadId="upload-id"
+    )
+    s3_client.complete_multipart_upload.assert_not_called()
+
+
+def test_sink_aborts_every_upload_when_a_close_fails(s3_client):
+    failing = MagicMock()
+    failing.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    failing.upload_part.return_value = {"ETag": "etag"}
+    failing.complete_multipart_upload.side_effect = ValueError("complete failed")
+    with pytest.raises(ValueError, match="complete failed"):
+        with CsvStreamSink(
+            [
+                S3MultipartWriter(failing, "bucket", "a.csv", part_size=16),
+                S3MultipartWriter(s3_client, "bucket", "b.csv", part_size=16),
+            ],
+            flush_size=1,
+        ) as sink:
+            sink.writerow(["a long enough value", "to start the upload"])
+
+    failing.abort_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="a.csv", UploadId="upload-id"
+    )
+    s3_client.abort_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="b.csv", UploadId="upload-id"
+    )
+    s3_client.complete_multipart_upload.assert_not_called()
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_sink_writes_same_csv_to_every_writer(s3_client, concurrent):
+    rows = [{"id": str(i), "name": f"name, {i}"} for i in range(1000)]
+    plain = MagicMock()
+    compressed = MagicMock()
+    with CsvStreamSink(
+        [
+            S3MultipartWriter(plain, "bucket", "key.csv"),
+            S3MultipartWriter(compressed, "bucket", "key.csv.bz2", compress=True),
+        ],
+        fieldnames=["id", "name"],
+        flush_size=100,
+        concurrent=concurrent,
+    ) as sink:
+        sink.writerows(rows)
+
+    expected = StringIO()
+    writer = csv.DictWriter(expected, fieldnames=["id", "name"])
+    writer.writeheader()
+    writer.writerows(rows)
+    expected = expected.getvalue().encode("utf-8")
+    assert plain.put_object.call_args.kwargs["Body"] == expected
+    assert bz2.decompress(compressed.put_object.call_args.kwargs["Body"]) == expected
+
+
+def test_concurrent_sink_uploads_parts_in_order(s3_client):
+    compressed = MagicMock()
+    rows = [[str(i), os.urandom(8).hex()] for i in range(2000)]
+    with CsvStreamSink(
+        [
+            S3MultipartWriter(s3_client, "bucket", "key.csv", part_size=1000),
+            S3MultipartWriter(compressed, "bucket", "key.csv.bz2", compress=True),
+        ],
+        flush_size=100,
+        concurrent=True,
+    ) as sink:
+        sink.writerows(rows)
+
+    expected = StringIO()
+    csv.writer(expected).writerows(rows)
+    expected = expected.getvalue().encode("utf-8")
+    assert get_uploaded_parts(s3_client) == expected
+    assert bz2.decompress(compressed.put_object.call_args.kwargs["Body"]) == expected
+
+
+# with a flush size of 1 the parts are uploaded while the rows are written,
+# with the default they are only uploaded once the writers are flushed by close
+@pytest.mark.parametrize("flush_size", [1, CSV_SINK_FLUSH_SIZE])
+def test_concurrent_sink_aborts_every_upload_on_error(s3_client, flush_size):
+    failing = MagicMock()
+    failing.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    failing.upload_part.side_effect = ValueError("upload failed")
+    with pytest.raises(ValueError, match="upload failed"):
+        with CsvStreamSink(
+            [
+                S3MultipartWriter(s3_client, "bucket", "key.csv", part_size=16),
+                S3MultipartWriter(failing, "bucket", "key.csv.bz2", part_size=16),
+            ],
+            flush_size=flush_size,
+            concurrent=True,
+        ) as sink:
+            sink.writerows([str(i), "a long enough value"] for i in range(100))
+
+    for client in (s3_client, failing):
+        client.abort_multipart_upload.assert_called_once()
+        client.complete_multipart_upload.assert_not_called()
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_sink_deletes_created_objects_when_a_close_fails(s3_client, concurrent):
+    failing = MagicMock()
+    failing.put_object.side_effect = ValueError("put failed")
+    with pytest.raises(ValueError, match="put failed"):
+        with CsvStreamSink(
+            [
+                S3MultipartWriter(s3_client, "bucket", "key.csv"),
+                S3MultipartWriter(failing, "bucket", "key.csv.bz2", compress=True),
+            ],
+            concurrent=concurrent,
+        ) as sink:
+            sink.writerows([str(i), "a value"] for i in range(10))
+
+    # the plain csv was created before the bz2 one failed, it is deleted again
+    s3_client.put_object.assert_called_once()
+    s3_client.delete_object.assert_called_once_with(Bucket="bucket", Key="key.csv")
+    failing.delete_object.assert_not_called()
+
+
+class SmallReads(BytesIO):
+    """
+    A stream returning at most size bytes per read, like a slow network stream
+    """
+
+    def __init__(self, data: bytes, size: int):
+        super().__init__(data)
+        self.size = size
+
+    def read(self, size: int = -1) -> bytes:
+        return super().read(self.size)
+
+
+def get_csv_bytes(rows: list[list[str]]) -> bytes:
+    text = StringIO()
+    csv.writer(text).writerows(rows)
+    return text.getvalue().encode("utf-8")
+
+
+@pytest.mark.parametrize(
+    "content_encoding, compress",
+    [
+        (None, lambda data: data),
+        ("bzip2", bz2.compress),
+        ("gzip", gzip.compress),
+        # concatenated streams, as written by parallel compressors
+        ("bzip2", lambda data: bz2.compress(data[:100]) + bz2.compress(data[100:])),
+        ("gzip", lambda data: gzip.compress(data[:100]) + gzip.compress(data[100:])),
+    ],
+)
+def test_iter_source_rows_csv(content_encoding, compress):
+    rows = [["COR_NUMBER", "COR_NAME"]] + [
+        [str(i), f"Café {i}\nline two" if i % 7 == 0 else f"Name, {i}"]
+        for i in range(500)
+    ]
+    data = compress(get_csv_bytes(rows))
+    result = list(iter_source_rows(SmallReads(data, 64), ContentType.CSV, content_encoding))
+    assert result == [dict(zip(rows[0], row)) for row in rows[1:]]
+
+
+def test_iter_source_rows_json_lines():
+    lines = [json.dumps({"COR_NUMBER": str(i), "nested": {"a": i}}) for i in range(50)]
+    data = gzip.compress(("\n".join(lines) + "\n\n").encode("utf-8"))
+    rows = iter_source_rows(SmallReads(data, 10), ContentType.Json_lines, "gzip")
+    assert next(rows) == {"COR_NUMBER": "0", "nested": {"a": 0}}
+    assert len(list(rows)) == 49
+
+
+@pytest.mark.parametrize(
+    "content_encoding, compress", [("bzip2", bz2.compress), ("gzip", gzip.compress)]
+)
+@pytest.mark.parametrize("streams", [1, 2])
+def test_decompressing_stream_bounds_the_output(content_encoding, compress, streams):
+    data = b"a" * 1_000_000
+    compressed = compress(data) * streams
+    stream = DecompressingStream(
+        BytesIO(compressed),
+        content_encoding,
+        block_size=len(compressed),
+        output_size=1000,
+    )
+    # the whole object is read in one block, it is decompressed 1000 bytes at a time
+    blocks = list(iter(lambda: stream.read(100_000), b""))
+    assert max(len(block) for block in blocks) == 1000
+    assert b"".join(blocks) == data * streams
+
+
+def test_iter_source_rows_errors():
+    # raised by the call, before the first row is read
+    with pytest.raises(ValueError, match="not supported"):
+        iter_source_rows(BytesIO(b""), ContentType.CSV, "zstd")
+    with pytest.raises(ValueError, match="unsupported content type"):
+        iter_source_rows(BytesIO(b""), ContentType.Parquet)
+    data = bz2.compress(b"a,b\n1,2\n")
+    with pytest.raises(EOFError):
+        list(iter_source_rows(BytesIO(data[:-10]), ContentType.CSV, "bzip2"))
+
@@ -1,5 +1,13 @@
+import asyncio
+import csv
+import json
+import pytest
 from datetime import datetime
+from io import BytesIO
+from unittest.mock import MagicMock
+import handlers.schema_transformation_handler as handler
 import schema_transformation.cdm_mapper as cdm_mapper
+from schema_transformation.cdm_mapping_rule import MappingRules
 from shared.metadata import CdmFileMetaData
 from shared.cdm_company import OrderedEnum
 
@@ -84,3 +92,128 @@ def test_is_metadata_set_with_partial_metadata():
 def test_is_metadata_set_with_empty_model():
     cdm_model = {}
     assert not cdm_mapper.is_metadata_set(cdm_model, metadata)
+
+
+def run_create_cdm_model(monkeypatch, process_result, **kwargs):
+    mapping_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    with open("tests/test_data/us_fl_source_small.csv", "r") as f:
+        row = next(csv.DictReader(f))
+    data = iter([{**row, "COR_NUMBER": str(i)} for i in range(10)])
+    monkeypatch.setattr(handler, "process_result", process_result)
+    asyncio.run(
+        handler.create_cdm_model(
+            MagicMock(),
+            "bucket",
+            "cor/2024/10/12/abc.csv",
+            handler.ContentType.CSV,
+            data,
+            "us_fl",
+            mapping_rules,
+            metadata,
+            chunk_size=2,
+            upload_workers=2,
+            **kwargs,
+        )
+    )
+
+
+def test_create_cdm_model_pipeline(monkeypatch):
+    uploads = {}
+    running = []
+
+    async def process_result(*args, index, **kwargs):
+        valid, _, _ = args[-1]
+        running.append(index)
+        # both workers are busy before either of them is done
+        await asyncio.sleep(0.01)
+        assert len(running) <= 2
+        uploads[index] = [record["company_number"] for record in valid]
+        running.remove(index)
+
+    incremental_run = MagicMock(removed_keys=[])
+    run_create_cdm_model(monkeypatch, process_result, incremental_run=incremental_run)
+    assert uploads == {i: [str(i * 2), str(i * 2 + 1)] for i in range(5)}
+    incremental_run.commit.assert_called_once()
+
+
+def test_create_cdm_model_upload_error(monkeypatch):
+    async def process_result(*args, index, **kwargs):
+        if index == 1:
+            raise ValueError("Error processing file")
+
+    incremental_run = MagicMock(removed_keys=[])
+    with pytest.raises(ValueError, match="Error processing file"):
+        run_create_cdm_model(
+            monkeypatch, process_result, incremental_run=incremental_run
+        )
+    # the index is only saved once every chunk is written
+    incremental_run.commit.assert_not_called()
+
+
+def test_get_cdm_outputs():
+    assert handler.get_cdm_outputs(None) == (handler.CdmOutput.CSV, handler.CdmOutput.BZ2)
+    assert handler.get_cdm_outputs("bz2") == (handler.CdmOutput.BZ2,)
+    assert handler.get_cdm_outputs(["csv"]) == (handler.CdmOutput.CSV,)
+    with pytest.raises(ValueError):
+        handler.get_cdm_outputs("csv,gzip")
+
+
+def test_save_csv_with_one_output():
+    s3_client = MagicMock()
+    file_arn = handler.save_csv(
+        [("1", "Test Company")],
+        {},
+        "bucket",
+        "us_fl/abc.csv",
+        s3_client,
+        fieldnames=("company_number", "name"),
+        cdm_outputs=(handler.CdmOutput.BZ2,),
+    )
+    assert file_arn == "bucket/us_fl/abc.csv.bz2"
+    s3_client.put_object.assert_called_once()
+    assert s3_client.put_object.call_args.kwargs["Key"] == "us_fl/abc.csv.bz2"
+
+
+@pytest.mark.parametrize(
+    "key, incremental",
+    [("cor/2024/10/12/abc.csv", True), ("cor/2024/10/12/abc/abc_0.csv", False)],
+)
+def test_lambda_handler_maps_chunks_in_full(monkeypatch, tmp_path, key, incremental):
+    with open("tests/test_data/us_fl_source_small.csv", "rb") as f:
+        body = f.read()
+    s3_client = MagicMock()
+    s3_client.get_object.return_value = {
+        "Body": BytesIO(body),
+        "ContentType": handler.ContentType.CSV.value,
+        "Metadata": {"jurisdiction": "us_fl"},
+    }
+    monkeypatch.setattr(handler.boto3, "client", lambda *args, **kwargs: s3_client)
+    mapping_rules = MappingRules(
+        **json.load(open("tests/test_data/cdm_mapping_us_fl.json"))
+    )
+    monkeypatch.setattr(
+        handler.mapping_rules_cache, "get", lambda *args, **kwargs: mapping_rules
+    )
+    runs = []
+
+    async def create_cdm_model(*args):
+        runs.append(args[12])
+
+    monkeypatch.setattr(handler, "create_cdm_model", create_cdm_model)
+
+    handler.lambda_handler(
+        {
+            "bucket": "source",
+            "key": key,
+            "config_bucket": "config",
+            "cdm_data_bucket": "cdm",
+            "region": "eu-west-2",
+            "hash_index_store": "local",
+            "hash_index_location": str(tmp_path),
+        },
+        context=None,
+    )
+    # a chunk isn't the whole snapshot, it is mapped without the index
+    assert (runs[0] is not None) == incremental
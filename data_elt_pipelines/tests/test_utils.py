@@ -8,11 +8,13 @@ from shared.utils import (
     list_s3_objects, 
     get_timestamp_string, 
     is_date_string_valid,
-    encode_jsonb_fields
+    encode_jsonb_fields,
+    parse_date,
+    DateValue,
     )
 from shared.param_models import FileParam
 from pydantic_core._pydantic_core import ValidationError
-from shared.utils import get_target_s3_object_key
+from shared.utils import get_target_s3_object_key, is_chunk_object_key
 from shared.content_type import ContentType
 
 def test_empty_file_name():    
@@ -824,3 +826,36 @@ def test_get_target_s3_object_key_without_original_key():
     expected = "us_fl/2024/10/7/anon.csv"
     result = get_target_s3_object_key(prefix, timestamp, None, format, index, add_file_name_as_prefix)
     assert result == expected, f"Expected {expected}, but got {result}"
+
+
+def test_parse_date():
+    assert parse_date("132021", "%m%d%Y") == ("01032021", True)
+    assert parse_date("132021", "%m%d%Y") == ("01032021", True)
+    assert parse_date("13/40/2021", "%m/%d/%Y") == ("13/40/2021", False)
+    with pytest.raises(TypeError):
+        parse_date(["132021"], "%m%d%Y")
+
+
+def test_is_date_string_valid_with_mapped_date():
+    date = DateValue(
+        {"value": "13/40/2021", "format": "MM/DD/YYYY", "python_date_format": "%m/%d/%Y"},
+        valid=True,
+    )
+    # the flag set by the mapper is used, the value isn't parsed again
+    assert is_date_string_valid({"date": date}) is True
+    date.valid = False
+    assert is_date_string_valid({"date": date}) is False
+    assert json.loads(json.dumps(date)) == dict(date)
+
+
+def test_is_chunk_object_key():
+    timestamp = datetime(2024, 9, 23)
+    chunk = get_target_s3_object_key(
+        "us_fl", timestamp, "abc.txt", index=3, add_file_name_as_prefix=True
+    )
+    assert is_chunk_object_key(chunk)
+    assert not is_chunk_object_key(
+        get_target_s3_object_key("us_fl", timestamp, "abc.txt")
+    )
+    assert not is_chunk_object_key("us_fl/2024/9/23/abc/abc_x.csv.bz2")
+    assert not is_chunk_object_key("abc_0.csv")
@@ -64,6 +64,17 @@ data "aws_iam_policy_document" "ecs_data_etl_execution_role_policy_doc" {
     ]
   }
 
+  statement {
+    effect = "Allow"
+    actions = [
+      # a chunk written as csv and csv.bz2 is deleted again if one of them fails
+      "s3:DeleteObject"
+    ]
+    resources = [
+      "${aws_s3_bucket.cdm_data.arn}/*",
+    ]
+  }
+
   statement {
     effect = "Allow"
     actions = [
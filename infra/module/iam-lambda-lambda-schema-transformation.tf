@@ -5,7 +5,7 @@
 # - Amazon EventBridge (events:PutEvents)
 # - Amazon CloudWatch Logs (logs:CreateLogGroup, logs:CreateLogStream, logs:PutLogEvents)
 # - Amazon S3 module.source_data.arn (s3:GetObject, s3:ListBucket) 
-# - Amazon S3 module.cdm_data.arn (s3:GetObject, s3:ListBucket, s3:PutObject)
+# - Amazon S3 module.cdm_data.arn (s3:GetObject, s3:ListBucket, s3:PutObject, s3:DeleteObject)
 
 resource "aws_iam_role" "lambda_role_schema_transformation" {
   name = "${local.short_name}-lambda-cdm-mapper-role"
@@ -96,6 +96,8 @@ data "aws_iam_policy_document" "lambda_policy_schema_transformation" {
     effect = "Allow"
     actions = [
       "s3:PutObject",
+      # a chunk written as csv and csv.bz2 is deleted again if one of them fails
+      "s3:DeleteObject",
     ]
     resources = [
       "${aws_s3_bucket.cdm_data.arn}/*",